@@ -0,0 +1,329 @@
+"""
+End-to-end throughput benchmark of the sync path. It feeds batches of
+container rows to MetadataSync.handle(), as the crawler does, with a fake
+Elasticsearch cluster (see fake_es) and a fake Swift internal client (see
+fake_swift), and reports the rows per second, the latency of the batches,
+and the requests made to Elasticsearch.
+
+    python -m bench.driver --rows 10000 --batch-size 1000 --passes 2 \\
+        --head-latency 0.002 --bulk-latency 0.02
+
+The first pass indexes every row; the later passes find the documents up to
+date, as when verifying the rows processed by another node. The rows are
+generated, unless --db points at container databases, e.g. the ones made by
+bench.make_container_db. The mapping and
+global options of the daemon are passed with --setting and --option, e.g.
+`--setting head_concurrency=8 --option engine=eventlet`.
+"""
+import argparse
+import eventlet
+import json
+import logging
+import math
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from swift.common.utils import Timestamp
+from swift.container.backend import ContainerBroker
+from swift_metadata_sync.metadata_sync import MetadataSyncFactory
+from swift_metadata_sync.stages import StageTimings
+
+from . import fake_es
+from .fake_swift import FakeInternalClient
+from .make_container_db import OBJECT_META_KEY
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_options(options):
+    """Parses a list of key=value options, with JSON values if possible."""
+    parsed = {}
+    for option in options or []:
+        key, _, value = option.partition('=')
+        parsed[key] = parse_value(value)
+    return parsed
+
+
+def make_rows(count, container, deleted=0.0, start_time=None):
+    """Returns the container rows of `count` objects."""
+    if start_time is None:
+        start_time = time.time()
+    deleted_every = int(round(1 / deleted)) if deleted else 0
+    rows = []
+    for i in range(count):
+        rows.append({'ROWID': i + 1,
+                     'name': '%s/dir-%03d/object-%08d' % (
+                         container, i % 1000, i),
+                     'created_at': Timestamp(start_time + i * 1e-3).internal,
+                     'size': 1024 + i,
+                     'content_type': 'application/octet-stream',
+                     'etag': '%032x' % i,
+                     'deleted': int(bool(deleted_every) and
+                                    i % deleted_every == deleted_every - 1)})
+    return rows
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def es_request(url, path, method='GET'):
+    request = urllib2.Request(url + path, data='' if method == 'POST' else
+                              None)
+    return json.load(urllib2.urlopen(request))
+
+
+class StageCollector(object):
+    """A stage hook that adds up the stage timings of every batch."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = StageTimings()
+
+    def __call__(self, labels, stages):
+        with self._lock:
+            self.stages.merge(stages)
+
+
+class Container(object):
+    """
+        A container and the MetadataSync instance syncing it. The rows are
+        read from the broker, if there is one.
+    """
+    def __init__(self, factory, settings, internal_client, rows=None,
+                 broker=None):
+        self.sync = factory.instance(settings)
+        self.account = settings['account']
+        self.container = settings['container']
+        self.rows = rows
+        self.broker = broker
+        self.internal_client = internal_client
+        self.db_id = 'bench-db-%s' % settings['container']
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.failed_batches = 0
+        self.handled_rows = 0
+
+    def _batches(self, batch_size):
+        if self.broker is None:
+            for i in range(0, len(self.rows), batch_size):
+                yield self.rows[i:i + batch_size]
+            return
+        last_row = 0
+        while True:
+            batch = self.broker.get_items_since(last_row, batch_size)
+            if not batch:
+                return
+            yield batch
+            last_row = batch[-1]['ROWID']
+
+    def run_pass(self, batch_size, verify=False):
+        """
+            Handles every row. When verifying, the rows are recorded as
+            verified rather than processed, as the crawler does.
+        """
+        self.sync.get_last_processed_row(self.db_id)
+        for batch in self._batches(batch_size):
+            self.internal_client.add_rows(self.account, self.container, batch)
+            start = time.time()
+            try:
+                self.sync.handle(batch, self.internal_client)
+            except Exception:
+                self.failed_batches += 1
+            self.latencies.append(time.time() - start)
+            self.internal_client.remove_rows(self.account, self.container,
+                                             batch)
+            self.handled_rows += len(batch)
+            if verify:
+                self.sync.save_last_verified_row(batch[-1]['ROWID'],
+                                                 self.db_id)
+            else:
+                self.sync.save_last_processed_row(batch[-1]['ROWID'],
+                                                  self.db_id)
+
+
+def run(args, es_url):
+    status_dir = tempfile.mkdtemp(prefix='swift-metadata-sync-bench-')
+    try:
+        conf = {'status_dir': status_dir}
+        conf.update(parse_options(args.option))
+        factory = MetadataSyncFactory(conf)
+        stage_collector = StageCollector()
+        factory.stage_hooks.append(stage_collector)
+        internal_client = FakeInternalClient(
+            args.head_latency, args.user_meta, args.meta_size)
+        start_time = time.time() - 3600
+        containers = []
+        for i in range(len(args.db) if args.db else args.containers):
+            settings = {'account': u'AUTH_bench',
+                        'container': u'bench-%d' % i,
+                        'index': args.index,
+                        'es_hosts': es_url}
+            settings.update(parse_options(args.setting))
+            if args.db:
+                broker = ContainerBroker(args.db[i])
+                info = broker.get_info()
+                settings['account'] = info['account'].decode('utf-8')
+                settings['container'] = info['container'].decode('utf-8')
+                if OBJECT_META_KEY in broker.metadata:
+                    object_meta = json.loads(
+                        broker.metadata[OBJECT_META_KEY][0])
+                    internal_client.user_meta = object_meta['count']
+                    internal_client.meta_size = object_meta['size']
+                containers.append(Container(
+                    factory, settings, internal_client, broker=broker))
+                continue
+            rows = make_rows(args.rows, settings['container'],
+                             args.deleted, start_time)
+            containers.append(Container(factory, settings, internal_client,
+                                        rows=rows))
+
+        results = []
+        for pass_number in range(1, args.passes + 1):
+            es_request(es_url, '/_bench/reset', 'POST')
+            heads = internal_client.heads
+            stage_collector.reset()
+            for container in containers:
+                container.reset()
+            threads = [threading.Thread(target=container.run_pass,
+                                        args=(args.batch_size,
+                                              pass_number > 1))
+                       for container in containers]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            factory.flush()
+
+            latencies = sum((container.latencies
+                             for container in containers), [])
+            rows = sum(container.handled_rows for container in containers)
+            results.append({
+                'pass': pass_number,
+                'rows': rows,
+                'seconds': elapsed,
+                'rows_per_second': rows / elapsed,
+                'batch_p50_ms': percentile(latencies, 0.5) * 1000,
+                'batch_p99_ms': percentile(latencies, 0.99) * 1000,
+                'failed_batches': sum(container.failed_batches
+                                      for container in containers),
+                'es_requests': es_request(es_url, '/_bench/stats'),
+                'swift_heads': internal_client.heads - heads,
+                'stages': dict(stage_collector.stages.items()),
+                'bulk_sizes': factory.bulk_sizes(),
+                'max_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss})
+        return results
+    finally:
+        shutil.rmtree(status_dir)
+
+
+def format_result(result):
+    lines = ['pass %(pass)d: %(rows)d rows in %(seconds).2fs, '
+             '%(rows_per_second).0f rows/s, batch p50 %(batch_p50_ms).1fms '
+             'p99 %(batch_p99_ms).1fms, %(failed_batches)d failed batches'
+             % result]
+    lines.append('  elasticsearch: %s' % ', '.join(
+        '%s=%d' % item for item in sorted(result['es_requests'].items())))
+    lines.append('  swift: heads=%d' % result['swift_heads'])
+    for stage in StageTimings.STAGES:
+        entry = result['stages'][stage]
+        if entry['items']:
+            lines.append('  %-14s %8.3fs %8d items %12d bytes' % (
+                stage, entry['seconds'], entry['items'], entry['bytes']))
+    lines.append('  max RSS: %d KiB' % result['max_rss_kb'])
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Throughput benchmark of swift-metadata-sync')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='rows of each container; defaults to 10000')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='rows handled at a time (the items_chunk of the '
+                        'crawler); defaults to 1000')
+    parser.add_argument('--containers', type=int, default=1,
+                        help='containers synced concurrently; defaults to 1')
+    parser.add_argument('--passes', type=int, default=1,
+                        help='passes over the rows; defaults to 1')
+    parser.add_argument('--deleted', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the rows that are deletions')
+    parser.add_argument('--head-latency', type=float, default=0.0,
+                        metavar='seconds',
+                        help='latency of the Swift HEAD requests')
+    parser.add_argument('--user-meta', type=int, default=2,
+                        help='user metadata headers of every object')
+    parser.add_argument('--meta-size', type=int, default=16,
+                        help='size of the user metadata values')
+    parser.add_argument('--db', action='append', metavar='path',
+                        help='read the rows from this container database '
+                        'instead of generating them (--rows, --deleted, and '
+                        '--containers are then ignored); may be repeated')
+    parser.add_argument('--index', default='bench',
+                        help='index of the documents')
+    parser.add_argument('--setting', action='append', metavar='key=value',
+                        help='mapping setting (the value is parsed as JSON '
+                        'if possible); may be repeated')
+    parser.add_argument('--option', action='append', metavar='key=value',
+                        help='global option of the daemon (the value is '
+                        'parsed as JSON if possible); may be repeated')
+    parser.add_argument('--es-url',
+                        help='use this Elasticsearch cluster instead of '
+                        'starting the fake one (it must serve /_bench/stats)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--log-level', default='error',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='logging level of the daemon; defaults to error')
+    fake_es.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr)
+    es_url = args.es_url
+    es_process = None
+    if not es_url:
+        es_process, es_url = fake_es.start_process(fake_es.get_options(args))
+    try:
+        if parse_options(args.option).get('engine') == 'eventlet':
+            # As in __main__, after the fake cluster has forked
+            eventlet.monkey_patch()
+        results = run(args, es_url)
+    finally:
+        if es_process:
+            es_process.terminate()
+    if args.json:
+        print json.dumps(results, indent=4, sort_keys=True)
+    else:
+        for result in results:
+            print format_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+"""
+A stand-in for an Elasticsearch cluster, for the benchmarks. It serves the
+requests that the daemon makes (info, get and put mapping, mget, search by
+ID, count, and bulk),
+keeps the documents in memory, and counts the requests. The latency of the
+requests and the rate of errors are configurable.
+
+It can be run on its own:
+
+    python -m bench.fake_es --port 9200 --bulk-latency 0.05
+
+The counters are served from /_bench/stats and reset with a POST to
+/_bench/reset.
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import multiprocessing
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+VERSION = '7.10.2'
+
+
+class FakeElasticsearch(object):
+    """
+        The state of the fake cluster.
+
+        `latency` maps the request types (info, get_mapping, put_mapping,
+        mget, search, and bulk) to their latency in seconds. `doc_latency` is
+        added to the mget, search, and bulk requests for every document.
+        `bulk_error_rate` is the fraction of the bulk requests that fail with
+        HTTP 503, `reject_rate` the fraction of the bulk items that are
+        rejected with HTTP 429, and `item_error_rate` the fraction of the bulk
+        items that fail with a mapping error (HTTP 400).
+    """
+    def __init__(self, latency=None, doc_latency=0.0, bulk_error_rate=0.0,
+                 reject_rate=0.0, item_error_rate=0.0, seed=None):
+        self.latency = latency or {}
+        self.doc_latency = doc_latency
+        self.bulk_error_rate = bulk_error_rate
+        self.reject_rate = reject_rate
+        self.item_error_rate = item_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._mappings = collections.defaultdict(dict)
+        self._docs = collections.defaultdict(dict)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = collections.Counter()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, request_type, docs=0, **errors):
+        with self._lock:
+            self._stats[request_type] += 1
+            if docs:
+                self._stats[request_type + '_docs'] += docs
+            for error, count in errors.items():
+                if count:
+                    self._stats[error] += count
+
+    def _sleep(self, request_type, docs=0):
+        delay = self.latency.get(request_type, 0.0) + docs * self.doc_latency
+        if delay:
+            time.sleep(delay)
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def info(self):
+        self._count('info')
+        self._sleep('info')
+        return 200, {'name': 'fake-es',
+                     'cluster_name': 'bench',
+                     'version': {'number': VERSION,
+                                 'build_flavor': 'default'},
+                     'tagline': 'You Know, for Search'}
+
+    def get_mapping(self, index):
+        self._count('get_mapping')
+        self._sleep('get_mapping')
+        with self._lock:
+            properties = dict(self._mappings[index])
+        mappings = {'properties': properties} if properties else {}
+        return 200, {index: {'mappings': mappings}}
+
+    def put_mapping(self, index, body):
+        self._count('put_mapping')
+        self._sleep('put_mapping')
+        with self._lock:
+            self._mappings[index].update(body.get('properties', {}))
+        return 200, {'acknowledged': True}
+
+    def mget(self, index, body, source_fields=None):
+        ids = body.get('ids') or [doc['_id'] for doc in body['docs']]
+        self._count('mget', len(ids))
+        self._sleep('mget', len(ids))
+        docs = []
+        with self._lock:
+            for doc_id in ids:
+                doc = self._docs[index].get(doc_id)
+                if doc is None:
+                    docs.append({'_index': index, '_id': doc_id,
+                                 'found': False})
+                    continue
+                source = doc['_source']
+                if source_fields is not None:
+                    source = dict((key, value)
+                                  for key, value in source.items()
+                                  if key in source_fields)
+                docs.append({'_index': index, '_id': doc_id, 'found': True,
+                             '_version': doc['_version'],
+                             '_source': source})
+        return 200, {'docs': docs}
+
+    def search(self, index, body):
+        """
+            Serves the ids queries of the verification, with the requested
+            doc values. Dates are formatted as epoch_millis.
+        """
+        ids = body['query']['ids']['values']
+        self._count('search', len(ids))
+        self._sleep('search', len(ids))
+        fields = [field['field'] if isinstance(field, dict) else field
+                  for field in body.get('docvalue_fields', [])]
+        hits = []
+        with self._lock:
+            for doc_id in ids[:body.get('size', 10)]:
+                doc = self._docs[index].get(doc_id)
+                if doc is None:
+                    continue
+                hit = {'_index': index, '_id': doc_id, '_score': 1.0}
+                values = dict((field, [str(doc['_source'][field])])
+                              for field in fields
+                              if field in doc['_source'])
+                if values:
+                    hit['fields'] = values
+                hits.append(hit)
+        return 200, {'hits': {'total': {'value': len(hits),
+                                        'relation': 'eq'},
+                              'hits': hits}}
+
+    def count(self, index):
+        self._count('count')
+        with self._lock:
+            return 200, {'count': len(self._docs[index])}
+
+    def bulk(self, lines, default_index=None):
+        actions = []
+        lines = iter(lines)
+        for line in lines:
+            action = json.loads(line)
+            op_type, meta = action.items()[0]
+            source = None
+            if op_type != 'delete':
+                source = json.loads(next(lines))
+            actions.append((op_type, meta, source))
+        start = time.time()
+        self._sleep('bulk', len(actions))
+        if self._chance(self.bulk_error_rate):
+            self._count('bulk', len(actions), bulk_errors=1)
+            return 503, {'error': {'type': 'unavailable_shards_exception',
+                                   'reason': 'injected error'},
+                         'status': 503}
+
+        items = []
+        rejected = 0
+        failed = 0
+        for op_type, meta, source in actions:
+            if self._chance(self.reject_rate):
+                rejected += 1
+                items.append({op_type: self._item_error(
+                    meta, default_index, 429,
+                    'es_rejected_execution_exception')})
+                continue
+            if op_type != 'delete' and self._chance(self.item_error_rate):
+                failed += 1
+                items.append({op_type: self._item_error(
+                    meta, default_index, 400, 'mapper_parsing_exception')})
+                continue
+            items.append({op_type: self._apply(
+                op_type, meta, source, default_index)})
+        self._count('bulk', len(actions), rejected_items=rejected,
+                    failed_items=failed)
+        errors = any('error' in item.values()[0] for item in items)
+        return 200, {'took': int((time.time() - start) * 1000),
+                     'errors': errors,
+                     'items': items}
+
+    @staticmethod
+    def _item_error(meta, default_index, status, error_type):
+        return {'_index': meta.get('_index', default_index),
+                '_id': meta.get('_id'),
+                'status': status,
+                'error': {'type': error_type, 'reason': 'injected error'}}
+
+    def _apply(self, op_type, meta, source, default_index):
+        index = meta.get('_index', default_index)
+        doc_id = meta['_id']
+        version = meta.get('version')
+        external = meta.get('version_type') == 'external'
+        result = {'_index': index, '_id': doc_id}
+        with self._lock:
+            docs = self._docs[index]
+            doc = docs.get(doc_id)
+            if external and doc is not None and doc['_version'] >= version:
+                result.update(status=409, error={
+                    'type': 'version_conflict_engine_exception',
+                    'reason': '[%s]: version conflict' % doc_id})
+                self._stats['version_conflicts'] += 1
+                return result
+            if op_type == 'delete':
+                if doc is None:
+                    result.update(status=404, result='not_found')
+                    return result
+                del docs[doc_id]
+                result.update(status=200, result='deleted')
+                return result
+            if not external:
+                version = doc['_version'] + 1 if doc else 1
+            docs[doc_id] = {'_source': source, '_version': version}
+            result.update(status=200 if doc else 201,
+                          result='updated' if doc else 'created',
+                          _version=version)
+            return result
+
+
+class FakeElasticsearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        # Checked by the Python client before any other request
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _handle(self):
+        es = self.server.es
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        body = self._read_body()
+
+        if parts == ['_bench', 'stats']:
+            return 200, es.stats()
+        if parts == ['_bench', 'reset']:
+            es.reset()
+            return 200, {'acknowledged': True}
+        if not parts:
+            return es.info()
+        if parts[-1] == '_bulk':
+            index = parts[0] if len(parts) > 1 else None
+            return es.bulk([line for line in body.split('\n') if line],
+                           index)
+        if len(parts) == 2 and parts[1] == '_mapping':
+            if self.command == 'GET':
+                return es.get_mapping(parts[0])
+            return es.put_mapping(parts[0], json.loads(body))
+        if len(parts) == 2 and parts[1] == '_search':
+            return es.search(parts[0], json.loads(body))
+        if len(parts) == 2 and parts[1] == '_count':
+            return es.count(parts[0])
+        if len(parts) == 2 and parts[1] == '_mget':
+            source_fields = None
+            if '_source' in query:
+                source_fields = query['_source'][0].split(',')
+            return es.mget(parts[0], json.loads(body), source_fields)
+        return 404, {'error': {'type': 'unsupported_request',
+                               'reason': '%s %s' % (self.command,
+                                                    self.path)},
+                     'status': 404}
+
+    def _dispatch(self):
+        try:
+            status, body = self._handle()
+        except Exception as e:
+            status, body = 500, {'error': {'type': 'exception',
+                                           'reason': repr(e)},
+                                 'status': 500}
+        self._respond(status, body)
+
+    do_GET = do_POST = do_PUT = do_HEAD = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeElasticsearchServer(SocketServer.ThreadingMixIn,
+                              BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, es):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, FakeElasticsearchHandler)
+        self.es = es
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+def _serve(address, options, port_queue):
+    server = FakeElasticsearchServer(address, FakeElasticsearch(**options))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_process(options, host='127.0.0.1', port=0):
+    """
+        Runs the fake cluster in a separate process, so that it does not
+        compete with the daemon for the interpreter. Returns the process and
+        the URL of the cluster.
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve, args=((host, port), options, port_queue))
+    process.daemon = True
+    process.start()
+    return process, 'http://%s:%d' % (host, port_queue.get(timeout=10))
+
+
+def add_arguments(parser):
+    """Adds the options of the fake cluster to the argument parser."""
+    for request_type in ('info', 'mapping', 'mget', 'search', 'bulk'):
+        parser.add_argument('--%s-latency' % request_type, type=float,
+                            default=0.0, metavar='seconds',
+                            help='latency of the %s requests' % request_type)
+    parser.add_argument('--doc-latency', type=float, default=0.0,
+                        metavar='seconds',
+                        help='latency added to mget, search, and bulk '
+                        'requests for every document')
+    parser.add_argument('--bulk-error-rate', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the bulk requests that fail with '
+                        'HTTP 503')
+    parser.add_argument('--reject-rate', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the bulk items rejected with '
+                        'HTTP 429')
+    parser.add_argument('--item-error-rate', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the indexed documents that fail '
+                        'with a mapping error')
+    parser.add_argument('--seed', type=int, help='seed of the injected errors')
+
+
+def get_options(args):
+    """Returns the keyword arguments of FakeElasticsearch from the args."""
+    return {'latency': {'info': args.info_latency,
+                        'get_mapping': args.mapping_latency,
+                        'put_mapping': args.mapping_latency,
+                        'mget': args.mget_latency,
+                        'search': args.search_latency,
+                        'bulk': args.bulk_latency},
+            'doc_latency': args.doc_latency,
+            'bulk_error_rate': args.bulk_error_rate,
+            'reject_rate': args.reject_rate,
+            'item_error_rate': args.item_error_rate,
+            'seed': args.seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fake Elasticsearch cluster for the benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeElasticsearchServer(
+        (args.host, args.port), FakeElasticsearch(**get_options(args)))
+    print 'Serving a fake Elasticsearch cluster on %s' % server.url
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
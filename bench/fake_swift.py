@@ -0,0 +1,53 @@
+"""
+A stand-in for the Swift internal client, for the benchmarks. It answers the
+HEAD requests of the daemon from the container rows, after a configurable
+latency.
+"""
+import email.utils
+import threading
+import time
+
+from swift.common.utils import decode_timestamps
+
+
+class FakeInternalClient(object):
+    """
+        Returns the metadata of the objects of the rows added with
+        `add_rows()`. Every HEAD request takes `head_latency` seconds and the
+        objects have `user_meta` user metadata headers of `meta_size` bytes.
+    """
+    def __init__(self, head_latency=0.0, user_meta=2, meta_size=16):
+        self.head_latency = head_latency
+        self.user_meta = user_meta
+        self.meta_size = meta_size
+        self.heads = 0
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def add_rows(self, account, container, rows):
+        for row in rows:
+            self._rows[(account, container, row['name'])] = row
+
+    def remove_rows(self, account, container, rows):
+        for row in rows:
+            self._rows.pop((account, container, row['name']), None)
+
+    def get_object_metadata(self, account, container, obj, headers=None,
+                            acceptable_statuses=None):
+        with self._lock:
+            self.heads += 1
+        if self.head_latency:
+            time.sleep(self.head_latency)
+        row = self._rows[(account, container, obj)]
+        # A POST updates the metadata timestamp of the row
+        _, _, timestamp = decode_timestamps(row['created_at'])
+        meta = {'x-timestamp': timestamp.internal,
+                'last-modified': email.utils.formatdate(
+                    float(timestamp), usegmt=True),
+                'content-length': str(row['size']),
+                'content-type': row['content_type'],
+                'etag': row['etag']}
+        for i in range(self.user_meta):
+            meta['x-object-meta-key-%d' % i] = ('value-%d-' % i).ljust(
+                self.meta_size, 'x')
+        return meta
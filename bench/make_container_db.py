@@ -0,0 +1,244 @@
+"""
+Generates a synthetic container database with Swift's ContainerBroker, for
+testing at scale. The rows are written as the object servers would: every
+object is created, a fraction of them are then updated with a POST (which
+replaces their rows with newer ones), and a fraction are deleted (replaced
+by tombstone rows).
+
+    python -m bench.make_container_db --output /tmp/bench.db \\
+        --objects 10000000 --names nested --deleted 0.05 --post-churn 0.1
+
+With --devices and --device, the database is placed where the crawler finds
+it, according to the container ring in --swift-dir.
+
+The container database does not hold the user metadata of the objects. The
+--meta-count and --meta-size options are recorded in the container metadata
+instead, and bench.driver uses them to size the HEAD responses of its fake
+Swift client.
+"""
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import random
+import time
+
+from swift.common.ring import Ring
+from swift.common.utils import Timestamp, hash_path, storage_directory
+from swift.container.backend import ContainerBroker, DATADIR
+
+
+OBJECT_META_KEY = 'X-Container-Meta-Bench-Object-Meta'
+NAME_DISTRIBUTIONS = ('sequential', 'random', 'nested', 'unicode')
+# Spacing of the timestamps of the generated rows
+TIMESTAMP_STEP = 0.001
+
+
+def make_name(i, distribution, fanout=100, length=0, seed=0):
+    """Returns the name (UTF-8) of the i-th object of the distribution."""
+    if distribution == 'sequential':
+        name = 'object-%010d' % i
+    elif distribution == 'random':
+        name = hashlib.md5('%d-%d' % (seed, i)).hexdigest()
+    elif distribution == 'nested':
+        name = 'dir-%03d/sub-%03d/object-%010d' % (
+            i % fanout, i // fanout % fanout, i)
+    elif distribution == 'unicode':
+        name = (u'r\xe9pertoire-%03d/\u6587\u4ef6-%010d' % (
+            i % fanout, i)).encode('utf-8')
+    else:
+        raise ValueError('Unknown name distribution: %s' % distribution)
+    if len(name) < length:
+        name += '-' + 'x' * (length - len(name) - 1)
+    return name
+
+
+def get_db_path(devices, device, account, container, swift_dir='/etc/swift'):
+    """Returns the path of the container database on the device."""
+    ring = Ring(swift_dir, ring_name='container')
+    part = ring.get_part(account, container)
+    container_hash = hash_path(account, container)
+    return os.path.join(devices, device,
+                        storage_directory(DATADIR, part, container_hash),
+                        container_hash + '.db')
+
+
+class ContainerDBGenerator(object):
+    """
+        Writes the rows of `objects` objects to the broker, in batches of
+        `batch_size` rows. `deleted` and `post_churn` are the fractions of the
+        objects that are deleted and updated with a POST.
+    """
+    def __init__(self, broker, objects, names='sequential', fanout=100,
+                 name_length=0, object_size=1024, deleted=0.0,
+                 post_churn=0.0, start_time=None, batch_size=10000, seed=0):
+        self.broker = broker
+        self.objects = objects
+        self.names = names
+        self.fanout = fanout
+        self.name_length = name_length
+        self.object_size = object_size
+        self.deleted = deleted
+        self.post_churn = post_churn
+        if start_time is None:
+            # The generated timestamps end around the current time
+            start_time = time.time() - 3 * objects * TIMESTAMP_STEP
+        self.start_time = start_time
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def _name(self, i):
+        return make_name(i, self.names, self.fanout, self.name_length,
+                         self.seed)
+
+    def _timestamp(self, phase, i):
+        return Timestamp(self.start_time + (phase * self.objects + i) *
+                         TIMESTAMP_STEP).internal
+
+    def _selected(self, fraction, salt):
+        """Yields the indices of a random fraction of the objects."""
+        rng = random.Random('%d-%s' % (self.seed, salt))
+        for i in xrange(self.objects):
+            if rng.random() < fraction:
+                yield i
+
+    def _put_items(self):
+        rng = random.Random(self.seed)
+        for i in xrange(self.objects):
+            yield {'name': self._name(i),
+                   'created_at': self._timestamp(0, i),
+                   'size': rng.randint(0, 2 * self.object_size),
+                   'content_type': 'application/octet-stream',
+                   'etag': hashlib.md5(str(i)).hexdigest(),
+                   'deleted': 0,
+                   'storage_policy_index': 0}
+
+    def _post_items(self):
+        for i in self._selected(self.post_churn, 'post'):
+            yield {'name': self._name(i),
+                   'created_at': self._timestamp(0, i),
+                   'meta_timestamp': self._timestamp(1, i),
+                   'size': 0,
+                   'content_type': 'application/octet-stream',
+                   'etag': hashlib.md5(str(i)).hexdigest(),
+                   'deleted': 0,
+                   'storage_policy_index': 0}
+
+    def _delete_items(self):
+        for i in self._selected(self.deleted, 'delete'):
+            yield {'name': self._name(i),
+                   'created_at': self._timestamp(2, i),
+                   'size': 0,
+                   'content_type': 'application/deleted',
+                   'etag': 'noetag',
+                   'deleted': 1,
+                   'storage_policy_index': 0}
+
+    def _merge(self, items):
+        count = 0
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.broker.merge_items(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.broker.merge_items(batch)
+            count += len(batch)
+        return count
+
+    def generate(self):
+        """Writes the rows and returns the number of each kind of update."""
+        return {'puts': self._merge(self._put_items()),
+                'posts': self._merge(self._post_items()),
+                'deletes': self._merge(self._delete_items())}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic container database')
+    parser.add_argument('--output', metavar='path',
+                        help='path of the database')
+    parser.add_argument('--devices', metavar='dir',
+                        help='place the database on a device in this '
+                        'directory, as the container server would')
+    parser.add_argument('--device', metavar='name',
+                        help='device of the database (with --devices)')
+    parser.add_argument('--swift-dir', default='/etc/swift',
+                        help='directory of the container ring (with '
+                        '--devices); defaults to /etc/swift')
+    parser.add_argument('--account', default='AUTH_bench')
+    parser.add_argument('--container', default='bench')
+    parser.add_argument('--objects', type=int, default=100000,
+                        help='number of objects; defaults to 100000')
+    parser.add_argument('--names', choices=NAME_DISTRIBUTIONS,
+                        default='sequential',
+                        help='distribution of the object names; defaults to '
+                        'sequential')
+    parser.add_argument('--fanout', type=int, default=100,
+                        help='directories at each level of the nested and '
+                        'unicode names; defaults to 100')
+    parser.add_argument('--name-length', type=int, default=0,
+                        help='pad the names to this length')
+    parser.add_argument('--object-size', type=int, default=1024,
+                        help='average object size in bytes; defaults to 1024')
+    parser.add_argument('--deleted', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the objects that are deleted')
+    parser.add_argument('--post-churn', type=float, default=0.0,
+                        metavar='fraction',
+                        help='fraction of the objects updated with a POST')
+    parser.add_argument('--meta-count', type=int, default=2,
+                        help='user metadata headers of every object; '
+                        'defaults to 2')
+    parser.add_argument('--meta-size', type=int, default=16,
+                        help='size of the user metadata values; defaults to '
+                        '16')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='rows written at a time; defaults to 10000')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated names and sizes')
+    args = parser.parse_args(argv)
+    if bool(args.output) == bool(args.devices):
+        parser.error('exactly one of --output and --devices is required')
+    if args.devices and not args.device:
+        parser.error('--devices requires --device')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_path = args.output or get_db_path(
+        args.devices, args.device, args.account, args.container,
+        args.swift_dir)
+    if os.path.exists(db_path):
+        raise SystemExit('%s already exists' % db_path)
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+
+    start = time.time()
+    broker = ContainerBroker(db_path, account=args.account,
+                             container=args.container)
+    put_timestamp = Timestamp.now().internal
+    broker.initialize(put_timestamp, 0)
+    broker.update_metadata({OBJECT_META_KEY: (
+        json.dumps({'count': args.meta_count, 'size': args.meta_size}),
+        put_timestamp)})
+    counts = ContainerDBGenerator(
+        broker, args.objects, names=args.names, fanout=args.fanout,
+        name_length=args.name_length, object_size=args.object_size,
+        deleted=args.deleted, post_churn=args.post_churn,
+        batch_size=args.batch_size, seed=args.seed).generate()
+    counts.update(path=db_path,
+                  max_row=broker.get_max_row(),
+                  object_count=broker.get_info()['object_count'],
+                  bytes=os.path.getsize(db_path),
+                  seconds=round(time.time() - start, 2))
+    print json.dumps(counts, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
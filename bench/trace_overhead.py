@@ -0,0 +1,79 @@
+"""
+Measures the cost of the debug output of a batch of rows, comparing the
+eager formatting that handle() used to do with the Tracer, at the INFO and
+DEBUG levels.
+
+    python -m bench.trace_overhead --rows 1000 --meta-size 1024
+"""
+import argparse
+import collections
+import logging
+import os
+import timeit
+
+from swift.common.utils import Timestamp
+from swift_metadata_sync.tracing import Tracer
+
+
+def make_batch(rows, meta_size):
+    """Returns the rows and stale rows of a batch, as handle() sees them."""
+    batch = [{'ROWID': i,
+              'name': 'dir-%03d/object-%08d' % (i % 100, i),
+              'created_at': Timestamp(1500000000 + i).internal,
+              'size': 1024,
+              'content_type': 'application/octet-stream;meta=%s' % (
+                  'x' * meta_size),
+              'etag': '%032x' % i,
+              'deleted': 0} for i in range(rows)]
+    mget_map = collections.OrderedDict(
+        ('%064x' % row['ROWID'], row) for row in batch)
+    return batch, mget_map, mget_map.items()
+
+
+def run(args):
+    logger = logging.getLogger('swift-metadata-sync-bench')
+    logger.propagate = False
+    logger.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    rows, mget_map, stale_rows = make_batch(args.rows, args.meta_size)
+    tracer = Tracer(u'AUTH_bench', u'bench', logger=logger)
+    sampled_out = Tracer(u'AUTH_bench', u'bench', 0, logger=logger)
+
+    def eager():
+        logger.debug("Handling rows: %s" % repr(rows))
+        logger.debug("multiple get map: %s" % repr(mget_map))
+        logger.debug("Stale rows: %s" % repr(stale_rows))
+
+    def traced(tracer=tracer):
+        tracer.trace('handle', rows=rows)
+        tracer.trace('mget', mget_map=mget_map)
+        tracer.trace('stale_rows', stale_rows=stale_rows)
+
+    cases = [('eager', eager), ('tracer', traced),
+             ('tracer, not sampled', lambda: traced(sampled_out))]
+    results = []
+    for level in ('INFO', 'DEBUG'):
+        logger.setLevel(level)
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+            results.append((level, name, seconds / args.number * 1e6))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Overhead of the debug output of handle()')
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='rows of the batch; defaults to 1000')
+    parser.add_argument('--meta-size', type=int, default=256,
+                        help='bytes of content type parameters of every '
+                        'row; defaults to 256')
+    parser.add_argument('--number', type=int, default=20,
+                        help='batches timed in each run; defaults to 20')
+    args = parser.parse_args(argv)
+    print '%-6s %-20s %14s' % ('level', 'output', 'us per batch')
+    for level, name, micros in run(args):
+        print '%-6s %-20s %14.1f' % (level, name, micros)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,16 @@
 import argparse
+import eventlet
 import json
-import logging
 import os
-import traceback
 
-from container_crawler.crawler import Crawler
-from .metadata_sync import MetadataSyncFactory
 
-
-def setup_logger(console=False, log_file=None, level='INFO'):
-    logger = logging.getLogger('swift-metadata-sync')
-    logger.setLevel(level)
-    formatter = logging.Formatter(
-        '[%(asctime)s] %(name)s [%(levelname)s]: %(message)s')
-    if console:
-        handler = logging.StreamHandler()
-    elif log_file:
-        handler = logging.handlers.RotatingFileHandler(log_file,
-                                                       maxBytes=100 * 2**20,
-                                                       backupCount=5)
-    else:
-        raise RuntimeError('log file must be set')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+# The backfill has the whole container to index, so it keeps more requests in
+# flight and sends larger bulk requests than the daemon does by default.
+BACKFILL_BATCH_SIZE = 10000
+BACKFILL_CHECKPOINT_ROWS = 100000
+BACKFILL_HEAD_CONCURRENCY = 128
+BACKFILL_BULK_MAX_DOCS = 5000
+BACKFILL_BULK_MAX_BYTES = 50 * 2**20
 
 
 def load_config(conf_file):
@@ -33,6 +21,12 @@ def load_config(conf_file):
 def parse_args():
     parser = argparse.ArgumentParser(
         description='Swift metadata synchronization daemon')
+    parser.add_argument('command', nargs='?', default='run',
+                        choices=['run', 'dlq', 'status', 'backfill'],
+                        help='run the daemon (default), list the rows in '
+                        'the dead letter queues, report how far behind '
+                        'each container is (as JSON), or backfill the index '
+                        'of a container')
     parser.add_argument('--config', metavar='conf', type=str, required=True,
                         help='path to the configuration file')
     parser.add_argument('--once', action='store_true',
@@ -43,6 +37,57 @@ def parse_args():
                         help='logging level; defaults to info')
     parser.add_argument('--console', action='store_true',
                         help='log messages to console')
+    parser.add_argument('--account', metavar='account', type=str,
+                        help='dlq: only the queues of the account; '
+                        'backfill: the account of the container')
+    parser.add_argument('--container', metavar='container', type=str,
+                        help='dlq: only the queues of the container; '
+                        'backfill: the container to backfill')
+    parser.add_argument('--retry', action='store_true',
+                        help='dlq: retry the due queued rows now')
+    parser.add_argument('--replay', action='store_true',
+                        help='dlq: retry the queued rows on the next pass, '
+                        'regardless of their backoff')
+    parser.add_argument('--target', metavar='name', type=str,
+                        help='backfill: the target of a mapping that lists '
+                        'several')
+    parser.add_argument('--force', action='store_true',
+                        help='backfill: even if the index is not empty')
+    parser.add_argument('--batch-size', metavar='rows', type=int,
+                        default=BACKFILL_BATCH_SIZE,
+                        help='backfill: rows read from the database at a '
+                        'time; defaults to %d' % BACKFILL_BATCH_SIZE)
+    parser.add_argument('--checkpoint-rows', metavar='rows', type=int,
+                        default=BACKFILL_CHECKPOINT_ROWS,
+                        help='backfill: rows between checkpoints; defaults '
+                        'to %d' % BACKFILL_CHECKPOINT_ROWS)
+    parser.add_argument('--head-concurrency', metavar='requests', type=int,
+                        default=BACKFILL_HEAD_CONCURRENCY,
+                        help='backfill: concurrent HEAD requests; defaults '
+                        'to %d' % BACKFILL_HEAD_CONCURRENCY)
+    parser.add_argument('--bulk-max-docs', metavar='docs', type=int,
+                        default=BACKFILL_BULK_MAX_DOCS,
+                        help='backfill: documents per bulk request; '
+                        'defaults to %d' % BACKFILL_BULK_MAX_DOCS)
+    parser.add_argument('--bulk-max-bytes', metavar='bytes', type=int,
+                        default=BACKFILL_BULK_MAX_BYTES,
+                        help='backfill: bytes per bulk request; defaults to '
+                        '%d' % BACKFILL_BULK_MAX_BYTES)
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the crawler cycles with cProfile')
+    parser.add_argument('--profile-dir', metavar='dir', type=str,
+                        default='/tmp/swift-metadata-sync-profiles',
+                        help='directory of the profiles; defaults to '
+                        '/tmp/swift-metadata-sync-profiles')
+    parser.add_argument('--profile-every', metavar='cycles', type=int,
+                        default=1,
+                        help='profile every N-th cycle; defaults to 1')
+    parser.add_argument('--profile-keep', metavar='count', type=int,
+                        default=10,
+                        help='number of profiles to keep; defaults to 10')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also summarize the memory usage of the '
+                        'profiled cycles')
     return parser.parse_args()
 
 
@@ -53,23 +98,16 @@ def main():
         exit(0)
 
     conf = load_config(args.config)
-    setup_logger(console=args.console, level=args.log_level.upper(),
-                 log_file=conf.get('log_file'))
-    factory = MetadataSyncFactory(conf)
-
-    logger = logging.getLogger('swift-metadata-sync')
-    logger.info('Starting Swift Metadata Sync')
-    try:
-        conf['bulk_process'] = True
-        crawler = Crawler(conf, factory, logger)
-        if args.once:
-            crawler.run_once()
-        else:
-            crawler.run_always()
-    except Exception as e:
-        logger.error("Metadata Sync failed: %s" % repr(e))
-        logger.error(traceback.format_exc(e))
-        exit(1)
+    if args.command == 'backfill' or (
+            conf.get('engine') == 'eventlet' and
+            (args.command == 'run' or args.retry)):
+        # The backfill and the eventlet engine run on green threads. The
+        # sockets and threads are patched before the crawler, the clients,
+        # and the logging handlers are imported, so that none of them binds
+        # the unpatched ones.
+        eventlet.monkey_patch()
+    from . import commands
+    commands.main(conf, args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+import errno
+import fcntl
+import logging
+import os
+import os.path
+import time
+
+
+class BackfillLock(object):
+    """
+        Marks a container as being backfilled. The lock file is kept next to
+        the status file and locked (with flock) for as long as the backfill
+        runs, so that the daemon leaves the container alone until the backfill
+        ends, even if the backfill is killed.
+    """
+    SUFFIX = '.backfill'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        lock_dir = os.path.dirname(self.path)
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise RuntimeError('A backfill is already running')
+            raise
+        self._file = lock_file
+
+    def release(self):
+        if self._file is None:
+            return
+        os.unlink(self.path)
+        # Closing the file releases the lock
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @staticmethod
+    def is_held(path):
+        """Returns True if a backfill holds the lock file."""
+        try:
+            lock_file = open(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        finally:
+            lock_file.close()
+        return False
+
+
+class Backfill(object):
+    """
+        Indexes every row of a container database into an empty index, ahead
+        of the incremental sync. As the index has no documents, the rows are
+        indexed without looking up the existing documents. The progress is
+        recorded every `checkpoint_rows` rows (and marked as a backfill, so
+        that an interrupted backfill can be resumed) and, once the backfill
+        catches up with the database, as the last processed and verified row
+        of the mapping, from which the daemon carries on.
+
+        The HEAD request concurrency and the bulk request sizes are those of
+        the MetadataSync instance, which is expected to be set up for the
+        backfill.
+    """
+    DEFAULT_BATCH_SIZE = 10000
+    DEFAULT_CHECKPOINT_ROWS = 100000
+
+    def __init__(self, sync, broker, internal_client,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 checkpoint_rows=DEFAULT_CHECKPOINT_ROWS):
+        if batch_size < 1:
+            raise RuntimeError(
+                'batch_size must be a positive integer: {}'.format(
+                    batch_size))
+        self._sync = sync
+        self._broker = broker
+        self._internal_client = internal_client
+        self._batch_size = batch_size
+        self._checkpoint_rows = checkpoint_rows
+        self.logger = logging.getLogger('swift-metadata-sync')
+
+    def run(self, force=False):
+        """
+            Runs the backfill and returns the number of rows processed and the
+            last row reached. Raises a RuntimeError if the mapping has already
+            been synced or, unless `force` is set, if the index is not empty.
+        """
+        db_id = self._broker.get_info()['id']
+        with self._sync.backfill_lock():
+            row = self._sync.get_last_processed_row(db_id)
+            if not self._sync.is_backfill(db_id):
+                if row:
+                    raise RuntimeError(
+                        'The mapping is already synced up to row %d' % row)
+                if not force and self._sync.count_documents():
+                    raise RuntimeError('The index is not empty')
+                self._sync.save_backfill_row(row, db_id)
+            start = time.time()
+            checkpoint = row
+            processed = 0
+            while True:
+                rows = self._broker.get_items_since(row, self._batch_size)
+                if rows:
+                    self._sync.backfill(rows, self._internal_client)
+                    row = rows[-1]['ROWID']
+                    processed += len(rows)
+                if len(rows) < self._batch_size:
+                    break
+                if row - checkpoint >= self._checkpoint_rows:
+                    self._sync.save_backfill_row(row, db_id)
+                    checkpoint = row
+                    self.logger.info(
+                        'Backfilled up to row %d (%d rows, %.1f rows/s)' % (
+                            row, processed,
+                            processed / max(time.time() - start, 1e-6)))
+            self._sync.save_backfill_row(row, db_id, done=True)
+        return processed, row
@@ -0,0 +1,99 @@
+import elasticsearch.helpers
+import threading
+import time
+
+from .bulk_sizer import BulkSizer
+
+
+class _PendingBulk(object):
+    """The operations of a bulk request that is being assembled."""
+    def __init__(self):
+        self.ops = []
+        self.bytes = 0
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BulkAggregator(object):
+    """
+        Combines the bulk operations of the MetadataSync instances that use
+        the same cluster into shared bulk requests, up to the limits of the
+        cluster's bulk sizer. The first operations to arrive wait for up to
+        `delay` seconds for others to join them. The request is sent as soon
+        as it reaches the limits, or once the delay expires, by one of the
+        callers whose operations it holds, and every caller receives the
+        results of its own operations.
+    """
+    def __init__(self, es_conn, sizer, delay):
+        self._es_conn = es_conn
+        self._sizer = sizer
+        self._delay = delay
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def bulk(self, ops, ops_bytes):
+        """
+            Sends the operations as part of a shared bulk request. Returns the
+            number of successful operations and the list of failures, as
+            elasticsearch.helpers.bulk() does with raise_on_error and
+            raise_on_exception unset.
+        """
+        to_send = []
+        with self._lock:
+            max_docs, max_bytes = self._sizer.limits()
+            batch = self._pending
+            if batch and (len(batch.ops) + len(ops) > max_docs or
+                          batch.bytes + ops_bytes > max_bytes):
+                # The operations do not fit: the pending request is sent
+                # as it is and they start the next one.
+                to_send.append(batch)
+                batch = None
+            leader = batch is None
+            if leader:
+                batch = _PendingBulk()
+            offset = len(batch.ops)
+            batch.ops.extend(ops)
+            batch.bytes += ops_bytes
+            if len(batch.ops) >= max_docs or batch.bytes >= max_bytes:
+                to_send.append(batch)
+                self._pending = None
+            else:
+                self._pending = batch
+        for full_batch in to_send:
+            self._send(full_batch)
+
+        if leader and not batch.done.is_set():
+            batch.done.wait(self._delay)
+            with self._lock:
+                expired = self._pending is batch
+                if expired:
+                    self._pending = None
+            if expired:
+                self._send(batch)
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        results = batch.results[offset:offset + len(ops)]
+        return (len([ok for ok, _ in results if ok]),
+                [item for ok, item in results if not ok])
+
+    def _send(self, batch):
+        start = time.time()
+        try:
+            batch.results = list(elasticsearch.helpers.streaming_bulk(
+                self._es_conn, batch.ops,
+                chunk_size=len(batch.ops),
+                max_chunk_bytes=max(batch.bytes, self._sizer.max_bytes),
+                raise_on_error=False,
+                raise_on_exception=False,
+                yield_ok=True))
+            self._sizer.record(
+                time.time() - start,
+                any(BulkSizer.is_rejected(op_info)
+                    for ok, item in batch.results if not ok
+                    for op_info in item.values()))
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
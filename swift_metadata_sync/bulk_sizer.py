@@ -0,0 +1,136 @@
+import json
+import logging
+import threading
+
+
+class BulkSizer(object):
+    """
+        Sizes the bulk requests sent to an Elasticsearch cluster. Every request
+        is limited to a number of documents and to a payload size in bytes.
+        Both limits are halved when the cluster rejects a request (HTTP 429)
+        or a request takes longer than target_latency seconds, and grow back
+        by a quarter after each request that completes within half of the
+        target latency, up to the configured maximums.
+    """
+    DEFAULT_MAX_DOCS = 500
+    DEFAULT_MIN_DOCS = 10
+    DEFAULT_MAX_BYTES = 10 * 2**20
+    DEFAULT_MIN_BYTES = 256 * 2**10
+    DEFAULT_TARGET_LATENCY = 2.0
+
+    SHRINK_FACTOR = 0.5
+    GROW_FACTOR = 1.25
+
+    REJECTED_STATUS = 429
+    REJECTED_ERROR = 'es_rejected_execution_exception'
+
+    def __init__(self, max_docs=DEFAULT_MAX_DOCS, min_docs=DEFAULT_MIN_DOCS,
+                 max_bytes=DEFAULT_MAX_BYTES, min_bytes=DEFAULT_MIN_BYTES,
+                 target_latency=DEFAULT_TARGET_LATENCY, name=None):
+        if min_docs < 1 or min_docs > max_docs:
+            raise RuntimeError(
+                'Invalid bulk document limits: {} - {}'.format(
+                    min_docs, max_docs))
+        if min_bytes < 1 or min_bytes > max_bytes:
+            raise RuntimeError(
+                'Invalid bulk byte limits: {} - {}'.format(
+                    min_bytes, max_bytes))
+        self.max_docs = max_docs
+        self.min_docs = min_docs
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.target_latency = target_latency
+        self.name = name
+        self.docs = max_docs
+        self.bytes = max_bytes
+        self.shrinks = 0
+        self.grows = 0
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def action_size(action):
+        """
+            Estimates the number of bytes the action takes up in the bulk
+            request: the action line, the source and the two newlines.
+        """
+        source = action.get('_source')
+        meta = dict((key, value) for key, value in action.items()
+                    if key != '_source')
+        size = len(json.dumps(meta)) + 1
+        if source is not None:
+            size += len(json.dumps(source)) + 1
+        return size
+
+    def chunks(self, actions):
+        """
+            Splits the actions into lists that fit the current limits. The
+            limits are read as each chunk is started, so that the feedback
+            from the previous request applies to the next one. A chunk always
+            holds at least one action, even if it is over the byte limit.
+        """
+        chunk = []
+        chunk_bytes = 0
+        max_docs, max_bytes = self.limits()
+        for action in actions:
+            size = self.action_size(action)
+            if chunk and (len(chunk) >= max_docs or
+                          chunk_bytes + size > max_bytes):
+                yield chunk, chunk_bytes
+                chunk = []
+                chunk_bytes = 0
+                max_docs, max_bytes = self.limits()
+            chunk.append(action)
+            chunk_bytes += size
+        if chunk:
+            yield chunk, chunk_bytes
+
+    def limits(self):
+        with self._lock:
+            return self.docs, self.bytes
+
+    @classmethod
+    def is_rejected(cls, op_info):
+        if op_info.get('status') == cls.REJECTED_STATUS:
+            return True
+        error = op_info.get('error')
+        return isinstance(error, dict) and\
+            error.get('type') == cls.REJECTED_ERROR
+
+    def record(self, latency, rejected):
+        """
+            Adjusts the limits after a bulk request that took latency seconds.
+            rejected is True if the cluster rejected any of its documents.
+        """
+        with self._lock:
+            old_limits = (self.docs, self.bytes)
+            if rejected or latency > self.target_latency:
+                self.docs = max(self.min_docs,
+                                int(self.docs * self.SHRINK_FACTOR))
+                self.bytes = max(self.min_bytes,
+                                 int(self.bytes * self.SHRINK_FACTOR))
+            elif latency <= self.target_latency / 2:
+                self.docs = min(self.max_docs,
+                                max(self.docs + 1,
+                                    int(self.docs * self.GROW_FACTOR)))
+                self.bytes = min(self.max_bytes,
+                                 int(self.bytes * self.GROW_FACTOR))
+            new_limits = (self.docs, self.bytes)
+            if new_limits < old_limits:
+                self.shrinks += 1
+            elif new_limits > old_limits:
+                self.grows += 1
+        if new_limits != old_limits:
+            self.logger.info(
+                'Bulk size for %s changed to %d documents, %d bytes '
+                '(latency %.3fs, rejected: %s)' % (
+                    self.name, new_limits[0], new_limits[1], latency,
+                    rejected))
+
+    def stats(self):
+        """Returns the current limits and the number of adjustments."""
+        with self._lock:
+            return {'docs': self.docs,
+                    'bytes': self.bytes,
+                    'shrinks': self.shrinks,
+                    'grows': self.grows}
@@ -0,0 +1,201 @@
+import json
+import logging
+import time
+import traceback
+
+from container_crawler.crawler import Crawler
+from swift.common.internal_client import InternalClient
+from .backfill import Backfill
+from .dead_letters import find_queues, start_dead_letter_retrier
+from .fan_out import get_targets
+from .mappings import is_per_account
+from .metadata_sync import ElasticsearchPool, MetadataSync, MetadataSyncFactory
+from .metrics import start_http_server, start_textfile_writer
+from .profiler import Profiler
+from .sync_status import get_container_broker, get_status
+
+
+def setup_logger(console=False, log_file=None, level='INFO'):
+    logger = logging.getLogger('swift-metadata-sync')
+    logger.setLevel(level)
+    formatter = logging.Formatter(
+        '[%(asctime)s] %(name)s [%(levelname)s]: %(message)s')
+    if console:
+        handler = logging.StreamHandler()
+    elif log_file:
+        handler = logging.handlers.RotatingFileHandler(log_file,
+                                                       maxBytes=100 * 2**20,
+                                                       backupCount=5)
+    else:
+        raise RuntimeError('log file must be set')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+
+# Seconds between the passes that retry the dead letters
+DEFAULT_DEAD_LETTER_RETRY_INTERVAL = 60
+
+
+def get_internal_client(conf):
+    return InternalClient(
+        conf.get('internal_client_conf_path',
+                 '/etc/swift/internal-client.conf'),
+        'Swift Metadata Sync', 3)
+
+
+def uses_dead_letters(conf):
+    return any(settings.get('dead_letter_queue', False)
+               for mapping in conf.get('containers', [])
+               for _, _, settings in get_targets(mapping))
+
+
+def dead_letters(conf, args):
+    for queue in find_queues(conf['status_dir']):
+        try:
+            identity = queue.identity
+            if identity is None:
+                continue
+            account, container, index = identity
+            if args.account and args.account.decode('utf-8') != account:
+                continue
+            if args.container and\
+                    args.container.decode('utf-8') != container:
+                continue
+            if args.replay:
+                print json.dumps({'account': account,
+                                  'container': container,
+                                  'index': index,
+                                  'replayed': queue.replay()})
+                continue
+            if args.retry:
+                continue
+            for entry in queue.list():
+                entry.update(account=account, container=container,
+                             index=index)
+                print json.dumps(entry, sort_keys=True)
+        finally:
+            queue.close()
+    if args.retry:
+        factory = MetadataSyncFactory(conf)
+        retried = factory.retry_dead_letters(
+            get_internal_client(conf),
+            account=args.account and args.account.decode('utf-8'),
+            container=args.container and args.container.decode('utf-8'))
+        print json.dumps({'retried': retried})
+
+
+def backfill(conf, args):
+    if not args.account or not args.container:
+        raise SystemExit('backfill requires --account and --container')
+    account = args.account.decode('utf-8')
+    container = args.container.decode('utf-8')
+    mappings = [mapping for mapping in conf.get('containers', [])
+                if mapping['account'] == account and
+                mapping['container'] == container]
+    if not mappings:
+        raise SystemExit('No mapping for %s/%s' % (args.account,
+                                                   args.container))
+    targets = get_targets(mappings[0])
+    if 'targets' in mappings[0]:
+        targets = [(name, target, settings)
+                   for name, target, settings in targets
+                   if args.target and name == args.target.decode('utf-8')]
+        if not targets:
+            raise SystemExit('backfill requires the --target of %s/%s' % (
+                args.account, args.container))
+    _, target, settings = targets[0]
+    broker = get_container_broker(conf, args.account, args.container)
+    if broker is None:
+        raise SystemExit('The container database of %s/%s is not on this '
+                         'node' % (args.account, args.container))
+    bulk_options = {'max_docs': args.bulk_max_docs,
+                    'max_bytes': args.bulk_max_bytes}
+    if 'bulk_target_latency' in conf:
+        bulk_options['target_latency'] = conf['bulk_target_latency']
+    es_pool = ElasticsearchPool(bulk_options=bulk_options,
+                                maxsize=args.head_concurrency)
+    settings = dict(settings, head_concurrency=args.head_concurrency)
+    sync = MetadataSync(conf['status_dir'], settings,
+                        status_backend=conf.get('status_backend', 'json'),
+                        es_pool=es_pool, engine='eventlet', target=target)
+    swift = get_internal_client(conf)
+    start = time.time()
+    try:
+        rows, last_row = Backfill(
+            sync, broker, swift, batch_size=args.batch_size,
+            checkpoint_rows=args.checkpoint_rows).run(force=args.force)
+    except RuntimeError as e:
+        raise SystemExit('Backfill of %s/%s failed: %s' % (
+            args.account, args.container, e))
+    print json.dumps({'account': account,
+                      'container': container,
+                      'index': settings['index'],
+                      'rows': rows,
+                      'last_row': last_row,
+                      'seconds': round(time.time() - start, 2)},
+                     sort_keys=True)
+
+
+def run(conf, args):
+    setup_logger(console=args.console, level=args.log_level.upper(),
+                 log_file=conf.get('log_file'))
+    factory = MetadataSyncFactory(conf)
+    if conf.get('metrics_port'):
+        start_http_server(factory.metrics, conf['metrics_port'],
+                          conf.get('metrics_host', '127.0.0.1'))
+    if conf.get('metrics_textfile'):
+        start_textfile_writer(factory.metrics, conf['metrics_textfile'],
+                              conf.get('metrics_textfile_interval', 15))
+    retry_interval = conf.get('dead_letter_retry_interval',
+                              DEFAULT_DEAD_LETTER_RETRY_INTERVAL)
+    if retry_interval and uses_dead_letters(conf):
+        start_dead_letter_retrier(factory, get_internal_client(conf),
+                                  retry_interval)
+
+    logger = logging.getLogger('swift-metadata-sync')
+    logger.info('Starting Swift Metadata Sync')
+    try:
+        conf['bulk_process'] = True
+        if args.profile:
+            factory.profiler = Profiler(
+                args.profile_dir, every=args.profile_every,
+                keep=args.profile_keep, memory=args.profile_memory,
+                per_thread=conf.get('engine', 'threads') == 'threads')
+        crawler = Crawler(conf, factory, logger)
+        if factory.profiler:
+            # run_always() calls run_once() for every cycle
+            crawler.run_once = factory.profiler.wrap_cycle(crawler.run_once)
+        if args.once:
+            crawler.run_once()
+            factory.flush()
+            logger.info('Bulk sizes: %s' % json.dumps(factory.bulk_sizes()))
+            if conf.get('metrics_textfile'):
+                factory.metrics.write_textfile(conf['metrics_textfile'])
+        else:
+            crawler.run_always()
+    except Exception as e:
+        logger.error("Metadata Sync failed: %s" % repr(e))
+        logger.error(traceback.format_exc(e))
+        exit(1)
+
+
+def main(conf, args):
+    """
+        Runs a command. The standard library has already been monkey patched
+        if the command needs it (see __main__).
+    """
+    if args.command == 'dlq':
+        dead_letters(conf, args)
+    elif args.command == 'status':
+        internal_client = None
+        if any(is_per_account(mapping)
+               for mapping in conf.get('containers', [])):
+            internal_client = get_internal_client(conf)
+        print json.dumps(get_status(conf, internal_client=internal_client),
+                         indent=4, sort_keys=True)
+    elif args.command == 'backfill':
+        setup_logger(console=args.console, level=args.log_level.upper(),
+                     log_file=conf.get('log_file'))
+        backfill(conf, args)
+    else:
+        run(conf, args)
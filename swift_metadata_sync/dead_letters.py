@@ -0,0 +1,202 @@
+import errno
+import json
+import logging
+import os
+import os.path
+import random
+import sqlite3
+import threading
+import time
+
+
+class DeadLetterQueue(object):
+    """
+        On-disk queue of the container rows that could not be indexed, along
+        with the last error for each one. A queued row is retried once its
+        backoff expires; the backoff doubles with every failed attempt, up to
+        max_backoff seconds. The queue is bound to an Elasticsearch index and
+        is cleared if the index changes.
+    """
+    SUFFIX = '.dead_letters'
+
+    def __init__(self, path, backoff=60, max_backoff=3600):
+        self._path = path
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._conn = None
+        self._identity = None
+
+    def _connect(self):
+        if self._conn:
+            return self._conn
+        try:
+            os.makedirs(os.path.dirname(self._path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS identity '
+                '(account TEXT NOT NULL, container TEXT NOT NULL, '
+                'es_index TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS dead_letters '
+                '(doc_id TEXT PRIMARY KEY, row TEXT NOT NULL, '
+                'error TEXT NOT NULL, attempts INTEGER NOT NULL, '
+                'failed_at REAL NOT NULL, retry_at REAL NOT NULL)')
+        return self._conn
+
+    def open(self, account, container, index):
+        if self._identity == (account, container, index):
+            return
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                'SELECT account, container, es_index FROM identity'
+            ).fetchone()
+            if row is None or tuple(row) != (account, container, index):
+                conn.execute('DELETE FROM dead_letters')
+                conn.execute('DELETE FROM identity')
+                conn.execute('INSERT INTO identity VALUES (?, ?, ?)',
+                             (account, container, index))
+        self._identity = (account, container, index)
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+        self._identity = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def identity(self):
+        """Returns the (account, container, index) of the queue, if any."""
+        row = self._connect().execute(
+            'SELECT account, container, es_index FROM identity').fetchone()
+        return tuple(row) if row else None
+
+    def _get_retry_at(self, attempts, now):
+        delay = min(self._max_backoff, self._backoff * 2 ** (attempts - 1))
+        return now + random.uniform(delay / 2.0, delay)
+
+    def add(self, failures, now=None):
+        """
+            Queues the (document ID, row, error) triples. A row that is
+            already queued has its attempts incremented; any other row
+            replaces the queued entry for the document.
+        """
+        if now is None:
+            now = time.time()
+        with self._conn:
+            for doc_id, row, error in failures:
+                row = json.dumps(row, sort_keys=True)
+                entry = self._conn.execute(
+                    'SELECT row, attempts, failed_at FROM dead_letters '
+                    'WHERE doc_id = ?', (doc_id,)).fetchone()
+                attempts, failed_at = 1, now
+                if entry and entry[0] == row:
+                    attempts, failed_at = entry[1] + 1, entry[2]
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO dead_letters '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (doc_id, row, str(error), attempts, failed_at,
+                     self._get_retry_at(attempts, now)))
+
+    def remove(self, doc_ids):
+        with self._conn:
+            self._conn.executemany(
+                'DELETE FROM dead_letters WHERE doc_id = ?',
+                [(doc_id,) for doc_id in doc_ids])
+
+    def is_empty(self):
+        return self._connect().execute(
+            'SELECT 1 FROM dead_letters LIMIT 1').fetchone() is None
+
+    def has_due(self, now=None):
+        """Returns True if the backoff of any queued row has expired."""
+        if now is None:
+            now = time.time()
+        return self._connect().execute(
+            'SELECT 1 FROM dead_letters WHERE retry_at <= ? LIMIT 1',
+            (now,)).fetchone() is not None
+
+    @staticmethod
+    def _load_row(row):
+        # The container database rows hold UTF-8 encoded strings
+        return dict((key, value.encode('utf-8')
+                     if isinstance(value, unicode) else value)
+                    for key, value in json.loads(row).items())
+
+    def get_due(self, limit, now=None):
+        """
+            Returns up to limit (document ID, row) pairs whose backoff has
+            expired, the longest waiting ones first.
+        """
+        if now is None:
+            now = time.time()
+        return [(doc_id, self._load_row(row)) for doc_id, row in
+                self._conn.execute(
+                    'SELECT doc_id, row FROM dead_letters '
+                    'WHERE retry_at <= ? ORDER BY retry_at LIMIT ?',
+                    (now, limit)).fetchall()]
+
+    def list(self):
+        """Returns all of the queued entries as dictionaries."""
+        return [{'doc_id': doc_id,
+                 'row': self._load_row(row),
+                 'error': error,
+                 'attempts': attempts,
+                 'failed_at': failed_at,
+                 'retry_at': retry_at}
+                for doc_id, row, error, attempts, failed_at, retry_at in
+                self._connect().execute(
+                    'SELECT doc_id, row, error, attempts, failed_at, '
+                    'retry_at FROM dead_letters ORDER BY failed_at')]
+
+    def replay(self, doc_ids=None):
+        """
+            Makes the given queued documents (or all of them) due for a retry
+            on the next pass. Returns the number of affected entries.
+        """
+        conn = self._connect()
+        with conn:
+            if doc_ids is None:
+                return conn.execute(
+                    'UPDATE dead_letters SET retry_at = 0').rowcount
+            return sum(conn.execute(
+                'UPDATE dead_letters SET retry_at = 0 WHERE doc_id = ?',
+                (doc_id,)).rowcount for doc_id in doc_ids)
+
+
+def find_queues(status_dir):
+    """Yields the dead letter queues found under the status directory."""
+    for root, _, files in os.walk(status_dir):
+        for name in sorted(files):
+            if name.endswith(DeadLetterQueue.SUFFIX):
+                yield DeadLetterQueue(os.path.join(root, name))
+
+
+def start_dead_letter_retrier(factory, internal_client, interval):
+    """
+        Retries the due rows of the dead letter queues every interval seconds
+        from a daemon thread, apart from the crawler, so that the rows of idle
+        containers are retried too.
+    """
+    logger = logging.getLogger('swift-metadata-sync')
+
+    def _retry_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                factory.retry_dead_letters(internal_client)
+            except Exception as e:
+                logger.error('Failed to retry the dead letters: %s' % repr(e))
+
+    thread = threading.Thread(target=_retry_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,144 @@
+import logging
+
+from container_crawler.base_sync import BaseSync
+
+
+def get_targets(settings):
+    """
+        Returns the (name, target, settings) of every target of a mapping. The
+        settings of a target are those of the mapping, overridden by the
+        target's own (e.g. es_hosts, index, and pipeline). A target is named
+        by its "name" setting, or else by its index.
+
+        The `target` is what distinguishes the progress and the state files of
+        the target (see MetadataSync). It is None for the first target, so
+        that the first target keeps the progress that the mapping had before
+        it listed any targets. A mapping without targets is its own (only)
+        target.
+    """
+    if 'targets' not in settings:
+        return [(settings['index'], None, settings)]
+    mapping_settings = dict((key, value) for key, value in settings.items()
+                            if key != 'targets')
+    targets = []
+    names = set()
+    for target in settings['targets']:
+        target_settings = dict(mapping_settings)
+        target_settings.update(target)
+        for key in ('es_hosts', 'index'):
+            if key not in target_settings:
+                raise RuntimeError(
+                    'A target of {}/{} is missing "{}"'.format(
+                        settings['account'], settings['container'], key))
+        name = target_settings.pop('name', target_settings['index'])
+        if name in names:
+            raise RuntimeError('Duplicate target of {}/{}: {}'.format(
+                settings['account'], settings['container'], name))
+        names.add(name)
+        targets.append((name, name if targets else None, target_settings))
+    if not targets:
+        raise RuntimeError('The mapping of {}/{} has no targets'.format(
+            settings['account'], settings['container']))
+    return targets
+
+
+class SharedMetadata(object):
+    """
+        Stands in for the internal client while the targets of a mapping
+        handle a batch of rows. The object metadata and the documents built
+        from it are kept for the batch, so that every object is retrieved
+        (and its document built) once, whatever the number of targets.
+    """
+    def __init__(self, internal_client):
+        self._client = internal_client
+        self._metadata = {}
+        self._docs = {}
+
+    def get_object_metadata(self, account, container, obj, headers=None):
+        key = (account, container, obj,
+               tuple(sorted((headers or {}).items())))
+        if key not in self._metadata:
+            self._metadata[key] = self._client.get_object_metadata(
+                account, container, obj, headers=headers)
+        return self._metadata[key]
+
+    def get_es_doc(self, key, build_doc):
+        """Returns the document for the key, building it on first use."""
+        if key not in self._docs:
+            self._docs[key] = build_doc()
+        return self._docs[key]
+
+
+class FanOutSync(BaseSync):
+    """
+        Indexes a container into several targets (Elasticsearch clusters or
+        indexes), with a MetadataSync instance for each. Every target keeps
+        its own progress: the crawler is handed the progress of the target
+        that is furthest behind, and every target skips the rows that it has
+        already verified. The targets handle a batch of rows in turn and
+        share the object metadata and documents (see SharedMetadata).
+
+        If any target fails, the error is raised once the other targets have
+        handled the rows, and the crawler retries the batch.
+    """
+    def __init__(self, status_dir, settings, syncs, per_account=False):
+        super(FanOutSync, self).__init__(status_dir, settings, per_account)
+        self.logger = logging.getLogger('swift-metadata-sync')
+        # (name, MetadataSync) of every target
+        self._syncs = syncs
+        self._db_id = None
+        self._processed_rows = [0] * len(syncs)
+        self._verified_rows = [0] * len(syncs)
+
+    def get_last_processed_row(self, db_id):
+        if db_id != self._db_id:
+            self._db_id = db_id
+            self._verified_rows = [0] * len(self._syncs)
+        self._processed_rows = [sync.get_last_processed_row(db_id)
+                                for _, sync in self._syncs]
+        return min(self._processed_rows)
+
+    def get_last_verified_row(self, db_id):
+        verified_rows = [sync.get_last_verified_row(db_id)
+                         for _, sync in self._syncs]
+        if db_id == self._db_id:
+            self._verified_rows = verified_rows
+        return min(verified_rows)
+
+    def _save_rows(self, row_id, db_id, known_rows, method):
+        for i, (_, sync) in enumerate(self._syncs):
+            if db_id == self._db_id:
+                if row_id <= known_rows[i]:
+                    # The target is ahead of the others
+                    continue
+                known_rows[i] = row_id
+            getattr(sync, method)(row_id, db_id)
+
+    def save_last_processed_row(self, row_id, db_id):
+        self._save_rows(row_id, db_id, self._processed_rows,
+                        'save_last_processed_row')
+
+    def save_last_verified_row(self, row_id, db_id):
+        self._save_rows(row_id, db_id, self._verified_rows,
+                        'save_last_verified_row')
+
+    def handle(self, rows, internal_client):
+        shared = SharedMetadata(internal_client)
+        failed = []
+        for (name, sync), verified_row in zip(self._syncs,
+                                              self._verified_rows):
+            target_rows = [row for row in rows
+                           if row.get('ROWID', verified_row + 1) >
+                           verified_row]
+            if not target_rows:
+                continue
+            try:
+                sync.handle(target_rows, shared)
+            except Exception as e:
+                self.logger.error(
+                    'Target %s of %s/%s failed: %s' % (
+                        name, self._account, self._container, repr(e)))
+                failed.append(name)
+        if failed:
+            raise RuntimeError('Failed to handle the rows for targets: %s' %
+                               ', '.join(failed))
@@ -0,0 +1,25 @@
+# The container of a mapping that covers every container of its account. The
+# crawler syncs each of them with the mapping's settings and a status file per
+# account.
+ALL_CONTAINERS = '/*'
+
+
+def is_per_account(mapping):
+    return mapping['container'] == ALL_CONTAINERS
+
+
+def find_mappings(conf, account, container):
+    """
+        Returns the (settings, per_account) of the configured mappings that
+        cover the container. The settings of a per-account mapping are those
+        that the crawler hands the container.
+    """
+    mappings = []
+    for mapping in conf.get('containers', []):
+        if mapping['account'] != account:
+            continue
+        if is_per_account(mapping):
+            mappings.append((dict(mapping, container=container), True))
+        elif mapping['container'] == container:
+            mappings.append((mapping, False))
+    return mappings
@@ -1,18 +1,46 @@
+import atexit
+import collections
 from distutils.version import StrictVersion
 import elasticsearch
 import elasticsearch.helpers
 import email.utils
+import eventlet
+import functools
 import hashlib
 import json
 import logging
+import math
 import os
 import os.path
+import random
+import threading
+import time
 
-from swift.common.utils import decode_timestamps
+from swift.common.internal_client import UnexpectedResponse
+from swift.common.utils import (
+    decode_timestamps, extract_swift_bytes, parse_content_type)
 from container_crawler.base_sync import BaseSync
+from .backfill import BackfillLock
+from .bulk_aggregator import BulkAggregator
+from .bulk_sizer import BulkSizer
+from .dead_letters import DeadLetterQueue, find_queues
+from .fan_out import FanOutSync, SharedMetadata, get_targets
+from .mappings import find_mappings
+from .metrics import Metrics
+from .stages import StageTimings
+from .tracing import Tracer
+from .status import CheckpointCache, STATUS_BACKENDS, SyncProgress
+from .timestamp_index import TimestampIndex
 
+# The threads engine blocks the crawler's worker threads on every request. The
+# eventlet engine monkey patches the standard library (see __main__), so that
+# the workers and the HEAD and bulk requests run on green threads.
+ENGINES = ('threads', 'eventlet')
+# Connections to each Elasticsearch node; None keeps the client's default (10)
+DEFAULT_ES_CONNECTIONS = {'threads': None, 'eventlet': 128}
 
-class MetadataSync(BaseSync):
+
+class MetadataSync(SyncProgress, BaseSync):
     OLD_DOC_TYPE = 'object'
     DEFAULT_DOC_TYPE = '_doc'
     DOC_MAPPING = {
@@ -29,137 +57,504 @@ class MetadataSync(BaseSync):
         "x-trans-id": {"type": "string", "index": "not_analyzed"}
     }
     USER_META_PREFIX = 'x-object-meta-'
+    # Bulk errors that indicate the index mapping may have changed
+    MAPPING_ERRORS = ('illegal_argument_exception',
+                      'index_not_found_exception',
+                      'mapper_parsing_exception',
+                      'strict_dynamic_mapping_exception',
+                      'type_missing_exception')
+
+    # Weight of the latest processing rate in its moving average
+    RATE_SMOOTHING = 0.3
+
+    # The eventlet engine multiplexes the requests of all the workers on green
+    # threads, so that many more of them can be in flight.
+    DEFAULT_HEAD_CONCURRENCY = {'threads': 1, 'eventlet': 64}
+    DEFAULT_BULK_CONCURRENCY = 4
+
+    # Bulk failures that are retried: throttling, unavailable shards, and
+    # proxy errors and timeouts.
+    TRANSIENT_STATUSES = (429, 502, 503, 504)
+    DEFAULT_RETRY_ATTEMPTS = 3
+    DEFAULT_RETRY_BACKOFF = 0.5
+    DEFAULT_RETRY_MAX_BACKOFF = 10
+
+    DEFAULT_DEAD_LETTER_BACKOFF = 60
+    DEFAULT_DEAD_LETTER_MAX_BACKOFF = 3600
+    DEFAULT_DEAD_LETTER_BATCH = 100
 
-    PROCESSED_ROW = 'last_row'
-    VERIFIED_ROW = 'last_verified_row'
+    # Documents looked up by each search of the fast verification, which is
+    # bounded by the index's max_result_window (10000 by default)
+    VERIFY_SEARCH_SIZE = 1000
 
-    def __init__(self, status_dir, settings, per_account=False):
+    def __init__(self, status_dir, settings, per_account=False,
+                 status_backend='json', checkpoint_cache=None, es_pool=None,
+                 engine='threads', metrics=None, profiler=None,
+                 stage_hooks=None, target=None):
         super(MetadataSync, self).__init__(status_dir, settings, per_account)
+        # The name of the target of a mapping with several targets (see
+        # FanOutSync), which keeps its progress and state files apart
+        self._target = target
 
         self.logger = logging.getLogger('swift-metadata-sync')
-        es_hosts = settings['es_hosts']
-        kwargs = {}
-        if 'ca_certs' in settings:
-            kwargs['ca_certs'] = settings['ca_certs']
-        if 'verify_certs' in settings:
-            kwargs['verify_certs'] = settings['verify_certs']
-        self._es_conn = elasticsearch.Elasticsearch(es_hosts, **kwargs)
-        self._server_version = StrictVersion(
-            self._es_conn.info()['version']['number'])
+        # Debug output of the rows and requests, for a sample of containers
+        self._tracer = Tracer(self._account, self._container,
+                              float(settings.get('trace_sample_rate', 1)))
+        if es_pool is None:
+            es_pool = ElasticsearchPool()
+        self._es_pool = es_pool
+        self._es_conn, self._server_version = es_pool.get(settings)
+        self._bulk_sizer = es_pool.get_bulk_sizer(settings)
+        # Combines our bulk requests with those of the other containers
+        self._bulk_aggregator = es_pool.get_bulk_aggregator(settings)
         self._index = settings['index']
+        self._metrics = metrics or Metrics()
+        self._metric_labels = {'account': self._account,
+                               'container': self._container,
+                               'index': self._index}
         self._parse_json = settings.get('parse_json', False)
         self._pipeline = settings.get('pipeline')
-        self._verify_mapping()
+        if engine not in ENGINES:
+            raise RuntimeError('Unknown engine: {}'.format(engine))
+        self._engine = engine
+        self._profiler = profiler
+        # Called with the metric labels and the StageTimings of every batch
+        self._stage_hooks = stage_hooks or []
+        self._stages = StageTimings()
+        self._head_concurrency = int(settings.get(
+            'head_concurrency', self.DEFAULT_HEAD_CONCURRENCY[engine]))
+        if self._head_concurrency < 1:
+            raise RuntimeError(
+                'head_concurrency must be a positive integer: {}'.format(
+                    self._head_concurrency))
+        # Concurrent bulk requests are only useful with green sockets
+        self._bulk_concurrency = 1
+        if engine == 'eventlet':
+            self._bulk_concurrency = int(settings.get(
+                'bulk_concurrency', self.DEFAULT_BULK_CONCURRENCY))
+            if self._bulk_concurrency < 1:
+                raise RuntimeError(
+                    'bulk_concurrency must be a positive integer: {}'.format(
+                        self._bulk_concurrency))
+        self._adaptive_newest = settings.get('adaptive_newest', False)
+        # Counts the object HEAD requests: "head" for the plain requests and
+        # "newest_fallback" for the X-Newest retries in the adaptive mode.
+        self.head_stats = collections.Counter()
+        self._row_only = settings.get('row_only', False)
+        self._external_versioning = settings.get('external_versioning', False)
+        self._fast_verify = settings.get('fast_verify', False)
+        if self._fast_verify and\
+                self._server_version < StrictVersion('5.0'):
+            raise RuntimeError(
+                'fast_verify requires Elasticsearch 5.0 or later')
+        self._retry_attempts = int(settings.get(
+            'retry_attempts', self.DEFAULT_RETRY_ATTEMPTS))
+        self._retry_backoff = float(settings.get(
+            'retry_backoff', self.DEFAULT_RETRY_BACKOFF))
+        self._retry_max_backoff = float(settings.get(
+            'retry_max_backoff', self.DEFAULT_RETRY_MAX_BACKOFF))
+        self._dead_letters = None
+        if settings.get('dead_letter_queue', False):
+            self._dead_letters = DeadLetterQueue(
+                self._get_state_path(DeadLetterQueue.SUFFIX),
+                backoff=settings.get(
+                    'dead_letter_backoff', self.DEFAULT_DEAD_LETTER_BACKOFF),
+                max_backoff=settings.get(
+                    'dead_letter_max_backoff',
+                    self.DEFAULT_DEAD_LETTER_MAX_BACKOFF))
+        self._dead_letter_batch = int(settings.get(
+            'dead_letter_batch', self.DEFAULT_DEAD_LETTER_BATCH))
+        self._timestamp_index = None
+        if settings.get('local_timestamp_index', False):
+            self._timestamp_index = TimestampIndex(
+                self._get_state_path('.timestamps'))
+        # The database ID and the last processed row are recorded when the
+        # crawler retrieves the status, before handing us the rows.
+        self._db_id = None
+        self._last_processed_row = None
+        # Time spent handling the rows past the last processed row since it
+        # was saved, over which the processing rate is measured
+        self._active_seconds = 0
+        self._status_store = self._get_status_store(status_dir, status_backend)
+        self._backfill_lock_path = self._get_state_path(BackfillLock.SUFFIX)
+        if checkpoint_cache:
+            self._status_store = checkpoint_cache.wrap(self._status_store)
+        self._doc_type = None
+        # Set when a bulk request fails on the mapping, so that the mapping
+        # is verified again before the next batch. The doc type is left
+        # alone, as the operations of the current batch still use it.
+        self._mapping_stale = False
+        self._ensure_mapping()
 
-    def _get_row(self, row_field, db_id):
-        if not os.path.exists(self._status_file):
-            return 0
-        with open(self._status_file) as f:
-            try:
-                status = json.load(f)
-                entry = status.get(db_id, None)
-                if not entry:
-                    return 0
-                if entry['index'] == self._index:
-                    try:
-                        return entry[row_field]
-                    except KeyError:
-                        if row_field == self.VERIFIED_ROW:
-                            return entry.get(self.PROCESSED_ROW, 0)
-                return 0
-            except ValueError:
-                return 0
-
-    def _save_row(self, row_id, row_field, db_id):
-        if not os.path.exists(self._status_account_dir):
-            os.mkdir(self._status_account_dir)
-        if not os.path.exists(self._status_file):
-            new_rows = {self.PROCESSED_ROW: 0,
-                        self.VERIFIED_ROW: 0,
-                        'index': self._index}
-            new_rows[row_field] = row_id
-            with open(self._status_file, 'w') as f:
-                json.dump({db_id: new_rows}, f)
-                return
-
-        with open(self._status_file, 'r+') as f:
-            try:
-                status = json.load(f)
-            except ValueError:
-                status = {}
-            new_rows = {'index': self._index,
-                        self.PROCESSED_ROW: 0,
-                        self.VERIFIED_ROW: 0}
-            if db_id in status:
-                old_processed_row = status[db_id][self.PROCESSED_ROW]
-                new_rows[self.PROCESSED_ROW] = old_processed_row
-                new_rows[self.VERIFIED_ROW] =\
-                    status[db_id].get(self.VERIFIED_ROW, old_processed_row)
-            new_rows[row_field] = row_id
-
-            status[db_id] = new_rows
-            f.seek(0)
-            json.dump(status, f)
-            f.truncate()
+    def _get_state_path(self, suffix):
+        """
+            Returns the path of a per-container state file, which is kept next
+            to the status file.
+        """
+        container_hash = hashlib.sha1('/'.join(
+            [self._account.encode('utf-8'),
+             self._container.encode('utf-8')])).hexdigest()
+        if self._target:
+            container_hash += '-' + hashlib.sha1(
+                self._target.encode('utf-8')).hexdigest()
+        return os.path.join(os.path.dirname(self._status_file),
+                            '.%s%s' % (container_hash, suffix))
 
-    def get_last_processed_row(self, db_id):
-        return self._get_row(self.PROCESSED_ROW, db_id)
+    def _update_entry(self, entry, row_id, row_field, active_seconds=0):
+        new_rows = {'index': self._index,
+                    self.PROCESSED_ROW: 0,
+                    self.VERIFIED_ROW: 0}
+        if entry:
+            old_processed_row = entry[self.PROCESSED_ROW]
+            new_rows[self.PROCESSED_ROW] = old_processed_row
+            new_rows[self.VERIFIED_ROW] =\
+                entry.get(self.VERIFIED_ROW, old_processed_row)
+            for field in (self.PROCESSED_TIME, self.PROCESSED_RATE):
+                if field in entry:
+                    new_rows[field] = entry[field]
+        new_rows[row_field] = row_id
+        if row_field == self.PROCESSED_ROW:
+            self._update_rate(new_rows, entry, row_id, active_seconds)
+        return new_rows
+
+    def _save_row(self, row_id, row_field, db_id, active_seconds=0):
+        self._status_store.update(
+            self._get_status_key(db_id),
+            lambda entry: self._update_entry(
+                entry, row_id, row_field, active_seconds))
 
-    def get_last_verified_row(self, db_id):
-        return self._get_row(self.VERIFIED_ROW, db_id)
+    def _update_rate(self, new_rows, entry, row_id, active_seconds):
+        """
+            Records the time of the processed row update and the rate at which
+            the rows are processed, as a moving average. The rate is used to
+            estimate how long it takes to catch up with a container, so it is
+            measured over the time spent handling the new rows rather than the
+            time since the last update, which includes the idle time between
+            the crawler's passes.
+        """
+        new_rows[self.PROCESSED_TIME] = time.time()
+        if not entry or row_id < entry[self.PROCESSED_ROW]:
+            new_rows.pop(self.PROCESSED_RATE, None)
+            return
+        if active_seconds <= 0:
+            return
+        rate = (row_id - entry[self.PROCESSED_ROW]) / active_seconds
+        if self.PROCESSED_RATE in entry:
+            rate = self.RATE_SMOOTHING * rate +\
+                (1 - self.RATE_SMOOTHING) * entry[self.PROCESSED_RATE]
+        new_rows[self.PROCESSED_RATE] = rate
+
+    def get_last_processed_row(self, db_id):
+        self._db_id = db_id
+        self._last_processed_row = super(
+            MetadataSync, self).get_last_processed_row(db_id)
+        return self._last_processed_row
 
     def save_last_processed_row(self, row_id, db_id):
-        return self._save_row(row_id, self.PROCESSED_ROW, db_id)
+        if db_id == self._db_id:
+            self._last_processed_row = row_id
+        active_seconds, self._active_seconds = self._active_seconds, 0
+        self._save_row(row_id, self.PROCESSED_ROW, db_id, active_seconds)
 
     def save_last_verified_row(self, row_id, db_id):
         return self._save_row(row_id, self.VERIFIED_ROW, db_id)
 
+    def save_backfill_row(self, row_id, db_id, done=False):
+        """
+            Records the row that a backfill reached as both the last processed
+            and the last verified row, as every row up to it has been indexed.
+            Until the backfill is done, the entry is also marked as a backfill.
+            Any other update of the entry clears the mark.
+        """
+        active_seconds, self._active_seconds = self._active_seconds, 0
+
+        def _update_entry(entry):
+            new_rows = self._update_entry(
+                entry, row_id, self.PROCESSED_ROW, active_seconds)
+            new_rows[self.VERIFIED_ROW] = row_id
+            if not done:
+                new_rows[self.BACKFILL] = True
+            return new_rows
+
+        if db_id == self._db_id:
+            self._last_processed_row = row_id
+        self._status_store.update(self._get_status_key(db_id), _update_entry)
+
+    def backfill_lock(self):
+        return BackfillLock(self._backfill_lock_path)
+
+    def count_documents(self):
+        return self._es_conn.count(index=self._index)['count']
+
+    def _ensure_mapping(self):
+        doc_type = self._es_pool.get_doc_type(self._es_conn, self._index)
+        if doc_type is None:
+            self._verify_mapping()
+            self._es_pool.set_doc_type(
+                self._es_conn, self._index, self._doc_type)
+        else:
+            self._doc_type = doc_type
+        self._mapping_stale = False
+
+    def _check_mapping_error(self, op_info):
+        error = op_info.get('error')
+        if isinstance(error, dict) and\
+                error.get('type') in self.MAPPING_ERRORS:
+            # Verify the mapping again before the next batch
+            self._es_pool.invalidate_doc_type(self._es_conn, self._index)
+            self._mapping_stale = True
+
     def handle(self, rows, internal_client):
-        self.logger.debug("Handling rows: %s" % repr(rows))
+        if BackfillLock.is_held(self._backfill_lock_path):
+            # The rows are handled once the backfill hands off to us
+            raise RuntimeError('Backfill of %s/%s is in progress' % (
+                self._account, self._container))
+        if self._profiler:
+            return self._profiler.runcall(self._handle, rows, internal_client)
+        return self._handle(rows, internal_client)
+
+    def backfill(self, rows, internal_client):
+        """
+            Handles the rows of a backfill. The index is known to be empty, so
+            the documents are written without looking up the indexed ones.
+        """
+        return self._handle(rows, internal_client, lookup=False)
+
+    def _handle(self, rows, internal_client, lookup=True):
+        self._tracer.trace('handle', rows=rows)
         if not rows:
             return []
-        errors = []
+        if self._doc_type is None or self._mapping_stale:
+            self._ensure_mapping()
+        self._metrics.inc('rows_total', self._metric_labels, len(rows))
+        self._stages = StageTimings()
+        start = time.time()
+        try:
+            errors = self._process_rows(rows, internal_client, lookup)
 
-        bulk_delete_ops = []
-        mget_map = {}
-        for row in rows:
-            op = {'_op_type': 'delete',
-                  '_id': self._get_document_id(row),
-                  '_index': self._index}
-            if self._server_version < StrictVersion('7.0'):
-                op['_type'] = self._doc_type
-            if row['deleted']:
-                bulk_delete_ops.append(op)
+            if self._dead_letters is not None:
+                if self._has_dead_letters():
+                    # Newer rows supersede any queued rows for the same
+                    # objects
+                    self._dead_letters.remove(
+                        [self._get_document_id(row) for row in rows])
+                errors = self._queue_dead_letters(rows, errors)
+        except Exception as e:
+            # The HEAD, mget, and transport errors fail the whole batch
+            self._count_error(type(e).__name__)
+            raise
+        finally:
+            if not self._is_verified_row(rows[-1]):
+                self._active_seconds += time.time() - start
+            self._report_stages()
+        self._check_errors([error for _, error in errors])
+
+    def _report_stages(self):
+        """Records the stage timings of the batch and passes them on."""
+        for stage, entry in self._stages.items():
+            if not entry['items']:
                 continue
-            mget_map[self._get_document_id(row)] = row
+            labels = dict(self._metric_labels, stage=stage)
+            self._metrics.observe('stage_seconds', labels, entry['seconds'])
+            self._metrics.inc('stage_items_total', labels, entry['items'])
+            self._metrics.inc('stage_bytes_total', labels, entry['bytes'])
+        self._tracer.trace('stages', stages=self._stages)
+        for hook in self._stage_hooks:
+            try:
+                hook(self._metric_labels, self._stages)
+            except Exception as e:
+                self.logger.error("Stage hook failed: %s" % repr(e))
+
+    def _process_rows(self, rows, internal_client, lookup=True):
+        """
+            Index or delete the documents for the rows. Returns a list of
+            (document ID, error) pairs for the operations that failed. The
+            document ID is None if the error is not specific to a document or
+            is transient. Without the `lookup`, every row is treated as stale.
+        """
+        errors = []
+        bulk_delete_ops = []
+        mget_map = collections.OrderedDict()
+        verified = {}
+        if lookup and self._fast_verify:
+            verified = self._get_verified_timestamps(rows)
+        with self._stages.timer('build_deletes', len(rows)):
+            for row in rows:
+                op = {'_op_type': 'delete',
+                      '_id': self._get_document_id(row),
+                      '_index': self._index}
+                if self._server_version < StrictVersion('7.0'):
+                    op['_type'] = self._doc_type
+                if self._external_versioning:
+                    op['version'] = self._get_es_timestamp(row)
+                    op['version_type'] = 'external'
+                if row['deleted']:
+                    if op['_id'] in verified and verified[op['_id']] is None:
+                        # The document has already been deleted
+                        continue
+                    bulk_delete_ops.append(op)
+                    continue
+                mget_map[self._get_document_id(row)] = row
 
         if bulk_delete_ops:
+            self._metrics.inc('deletes_total', self._metric_labels,
+                              len(bulk_delete_ops))
             errors = self._bulk_delete(bulk_delete_ops)
+            if self._open_timestamp_index():
+                # Any subsequent lookup falls through to Elasticsearch
+                self._timestamp_index.remove(
+                    [delete_op['_id'] for delete_op in bulk_delete_ops])
         if not mget_map:
-            self._check_errors(errors)
-            return
+            return errors
 
-        self.logger.debug("multiple get map: %s" % repr(mget_map))
-        stale_rows, mget_errors = self._get_stale_rows(mget_map)
-        errors += mget_errors
-        update_ops = [self._create_index_op(doc_id, row, internal_client)
-                      for doc_id, row in stale_rows]
-        _, update_failures = elasticsearch.helpers.bulk(
-            self._es_conn,
-            update_ops,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
-        self.logger.debug("Index operations: %s" % repr(update_ops))
+        if self._external_versioning or not lookup:
+            # Elasticsearch rejects the out of date documents based on their
+            # version (or a backfilled index has no documents to begin with),
+            # so there is no need to look up the indexed timestamps.
+            stale_rows = mget_map.items()
+        else:
+            self._tracer.trace('mget', mget_map=mget_map)
+            with self._stages.timer('get_stale_rows', len(mget_map)):
+                stale_rows, mget_errors = self._get_stale_rows(
+                    mget_map, verified)
+            errors += mget_errors
+        # The index operations are generated as the bulk requests are sent,
+        # so that at most one chunk of documents is held in memory.
+        indexed_docs = []
+
+        def _record_ops(ops):
+            for op in ops:
+                indexed_docs.append((op['_id'], op['_source']['x-timestamp']))
+                yield op
+
+        head_errors = []
+        index_ops = self._create_index_ops(
+            stale_rows, internal_client, head_errors)
+        try:
+            _, update_failures = self._bulk(_record_ops(index_ops),
+                                            'bulk_index')
+        finally:
+            # Stops the HEAD requests of any rows that the bulk requests did
+            # not get to
+            index_ops.close()
+        errors += head_errors
+        self._tracer.trace('indexed', documents=len(indexed_docs))
+        if self._adaptive_newest:
+            self._tracer.trace(
+                'adaptive_newest', heads=self.head_stats['head'],
+                newest_fallbacks=self.head_stats['newest_fallback'])
 
+        failed_ids = set()
         for op in update_failures:
             op_info = op['index']
-            if 'exception' in op_info:
-                errors.append(op_info['exception'])
-            else:
-                errors.append("%s: %s" % (
-                    op_info['_id'], self._extract_error(op_info)))
-        self._check_errors(errors)
+            if self._is_version_conflict(op_info):
+                continue
+            failed_ids.add(op_info.get('_id'))
+            self._check_mapping_error(op_info)
+            errors.append(self._get_failure(op_info))
+        if self._open_timestamp_index():
+            self._timestamp_index.update(
+                [(doc_id, timestamp) for doc_id, timestamp in indexed_docs
+                 if doc_id not in failed_ids])
+        return errors
+
+    def _get_failure(self, op_info):
+        """Returns the (document ID, error) pair for a failed operation."""
+        self._count_error(self._get_error_type(op_info))
+        doc_id = op_info.get('_id')
+        if self._is_transient_error(op_info):
+            # Retrying the whole batch later is preferable to queueing it
+            doc_id = None
+        if 'exception' in op_info:
+            return doc_id, op_info['exception']
+        return doc_id, "%s: %s" % (op_info['_id'],
+                                   self._extract_error(op_info))
+
+    @staticmethod
+    def _get_error_type(op_info):
+        error = op_info.get('error')
+        if isinstance(error, dict) and 'type' in error:
+            return error['type']
+        if 'exception' in op_info:
+            return type(op_info['exception']).__name__
+        return 'status_%s' % op_info.get('status')
+
+    def _count_error(self, error_type):
+        self._metrics.inc('errors_total',
+                          dict(self._metric_labels, type=error_type))
+
+    def _queue_dead_letters(self, rows, errors):
+        """
+            Queue the rows whose documents failed and return the remaining
+            errors, which are not specific to a row.
+        """
+        row_map = dict((self._get_document_id(row), row) for row in rows)
+        failures = [(doc_id, row_map[doc_id], error)
+                    for doc_id, error in errors if doc_id in row_map]
+        if failures:
+            self._open_dead_letters()
+            self._dead_letters.add(failures)
+            for doc_id, row, error in failures:
+                self.logger.warning(
+                    "Queued row %s of %s/%s for a retry: %s" % (
+                        row['ROWID'] if 'ROWID' in row else row['name'],
+                        self._account, self._container, error))
+        return [(doc_id, error) for doc_id, error in errors
+                if doc_id not in row_map]
+
+    def retry_dead_letters(self, internal_client):
+        """
+            Retries the queued rows whose backoff has expired, in batches of
+            dead_letter_batch rows, independently of the rows handed over by
+            the crawler. Any errors are recorded in the queue rather than
+            raised. Returns the number of rows retried.
+        """
+        if self._dead_letters is None or\
+                not os.path.exists(self._dead_letters.path):
+            return 0
+        self._open_dead_letters()
+        retried = 0
+        try:
+            while True:
+                count = self._drain_dead_letters(internal_client)
+                retried += count
+                # The rows that fail again are due after their backoff
+                if count < self._dead_letter_batch:
+                    return retried
+        finally:
+            self._dead_letters.close()
+
+    def _drain_dead_letters(self, internal_client):
+        """
+            Retry a batch of the queued rows whose backoff has expired and
+            return the number of rows retried.
+        """
+        due = self._dead_letters.get_due(self._dead_letter_batch)
+        if not due:
+            return 0
+        if self._doc_type is None or self._mapping_stale:
+            self._ensure_mapping()
+        rows = [row for _, row in due]
+        try:
+            errors = self._process_rows(rows, internal_client)
+        except Exception as e:
+            self._count_error(type(e).__name__)
+            errors = [(None, repr(e))]
+        remaining = self._queue_dead_letters(rows, errors)
+        failed_ids = set(doc_id for doc_id, _ in errors
+                         if doc_id is not None)
+        if remaining:
+            # The outcome for the other rows is unknown
+            self._dead_letters.add(
+                [(doc_id, row, remaining[0][1]) for doc_id, row in due
+                 if doc_id not in failed_ids])
+            failed_ids = set(doc_id for doc_id, _ in due)
+        else:
+            self._dead_letters.remove(
+                [doc_id for doc_id, _ in due if doc_id not in failed_ids])
+        self.logger.info("Retried %d queued rows of %s/%s, %d failed" % (
+            len(due), self._account, self._container, len(failed_ids)))
+        return len(due)
 
     def _check_errors(self, errors):
         if not errors:
@@ -169,13 +564,112 @@ class MetadataSync(BaseSync):
             self.logger.error(str(error))
         raise RuntimeError('Failed to process some entries')
 
+    def _bulk(self, ops, stage):
+        """
+            Send the operations in bulk requests sized by the cluster's bulk
+            sizer. Returns the number of successful operations and the list of
+            failures across all of the requests, once any transient failures
+            have been retried. The requests are timed as the given stage.
+        """
+        success_count = 0
+        failures = []
+        if self._bulk_concurrency > 1:
+            # Up to bulk_concurrency requests are in flight at a time, while
+            # the following chunk is being assembled.
+            pile = eventlet.GreenPile(self._bulk_concurrency)
+            for chunk, chunk_bytes in self._bulk_sizer.chunks(ops):
+                pile.spawn(self._bulk_chunk, chunk, chunk_bytes, stage)
+            results = pile
+        else:
+            results = (self._bulk_chunk(chunk, chunk_bytes, stage)
+                       for chunk, chunk_bytes in self._bulk_sizer.chunks(ops))
+        for chunk_success, chunk_failures in results:
+            success_count += chunk_success
+            failures.extend(chunk_failures)
+        sizes = self._bulk_sizer.stats()
+        cluster_labels = {'cluster': self._bulk_sizer.name}
+        self._metrics.set('bulk_docs', cluster_labels, sizes['docs'])
+        self._metrics.set('bulk_bytes', cluster_labels, sizes['bytes'])
+        self._tracer.trace('bulk_size', sizes=sizes)
+        return success_count, failures
+
+    def _bulk_chunk(self, chunk, chunk_bytes, stage):
+        """
+            Send one chunk of operations, reporting the latency and any
+            rejections of each request to the bulk sizer. The operations that
+            fail with a transient error are sent again, up to retry_attempts
+            times, after a jittered exponential backoff.
+        """
+        success_count = 0
+        failures = []
+        attempt = 0
+        while True:
+            start = time.time()
+            if self._bulk_aggregator:
+                # The aggregator reports the shared requests to the sizer
+                chunk_success, chunk_failures = self._bulk_aggregator.bulk(
+                    chunk, chunk_bytes)
+            else:
+                chunk_success, chunk_failures = elasticsearch.helpers.bulk(
+                    self._es_conn, chunk,
+                    chunk_size=len(chunk),
+                    max_chunk_bytes=max(chunk_bytes,
+                                        self._bulk_sizer.max_bytes),
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                )
+            latency = time.time() - start
+            self._stages.add(stage, latency, len(chunk), chunk_bytes)
+            self._metrics.observe('bulk_seconds', self._metric_labels,
+                                  latency)
+            if not self._bulk_aggregator:
+                self._bulk_sizer.record(
+                    latency,
+                    any(BulkSizer.is_rejected(op_info)
+                        for failure in chunk_failures
+                        for op_info in failure.values()))
+            success_count += chunk_success or 0
+
+            retry_failures = {}
+            for failure in chunk_failures:
+                op_type, op_info = failure.items()[0]
+                if attempt < self._retry_attempts and\
+                        self._is_transient_error(op_info):
+                    retry_failures[(op_type, op_info.get('_id'))] = failure
+                else:
+                    failures.append(failure)
+            retry_ops = [op for op in chunk if retry_failures.pop(
+                (op.get('_op_type', 'index'), op.get('_id')), None)]
+            # Failures that do not match any operation cannot be retried
+            failures.extend(retry_failures.values())
+            if not retry_ops:
+                return success_count, failures
+            attempt += 1
+            backoff = self._get_retry_backoff(attempt)
+            self._tracer.trace('bulk_retry', operations=len(retry_ops),
+                               backoff=backoff, attempt=attempt,
+                               attempts=self._retry_attempts)
+            eventlet.sleep(backoff)
+            chunk = retry_ops
+            chunk_bytes = sum(map(BulkSizer.action_size, chunk))
+
+    @classmethod
+    def _is_transient_error(cls, op_info):
+        if op_info.get('status') in cls.TRANSIENT_STATUSES:
+            return True
+        # Timeouts and connection errors fail the whole request, in which case
+        # every operation carries the exception.
+        return isinstance(op_info.get('exception'),
+                          elasticsearch.ConnectionError)
+
+    def _get_retry_backoff(self, attempt):
+        return random.uniform(0, min(
+            self._retry_max_backoff,
+            self._retry_backoff * 2 ** (attempt - 1)))
+
     def _bulk_delete(self, ops):
         errors = []
-        success_count, delete_failures = elasticsearch.helpers.bulk(
-            self._es_conn, ops,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
+        success_count, delete_failures = self._bulk(ops, 'bulk_delete')
 
         for op in delete_failures:
             op_info = op['delete']
@@ -185,57 +679,304 @@ class MetadataSync(BaseSync):
                 # < 5.x Elasticsearch versions do not return "result"
                 if op_info.get('found') is False:
                     continue
-            if 'exception' in op_info:
-                errors.append(op_info['exception'])
-            else:
-                errors.append("%s: %s" % (op_info['_id'],
-                                          self._extract_error(op_info)))
+            if self._is_version_conflict(op_info):
+                continue
+            self._check_mapping_error(op_info)
+            errors.append(self._get_failure(op_info))
         return errors
 
-    def _get_stale_rows(self, mget_map):
+    def _is_version_conflict(self, op_info):
+        # With external versioning, a conflict means that the indexed
+        # document is at least as new as the one we attempted to write.
+        return self._external_versioning and op_info.get('status') == 409
+
+    def _get_es_timestamp(self, row):
+        # ElasticSearch only supports milliseconds
+        return int(float(self._get_last_modified_date(row)) * 1000)
+
+    def _open_timestamp_index(self):
+        if self._timestamp_index is None or self._db_id is None:
+            return False
+        self._timestamp_index.open(self._db_id, self._index)
+        return True
+
+    def _open_dead_letters(self):
+        if self._dead_letters is None:
+            return False
+        self._dead_letters.open(self._account, self._container, self._index)
+        return True
+
+    def _has_dead_letters(self):
+        """
+            Returns True if the dead letter queue holds any rows. The queue
+            file is only created once a row is queued.
+        """
+        if not os.path.exists(self._dead_letters.path):
+            return False
+        self._open_dead_letters()
+        return not self._dead_letters.is_empty()
+
+    def _is_verified_row(self, row):
+        # Rows at or below the last processed row are being verified and must
+        # always be checked against Elasticsearch.
+        if self._last_processed_row is None or 'ROWID' not in row:
+            return True
+        return row['ROWID'] <= self._last_processed_row
+
+    def _get_verified_timestamps(self, rows):
+        """
+            Looks up the documents of the rows that are being verified, with
+            searches that read the x-timestamp doc values instead of the
+            documents' source. Returns the indexed timestamp of every document
+            ID (None if the document is not found). Searches are near real
+            time, so a document that was just indexed may not be found, in
+            which case its row is processed again.
+        """
+        doc_ids = [self._get_document_id(row) for row in rows
+                   if self._is_verified_row(row)]
+        timestamps = dict.fromkeys(doc_ids)
+        if not doc_ids:
+            return timestamps
+        # Dates are returned as formatted strings by default since 6.4
+        if self._server_version >= StrictVersion('6.4'):
+            field = {'field': 'x-timestamp', 'format': 'epoch_millis'}
+        else:
+            field = 'x-timestamp'
+        with self._stages.timer('get_stale_rows'):
+            for i in xrange(0, len(doc_ids), self.VERIFY_SEARCH_SIZE):
+                chunk = doc_ids[i:i + self.VERIFY_SEARCH_SIZE]
+                with self._metrics.timer('verify_seconds',
+                                         self._metric_labels):
+                    results = self._es_conn.search(
+                        index=self._index,
+                        body={'query': {'ids': {'values': chunk}},
+                              'size': len(chunk),
+                              '_source': False,
+                              'docvalue_fields': [field]})
+                for hit in results['hits']['hits']:
+                    values = hit.get('fields', {}).get('x-timestamp')
+                    timestamps[hit['_id']] = int(float(values[0]))\
+                        if values else 0
+        self._tracer.trace('verified', documents=len(doc_ids))
+        return timestamps
+
+    def _get_stale_rows(self, mget_map, verified=None):
+        """
+            Returns the (document ID, row) pairs of the rows whose documents
+            are missing or out of date and the lookup errors. The timestamps
+            of the `verified` document IDs are already known.
+        """
         errors = []
-        stale_rows = []
-        results = self._es_conn.mget(body={'ids': mget_map.keys()},
-                                     index=self._index,
-                                     refresh=True,
-                                     _source=['x-timestamp'])
-        docs = results['docs']
-        for doc in docs:
-            row = mget_map.get(doc['_id'])
-            if not row:
-                errors.append("Unknown row for ID %s" % doc['_id'])
-                continue
-            if 'error' in doc:
-                errors.append("Failed to query %s: %s" % (
-                              doc['_id'], str(doc['error'])))
-                continue
-            object_date = self._get_last_modified_date(row)
-            # ElasticSearch only supports milliseconds
-            object_ts = int(float(object_date) * 1000)
-            if not doc['found'] or object_ts > doc['_source'].get(
-                    'x-timestamp', 0):
-                stale_rows.append((doc['_id'], row))
-                continue
-        self.logger.debug("Stale rows: %s" % repr(stale_rows))
+        stale_ids = set()
+        verified = verified or {}
+        for doc_id, indexed_ts in verified.items():
+            if doc_id in mget_map and (
+                    indexed_ts is None or
+                    self._get_es_timestamp(mget_map[doc_id]) > indexed_ts):
+                stale_ids.add(doc_id)
+        fresh_count = len(
+            verified.viewkeys() & mget_map.viewkeys()) - len(stale_ids)
+        local_timestamps = {}
+        use_local_index = self._open_timestamp_index()
+        if use_local_index:
+            local_timestamps = self._timestamp_index.get_many(
+                [doc_id for doc_id, row in mget_map.items()
+                 if not self._is_verified_row(row)])
+        local_stale = 0
+        for doc_id, indexed_ts in local_timestamps.items():
+            if self._get_es_timestamp(mget_map[doc_id]) > indexed_ts:
+                stale_ids.add(doc_id)
+                local_stale += 1
+        fresh_count += len(local_timestamps) - local_stale
+
+        remote_ids = [doc_id for doc_id in mget_map.keys()
+                      if doc_id not in local_timestamps and
+                      doc_id not in verified]
+        if remote_ids:
+            fresh_docs = []
+            with self._metrics.timer('mget_seconds', self._metric_labels):
+                results = self._es_conn.mget(body={'ids': remote_ids},
+                                             index=self._index,
+                                             refresh=True,
+                                             _source=['x-timestamp'])
+            docs = results['docs']
+            for doc in docs:
+                row = mget_map.get(doc['_id'])
+                if not row:
+                    self._count_error('unknown_row')
+                    errors.append(
+                        (None, "Unknown row for ID %s" % doc['_id']))
+                    continue
+                if 'error' in doc:
+                    self._count_error('mget_error')
+                    errors.append((None, "Failed to query %s: %s" % (
+                                   doc['_id'], str(doc['error']))))
+                    continue
+                object_ts = self._get_es_timestamp(row)
+                if not doc['found'] or object_ts > doc['_source'].get(
+                        'x-timestamp', 0):
+                    stale_ids.add(doc['_id'])
+                    continue
+                fresh_docs.append(
+                    (doc['_id'], doc['_source']['x-timestamp']))
+            fresh_count += len(fresh_docs)
+            if use_local_index and fresh_docs:
+                self._timestamp_index.update(fresh_docs)
+        stale_rows = [(doc_id, mget_map[doc_id]) for doc_id in mget_map
+                      if doc_id in stale_ids]
+        self._metrics.inc('stale_rows_total', self._metric_labels,
+                          len(stale_rows))
+        self._metrics.inc('fresh_rows_total', self._metric_labels,
+                          fresh_count)
+        self._tracer.trace('stale_rows', stale_rows=stale_rows)
         return stale_rows, errors
 
-    def _create_index_op(self, doc_id, row, internal_client):
+    def _create_index_ops(self, stale_rows, internal_client, errors):
+        """
+            Generate the index operations for the stale rows, in the same
+            order as the rows. Up to head_concurrency HEAD requests are in
+            flight at a time and the pool keeps fetching ahead while the
+            generated operations are consumed. If any request fails, the error
+            is raised when its operation is reached, as with the serial case.
+            With the dead letter queue, the rows whose objects cannot be
+            retrieved are skipped instead and their errors are appended to
+            `errors`, so that the rows are queued.
+        """
+        create_op = self._create_index_op
+        if self._dead_letters is not None:
+            create_op = functools.partial(self._try_create_index_op,
+                                          errors=errors)
+        if self._row_only or self._head_concurrency == 1 or\
+                len(stale_rows) < 2:
+            ops = (create_op(doc_id, row, internal_client)
+                   for doc_id, row in stale_rows)
+        else:
+            ops = self._create_concurrently(
+                create_op, stale_rows, internal_client)
+        try:
+            for op in ops:
+                if op is not None:
+                    yield op
+        finally:
+            ops.close()
+
+    def _create_concurrently(self, create_op, stale_rows, internal_client):
+        """
+            Generate the results of create_op for the stale rows, in order,
+            with up to head_concurrency calls in flight. The greenthreads that
+            are still running when the generator is closed (on an error, or if
+            the consumer stops early) are killed, so that none outlive it.
+        """
+        def _call(doc_id, row):
+            try:
+                return create_op(doc_id, row, internal_client), None
+            except Exception as e:
+                # Raised by the generator instead, as the hub would print
+                # the traceback of an exception that leaves a greenthread
+                return None, e
+
+        def _result(thread):
+            op, error = thread.wait()
+            if error is not None:
+                raise error
+            return op
+
+        pool = eventlet.GreenPool(
+            min(self._head_concurrency, len(stale_rows)))
+        pending = collections.deque()
+        try:
+            for doc_id, row in stale_rows:
+                while pending and pending[0].dead:
+                    yield _result(pending.popleft())
+                pending.append(pool.spawn(_call, doc_id, row))
+            while pending:
+                yield _result(pending.popleft())
+        finally:
+            for thread in pending:
+                thread.kill()
+
+    def _try_create_index_op(self, doc_id, row, internal_client, errors):
+        """
+            Returns the index operation for the row, or None if Swift fails
+            the requests for the object (e.g. it was deleted since the row was
+            listed), in which case the error is appended to `errors`.
+        """
+        try:
+            return self._create_index_op(doc_id, row, internal_client)
+        except UnexpectedResponse as e:
+            self._count_error(type(e).__name__)
+            errors.append((doc_id, '%s: %s' % (doc_id, e)))
+            return None
+
+    def _get_object_metadata(self, row, internal_client):
+        """
+            Retrieve the object metadata. In the adaptive mode, a plain HEAD
+            is issued first and the request is retried with X-Newest only if
+            the response is older than the row (or the HEAD fails).
+        """
         swift_hdrs = {'X-Newest': True}
-        meta = internal_client.get_object_metadata(
+        if not self._adaptive_newest:
+            return internal_client.get_object_metadata(
+                self._account, self._container, row['name'],
+                headers=swift_hdrs)
+
+        self._count_head('head')
+        try:
+            meta = internal_client.get_object_metadata(
+                self._account, self._container, row['name'], headers={})
+            row_ts = float(self._get_last_modified_date(row))
+            if float(meta['x-timestamp']) >= row_ts:
+                return meta
+        except UnexpectedResponse:
+            pass
+        self._count_head('newest_fallback')
+        return internal_client.get_object_metadata(
             self._account, self._container, row['name'], headers=swift_hdrs)
-        op = {'_op_type': 'index',
-              '_index': self._index,
-              '_source': self._create_es_doc(meta, self._account,
-                                             self._container,
-                                             row['name'].decode('utf-8'),
-                                             self._parse_json),
-              '_id': doc_id}
-        if self._pipeline:
-            op['pipeline'] = self._pipeline
-        if self._server_version < StrictVersion('7.0'):
-            op['_type'] = self._doc_type
+
+    def _count_head(self, head_type):
+        self.head_stats[head_type] += 1
+        self._metrics.inc('head_requests_total',
+                          dict(self._metric_labels, type=head_type))
+
+    def _create_index_op(self, doc_id, row, internal_client):
+        if not self._row_only:
+            with self._stages.timer('head', 1),\
+                    self._metrics.timer('head_seconds', self._metric_labels):
+                meta = self._get_object_metadata(row, internal_client)
+            self._stages.add('head', size=sum(
+                len(key) + len(str(value)) for key, value in meta.items()))
+        with self._stages.timer('build_docs', 1):
+            if self._row_only:
+                es_doc = self._create_row_es_doc(
+                    row, self._account, self._container)
+            else:
+                es_doc = self._get_es_doc(meta, row, internal_client)
+            op = {'_op_type': 'index',
+                  '_index': self._index,
+                  '_source': es_doc,
+                  '_id': doc_id}
+            if self._pipeline:
+                op['pipeline'] = self._pipeline
+            if self._external_versioning:
+                op['version'] = es_doc['x-timestamp']
+                op['version_type'] = 'external'
+            if self._server_version < StrictVersion('7.0'):
+                op['_type'] = self._doc_type
         return op
 
+    def _get_es_doc(self, meta, row, internal_client):
+        def _build_doc():
+            return self._create_es_doc(meta, self._account, self._container,
+                                       row['name'].decode('utf-8'),
+                                       self._parse_json)
+
+        if isinstance(internal_client, SharedMetadata):
+            # The targets of the mapping share the documents of the batch
+            return internal_client.get_es_doc(
+                (row['name'], meta['x-timestamp'], self._parse_json),
+                _build_doc)
+        return _build_doc()
+
     """
         Verify document mapping for the elastic search index. Does not include
         any user-defined fields.
@@ -344,6 +1085,38 @@ class MetadataSync(BaseSync):
             es_doc[field] = meta[field]
         return es_doc
 
+    @staticmethod
+    def _create_row_es_doc(row, account, container):
+        """
+            Create the Elasticsearch document from the container row alone.
+            The fields match the ones that _create_es_doc() would produce from
+            the HEAD response, but no user metadata is included.
+        """
+        meta_ts = float(MetadataSync._get_last_modified_date(row))
+        es_doc = {}
+        # ElasticSearch only supports millisecond resolution
+        es_doc['x-timestamp'] = int(meta_ts * 1000)
+        # Swift rounds Last-Modified up to the next second
+        es_doc['last-modified'] = int(math.ceil(meta_ts)) * 1000
+        es_doc['x-swift-object'] = row['name'].decode('utf-8')
+        es_doc['x-swift-account'] = account
+        es_doc['x-swift-container'] = container
+
+        # Static large objects record their total size in the swift_bytes
+        # content-type parameter and the manifest etag in the slo_etag
+        # parameter of the etag.
+        content_type, swift_bytes = extract_swift_bytes(row['content_type'])
+        es_doc['content-type'] = content_type
+        es_doc['content-length'] = int(swift_bytes) if swift_bytes\
+            else row['size']
+        etag, etag_params = parse_content_type(row['etag'])
+        etag_params = dict(etag_params)
+        if 'slo_etag' in etag_params:
+            etag = etag_params['slo_etag']
+            es_doc['x-static-large-object'] = 'true'
+        es_doc['etag'] = '"%s"' % etag
+        return es_doc
+
     @staticmethod
     def _get_last_modified_date(row):
         ts, content, meta = decode_timestamps(row['created_at'])
@@ -391,15 +1164,211 @@ class MetadataSync(BaseSync):
         ).hexdigest()
 
 
+class ElasticsearchPool(object):
+    """
+        Shares the Elasticsearch clients, along with the server versions,
+        between the MetadataSync instances that use the same cluster.
+    """
+    def __init__(self, mapping_ttl=0, bulk_options=None, maxsize=None,
+                 aggregation_delay=0):
+        self._clients = {}
+        self._maxsize = maxsize
+        self._doc_types = {}
+        self._bulk_sizers = {}
+        self._bulk_aggregators = {}
+        self._aggregation_delay = aggregation_delay
+        self._mapping_ttl = mapping_ttl
+        self._bulk_options = bulk_options or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(settings):
+        return (json.dumps(settings['es_hosts'], sort_keys=True),
+                settings.get('ca_certs'),
+                settings.get('verify_certs'))
+
+    def get(self, settings):
+        """Returns the client and server version for the mapping."""
+        key = self._get_key(settings)
+        with self._lock:
+            if key not in self._clients:
+                kwargs = {}
+                if 'ca_certs' in settings:
+                    kwargs['ca_certs'] = settings['ca_certs']
+                if 'verify_certs' in settings:
+                    kwargs['verify_certs'] = settings['verify_certs']
+                if self._maxsize:
+                    # Connections kept open to each node
+                    kwargs['maxsize'] = self._maxsize
+                es_conn = elasticsearch.Elasticsearch(
+                    settings['es_hosts'], **kwargs)
+                server_version = StrictVersion(
+                    es_conn.info()['version']['number'])
+                self._clients[key] = (es_conn, server_version)
+            return self._clients[key]
+
+    def get_bulk_sizer(self, settings):
+        """Returns the bulk sizer shared by the mappings of the cluster."""
+        key = self._get_key(settings)
+        with self._lock:
+            if key not in self._bulk_sizers:
+                self._bulk_sizers[key] = BulkSizer(
+                    name=key[0], **self._bulk_options)
+            return self._bulk_sizers[key]
+
+    def get_bulk_aggregator(self, settings):
+        """
+            Returns the bulk aggregator shared by the mappings of the cluster,
+            or None if the bulk requests are not aggregated.
+        """
+        if not self._aggregation_delay:
+            return None
+        es_conn, _ = self.get(settings)
+        sizer = self.get_bulk_sizer(settings)
+        key = self._get_key(settings)
+        with self._lock:
+            if key not in self._bulk_aggregators:
+                self._bulk_aggregators[key] = BulkAggregator(
+                    es_conn, sizer, self._aggregation_delay)
+            return self._bulk_aggregators[key]
+
+    def bulk_sizes(self):
+        """Returns the current bulk sizes of every cluster by its hosts."""
+        with self._lock:
+            sizers = self._bulk_sizers.items()
+        return dict((key[0], sizer.stats()) for key, sizer in sizers)
+
+    def get_doc_type(self, es_conn, index):
+        """
+            Returns the document type recorded when the index mapping was last
+            verified, or None if it has to be verified (again).
+        """
+        with self._lock:
+            doc_type, expires = self._doc_types.get(
+                (es_conn, index), (None, 0))
+        if time.time() >= expires:
+            return None
+        return doc_type
+
+    def set_doc_type(self, es_conn, index, doc_type):
+        if not self._mapping_ttl:
+            return
+        with self._lock:
+            self._doc_types[(es_conn, index)] = (
+                doc_type, time.time() + self._mapping_ttl)
+
+    def invalidate_doc_type(self, es_conn, index):
+        with self._lock:
+            self._doc_types.pop((es_conn, index), None)
+
+
 class MetadataSyncFactory(object):
     def __init__(self, config):
         self._conf = config
+        self.logger = logging.getLogger('swift-metadata-sync')
         if not config.get('status_dir'):
             raise RuntimeError('Configuration option "status_dir" is missing')
+        if config.get('status_backend', 'json') not in STATUS_BACKENDS:
+            raise RuntimeError(
+                'Configuration option "status_backend" must be one of: '
+                '{}'.format(', '.join(STATUS_BACKENDS)))
+        bulk_options = dict(
+            (option, config[key]) for option, key in (
+                ('max_docs', 'bulk_max_docs'),
+                ('min_docs', 'bulk_min_docs'),
+                ('max_bytes', 'bulk_max_bytes'),
+                ('min_bytes', 'bulk_min_bytes'),
+                ('target_latency', 'bulk_target_latency'))
+            if key in config)
+        self._engine = config.get('engine', 'threads')
+        if self._engine not in ENGINES:
+            raise RuntimeError(
+                'Configuration option "engine" must be one of: '
+                '{}'.format(', '.join(ENGINES)))
+        self.metrics = Metrics()
+        self.profiler = None
+        # Callables that receive the metric labels and the StageTimings of
+        # every batch of rows, e.g. to send them to statsd.
+        self.stage_hooks = []
+        self._es_pool = ElasticsearchPool(
+            mapping_ttl=config.get('mapping_cache_ttl', 300),
+            bulk_options=bulk_options,
+            maxsize=config.get(
+                'es_connections', DEFAULT_ES_CONNECTIONS[self._engine]),
+            aggregation_delay=float(
+                config.get('bulk_aggregation_delay', 0)))
+        self._checkpoint_cache = None
+        if 'checkpoint_flush_interval' in config or\
+                'checkpoint_flush_rows' in config:
+            self._checkpoint_cache = CheckpointCache(
+                flush_interval=config.get('checkpoint_flush_interval'),
+                flush_rows=config.get('checkpoint_flush_rows'),
+                row_fields=(MetadataSync.PROCESSED_ROW,
+                            MetadataSync.VERIFIED_ROW))
+            atexit.register(self.flush)
 
     def __str__(self):
         return 'MetadataSync'
 
     def instance(self, settings, per_account=False):
+        if 'targets' not in settings:
+            return self._instance(settings, per_account)
+        syncs = [(name, self._instance(target_settings, per_account, target))
+                 for name, target, target_settings in get_targets(settings)]
+        return FanOutSync(self._conf['status_dir'], settings, syncs,
+                          per_account=per_account)
+
+    def _instance(self, settings, per_account, target=None):
         return MetadataSync(
-            self._conf['status_dir'], settings, per_account=per_account)
+            self._conf['status_dir'], settings, per_account=per_account,
+            status_backend=self._conf.get('status_backend', 'json'),
+            checkpoint_cache=self._checkpoint_cache,
+            es_pool=self._es_pool, engine=self._engine,
+            metrics=self.metrics, profiler=self.profiler,
+            stage_hooks=self.stage_hooks, target=target)
+
+    def retry_dead_letters(self, internal_client, account=None,
+                           container=None):
+        """
+            Retries the due rows of the dead letter queues under the status
+            directory (or only those of the given account or container) and
+            returns the number of rows retried. The queues of the containers
+            that are no longer configured are left alone.
+        """
+        containers = set()
+        for queue in find_queues(self._conf['status_dir']):
+            try:
+                identity = queue.identity
+                # The queues with no due rows are left out, so that no
+                # MetadataSync instance is set up for them
+                due = identity is not None and queue.has_due()
+            finally:
+                queue.close()
+            if due:
+                containers.add(identity[:2])
+        retried = 0
+        for queue_account, queue_container in sorted(containers):
+            if account and account != queue_account:
+                continue
+            if container and container != queue_container:
+                continue
+            for settings, per_account in find_mappings(
+                    self._conf, queue_account, queue_container):
+                for _, target, target_settings in get_targets(settings):
+                    try:
+                        sync = self._instance(
+                            target_settings, per_account, target)
+                        retried += sync.retry_dead_letters(internal_client)
+                    except Exception as e:
+                        self.logger.error(
+                            'Failed to retry the dead letters of %s/%s: '
+                            '%s' % (queue_account, queue_container, repr(e)))
+        return retried
+
+    def bulk_sizes(self):
+        return self._es_pool.bulk_sizes()
+
+    def flush(self):
+        """Writes out any cached checkpoints."""
+        if self._checkpoint_cache:
+            self._checkpoint_cache.flush()
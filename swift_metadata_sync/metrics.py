@@ -0,0 +1,205 @@
+import BaseHTTPServer
+import contextlib
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+PREFIX = 'swift_metadata_sync_'
+
+COUNTERS = {
+    'rows_total': 'Container rows handled.',
+    'deletes_total': 'Documents deleted for the deleted rows.',
+    'stale_rows_total': 'Rows whose documents were out of date.',
+    'fresh_rows_total': 'Rows whose documents were up to date.',
+    'errors_total': 'Failed operations and batches by error type.',
+    'head_requests_total': 'Swift object HEAD requests of the adaptive '
+                           'X-Newest mode, by type.',
+    'stage_items_total': 'Items handled by each stage of the batches.',
+    'stage_bytes_total': 'Bytes handled by each stage of the batches.',
+}
+HISTOGRAMS = {
+    'head_seconds': 'Latency of the Swift object HEAD requests.',
+    'mget_seconds': 'Latency of the Elasticsearch multiple get requests.',
+    'verify_seconds': 'Latency of the Elasticsearch searches that verify '
+                      'the processed rows.',
+    'bulk_seconds': 'Latency of the Elasticsearch bulk requests.',
+    'stage_seconds': 'Time spent in each stage of a batch of rows.',
+}
+GAUGES = {
+    'bulk_docs': 'Current bulk request limit in documents.',
+    'bulk_bytes': 'Current bulk request limit in bytes.',
+}
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def _escape(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value).replace('\\', '\\\\').replace(
+            '\n', '\\n').replace('"', '\\"')
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in labels)
+
+
+class Metrics(object):
+    """
+        Counters, gauges, and histograms of the daemon, rendered in the
+        Prometheus text exposition format. Every sample is keyed by its
+        labels, e.g. the account, container, and index of a mapping.
+    """
+    def __init__(self):
+        self._counters = dict((name, {}) for name in COUNTERS)
+        self._gauges = dict((name, {}) for name in GAUGES)
+        self._histograms = dict((name, {}) for name in HISTOGRAMS)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        key = self._key(labels)
+        with self._lock:
+            counter = self._counters[name]
+            counter[key] = counter.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._gauges[name][self._key(labels)] = value
+
+    def observe(self, name, labels, value):
+        key = self._key(labels)
+        with self._lock:
+            histogram = self._histograms[name]
+            if key not in histogram:
+                histogram[key] = [[0] * len(BUCKETS), 0.0, 0]
+            buckets, _, _ = entry = histogram[key]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels):
+        """Observes the time spent in the block, even if it raises."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.time() - start)
+
+    def get(self, name, labels):
+        """Returns the value of a counter or gauge (or None)."""
+        key = self._key(labels)
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name].get(key)
+            return self._gauges[name].get(key)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metrics, metric_type, descriptions in (
+                    (self._counters, 'counter', COUNTERS),
+                    (self._gauges, 'gauge', GAUGES)):
+                for name in sorted(metrics):
+                    lines.append('# HELP %s%s %s' % (
+                        PREFIX, name, descriptions[name]))
+                    lines.append('# TYPE %s%s %s' % (
+                        PREFIX, name, metric_type))
+                    for key, value in sorted(metrics[name].items()):
+                        lines.append('%s%s%s %s' % (
+                            PREFIX, name, _format_labels(key),
+                            _format_value(value)))
+            for name in sorted(self._histograms):
+                lines.append('# HELP %s%s %s' % (
+                    PREFIX, name, HISTOGRAMS[name]))
+                lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+                for key, (buckets, total, count) in sorted(
+                        self._histograms[name].items()):
+                    for bound, bucket_count in zip(
+                            BUCKETS + (float('inf'),), buckets + [count]):
+                        lines.append('%s%s_bucket%s %d' % (
+                            PREFIX, name, _format_labels(
+                                key + (('le', _format_value(bound)),)),
+                            bucket_count))
+                    lines.append('%s%s_sum%s %s' % (
+                        PREFIX, name, _format_labels(key),
+                        _format_value(total)))
+                    lines.append('%s%s_count%s %d' % (
+                        PREFIX, name, _format_labels(key), count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+            Writes the metrics for the node exporter's textfile collector. The
+            file is replaced atomically, so that it is never read partially.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(metrics, port, host='127.0.0.1'):
+    """Serves the metrics on the port from a daemon thread."""
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_textfile_writer(metrics, path, interval):
+    """Writes the metrics to the file every interval seconds."""
+    logger = logging.getLogger('swift-metadata-sync')
+
+    def _write_forever():
+        while True:
+            try:
+                metrics.write_textfile(path)
+            except Exception as e:
+                logger.error('Failed to write the metrics to %s: %s' % (
+                    path, repr(e)))
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_write_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
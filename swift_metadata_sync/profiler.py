@@ -0,0 +1,128 @@
+import collections
+import cProfile
+import gc
+import glob
+import logging
+import os
+import os.path
+import pstats
+import resource
+import threading
+import time
+
+
+class Profiler(object):
+    """
+        Profiles every `every`-th crawler cycle with cProfile and writes the
+        statistics to `profile_dir`, keeping the `keep` most recent profiles.
+
+        cProfile only follows the thread that enables it. With the threads
+        engine, the rows are handled on the crawler's worker threads, so each
+        call to `runcall()` is profiled separately and merged into the
+        profile of the cycle. With the eventlet engine, all of the green
+        threads run on the thread of the cycle and are covered by its profile.
+
+        If `memory` is set, a summary of the memory usage is written next to
+        each profile: the peak RSS of the process and the types of objects
+        whose number grew the most since the previous profiled cycle.
+    """
+    PREFIX = 'cycle-'
+    MEMORY_TOP_TYPES = 50
+
+    def __init__(self, profile_dir, every=1, keep=10, memory=False,
+                 per_thread=True):
+        self._profile_dir = profile_dir
+        self._every = max(1, every)
+        self._keep = keep
+        self._memory = memory
+        self._per_thread = per_thread
+        self._cycle = 0
+        self._active = False
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._type_counts = {}
+        self.logger = logging.getLogger('swift-metadata-sync')
+
+    def wrap_cycle(self, func):
+        """Returns func, profiled on every `every`-th call."""
+        def _profiled_cycle(*args, **kwargs):
+            self._cycle += 1
+            if (self._cycle - 1) % self._every:
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            with self._lock:
+                self._active = True
+                self._profiles = [profile]
+            self._local.profiling = True
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                self._local.profiling = False
+                with self._lock:
+                    self._active = False
+                    profiles = self._profiles
+                    self._profiles = []
+                try:
+                    self._write(profiles)
+                except Exception as e:
+                    self.logger.error('Failed to write the profile: %s' %
+                                      repr(e))
+        return _profiled_cycle
+
+    def runcall(self, func, *args, **kwargs):
+        """
+            Calls func, profiling it if a profiled cycle is running on another
+            thread.
+        """
+        if not self._per_thread or not self._active or\
+                getattr(self._local, 'profiling', False):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        self._local.profiling = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._local.profiling = False
+            with self._lock:
+                if self._active:
+                    self._profiles.append(profile)
+
+    def _write(self, profiles):
+        if not os.path.exists(self._profile_dir):
+            os.makedirs(self._profile_dir)
+        name = os.path.join(self._profile_dir, '%s%s-%06d' % (
+            self.PREFIX, time.strftime('%Y%m%d-%H%M%S'), self._cycle))
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(name + '.prof')
+        if self._memory:
+            self._write_memory(name + '.mem')
+        self.logger.info('Wrote the profile of cycle %d to %s.prof' % (
+            self._cycle, name))
+        self._rotate()
+
+    def _write_memory(self, path):
+        counts = collections.Counter(
+            type(obj).__name__ for obj in gc.get_objects())
+        growth = sorted(
+            ((count - self._type_counts.get(name, 0), count, name)
+             for name, count in counts.items()), reverse=True)
+        self._type_counts = counts
+        with open(path, 'w') as f:
+            f.write('peak RSS: %d KiB\n' % resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss)
+            f.write('objects: %d\n\n' % sum(counts.values()))
+            f.write('%12s %12s  type\n' % ('growth', 'count'))
+            for delta, count, name in growth[:self.MEMORY_TOP_TYPES]:
+                f.write('%+12d %12d  %s\n' % (delta, count, name))
+
+    def _rotate(self):
+        profiles = sorted(glob.glob(os.path.join(
+            self._profile_dir, self.PREFIX + '*.prof')))
+        for path in profiles[:max(0, len(profiles) - self._keep)]:
+            prefix = path[:-len('.prof')]
+            for old_path in (path, prefix + '.mem'):
+                if os.path.exists(old_path):
+                    os.unlink(old_path)
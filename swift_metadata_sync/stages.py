@@ -0,0 +1,64 @@
+import collections
+import contextlib
+import time
+
+
+class StageTimings(object):
+    """
+        Wall time, item counts, and bytes of the stages of handling a batch of
+        rows:
+
+        - build_deletes: building the delete operations (items are rows)
+        - bulk_delete: the bulk requests of the delete operations
+        - get_stale_rows: looking up the indexed documents
+        - head: the Swift HEAD requests
+        - build_docs: building the documents from the metadata
+        - bulk_index: the bulk requests of the index operations
+
+        The time of a stage is the sum over its calls. The HEAD requests and
+        the bulk requests may be concurrent and the documents are built as
+        they are sent, so the head, build_docs, and bulk_index times overlap
+        and may add up to more than the time of the batch. The bytes are the
+        size of the HEAD responses' headers and of the bulk requests' payload
+        (and 0 for the other stages).
+    """
+    STAGES = ('build_deletes', 'bulk_delete', 'get_stale_rows', 'head',
+              'build_docs', 'bulk_index')
+
+    def __init__(self):
+        self._stages = collections.OrderedDict(
+            (stage, {'seconds': 0.0, 'items': 0, 'bytes': 0})
+            for stage in self.STAGES)
+
+    def add(self, stage, seconds=0.0, items=0, size=0):
+        entry = self._stages[stage]
+        entry['seconds'] += seconds
+        entry['items'] += items
+        entry['bytes'] += size
+
+    @contextlib.contextmanager
+    def timer(self, stage, items=0, size=0):
+        """Adds the time spent in the block to the stage, even if it raises."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, items, size)
+
+    def merge(self, other):
+        for stage, entry in other.items():
+            self.add(stage, entry['seconds'], entry['items'], entry['bytes'])
+
+    def get(self, stage):
+        return dict(self._stages[stage])
+
+    def items(self):
+        """Returns the (stage, {seconds, items, bytes}) of every stage."""
+        return [(stage, dict(entry)) for stage, entry in self._stages.items()]
+
+    def __str__(self):
+        return ' '.join(
+            '%s=%.3fs/%d/%dB' % (stage, entry['seconds'], entry['items'],
+                                 entry['bytes'])
+            for stage, entry in self._stages.items()
+            if entry['seconds'] or entry['items'])
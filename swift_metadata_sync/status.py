@@ -0,0 +1,386 @@
+import errno
+import json
+import os
+import os.path
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+STATUS_BACKENDS = ('json', 'sqlite')
+
+
+class JSONStatusStore(object):
+    """
+        Stores the status entries of all database IDs in a JSON file. The file
+        is rewritten on every update.
+    """
+    def __init__(self, status_file, status_account_dir):
+        self._status_file = status_file
+        self._status_account_dir = status_account_dir
+
+    @property
+    def cache_key(self):
+        return ('json', self._status_file)
+
+    def get(self, db_id):
+        if not os.path.exists(self._status_file):
+            return None
+        with open(self._status_file) as f:
+            try:
+                return json.load(f).get(db_id)
+            except ValueError:
+                return None
+
+    def update(self, db_id, update_fn):
+        """
+            Replaces the entry for the database ID with the result of
+            update_fn, which is called with the current entry (or None).
+        """
+        if not os.path.exists(self._status_account_dir):
+            os.mkdir(self._status_account_dir)
+        if not os.path.exists(self._status_file):
+            with open(self._status_file, 'w') as f:
+                json.dump({db_id: update_fn(None)}, f)
+                return
+
+        with open(self._status_file, 'r+') as f:
+            try:
+                status = json.load(f)
+            except ValueError:
+                status = {}
+            status[db_id] = update_fn(status.get(db_id))
+            f.seek(0)
+            json.dump(status, f)
+            f.truncate()
+
+    def update_many(self, entries):
+        """
+            Durably replaces the entries for the given database IDs. The new
+            file is written and synced before it is renamed over the old one.
+        """
+        if not os.path.exists(self._status_account_dir):
+            os.mkdir(self._status_account_dir)
+        status = {}
+        if os.path.exists(self._status_file):
+            with open(self._status_file) as f:
+                try:
+                    status = json.load(f)
+                except ValueError:
+                    pass
+        status.update(entries)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._status_account_dir,
+                                        prefix='.status-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(status, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._status_file)
+        except:
+            os.unlink(tmp_path)
+            raise
+        dir_fd = os.open(self._status_account_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class SQLiteStatusStore(object):
+    """
+        Stores the status entries in a sqlite database (in WAL mode) shared by
+        all containers. Every update is a transaction on the single database
+        ID. Entries that are missing from the database are migrated from the
+        legacy JSON status file, if one is provided.
+
+        The database is set up once per process, and every thread keeps a
+        connection to it that is shared by the stores of all containers.
+    """
+    DB_FILE = 'status.db'
+    TIMEOUT = 30
+
+    _initialized = set()
+    _init_lock = threading.Lock()
+    _local = threading.local()
+
+    def __init__(self, status_dir, account, container, legacy_store=None):
+        self._path = os.path.join(status_dir, self.DB_FILE)
+        self._account = account
+        self._container = container
+        self._legacy_store = legacy_store
+
+    @property
+    def cache_key(self):
+        return ('sqlite', self._path, self._account, self._container)
+
+    def _initialize(self):
+        """Creates the database in WAL mode (which persists) and its table."""
+        with self._init_lock:
+            if self._path in self._initialized:
+                return
+            try:
+                os.makedirs(os.path.dirname(self._path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            conn = sqlite3.connect(self._path, timeout=self.TIMEOUT,
+                                   isolation_level=None)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS status ('
+                    'db_id TEXT PRIMARY KEY, account TEXT, container TEXT, '
+                    'entry TEXT NOT NULL)')
+            finally:
+                conn.close()
+            self._initialized.add(self._path)
+
+    def _connect(self):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        if self._path not in conns:
+            self._initialize()
+            conns[self._path] = sqlite3.connect(
+                self._path, timeout=self.TIMEOUT, isolation_level=None)
+        return conns[self._path]
+
+    def close(self):
+        """Closes the connection of the current thread to the database."""
+        conns = getattr(self._local, 'conns', {})
+        conn = conns.pop(self._path, None)
+        if conn is not None:
+            conn.close()
+
+    @staticmethod
+    def _select(conn, db_id):
+        row = conn.execute(
+            'SELECT entry FROM status WHERE db_id = ?', (db_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _put(self, conn, db_id, entry):
+        conn.execute(
+            'INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)',
+            (db_id, self._account, self._container, json.dumps(entry)))
+
+    def get(self, db_id):
+        entry = self._select(self._connect(), db_id)
+        if entry is not None or not self._legacy_store:
+            return entry
+        return self.update(db_id, lambda entry: entry)
+
+    def update(self, db_id, update_fn):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            entry = self._select(conn, db_id)
+            if entry is None and self._legacy_store:
+                entry = self._legacy_store.get(db_id)
+            entry = update_fn(entry)
+            if entry is not None:
+                self._put(conn, db_id, entry)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return entry
+
+    def update_many(self, entries):
+        """Replaces the entries for the given database IDs in a transaction."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for db_id, entry in entries.items():
+                self._put(conn, db_id, entry)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+
+class SyncProgress(object):
+    """
+        Reads the progress of a mapping from its status entries. Mixed into
+        the BaseSync classes, which set the paths of the status files, along
+        with the _index, _target, and _status_store attributes.
+    """
+    PROCESSED_ROW = 'last_row'
+    VERIFIED_ROW = 'last_verified_row'
+    PROCESSED_TIME = 'last_row_time'
+    PROCESSED_RATE = 'rows_per_second'
+    # Set while a backfill of the index has not caught up with the database
+    BACKFILL = 'backfill'
+
+    def _get_status_store(self, status_dir, backend):
+        json_store = JSONStatusStore(self._status_file,
+                                     self._status_account_dir)
+        if backend == 'json':
+            return json_store
+        if backend == 'sqlite':
+            return SQLiteStatusStore(status_dir, self._account,
+                                     self._container, legacy_store=json_store)
+        raise RuntimeError('Unknown status backend: {}'.format(backend))
+
+    def _get_status_key(self, db_id):
+        """Returns the key of the status entry of the database."""
+        if self._target:
+            return u'%s:%s' % (db_id, self._target)
+        return db_id
+
+    def _get_entry(self, db_id):
+        """Returns the status entry of the database, if it is for our index."""
+        entry = self._status_store.get(self._get_status_key(db_id))
+        if not entry or entry['index'] != self._index:
+            return None
+        return entry
+
+    def _get_row(self, row_field, db_id):
+        entry = self._get_entry(db_id)
+        if not entry:
+            return 0
+        try:
+            return entry[row_field]
+        except KeyError:
+            if row_field == self.VERIFIED_ROW:
+                return entry.get(self.PROCESSED_ROW, 0)
+        return 0
+
+    def get_last_processed_row(self, db_id):
+        return self._get_row(self.PROCESSED_ROW, db_id)
+
+    def get_last_verified_row(self, db_id):
+        return self._get_row(self.VERIFIED_ROW, db_id)
+
+    def get_rate(self, db_id):
+        """Returns the recent rate of processed rows per second, if known."""
+        entry = self._get_entry(db_id)
+        return entry.get(self.PROCESSED_RATE) if entry else None
+
+    def is_backfill(self, db_id):
+        """Returns True if a backfill of the index has not completed."""
+        entry = self._get_entry(db_id)
+        return bool(entry and entry.get(self.BACKFILL))
+
+
+class CachedStatusStore(object):
+    """
+        Keeps the status entries in memory and writes them to the underlying
+        store once flush_interval seconds have passed since the last flush or
+        any of the row fields advanced by flush_rows. Either criterion may be
+        None to disable it. A crash loses at most the unflushed window, which
+        is then processed again.
+
+        The entries may also be written by another process, such as a
+        backfill. Reading an entry, or flushing it, reads it from the
+        underlying store again and, if it no longer is the entry that was
+        last flushed, the stored entry replaces the cached one, dropping any
+        unflushed changes.
+    """
+    def __init__(self, store, flush_interval=None, flush_rows=None,
+                 row_fields=()):
+        self._store = store
+        self._flush_interval = flush_interval
+        self._flush_rows = flush_rows
+        self._row_fields = row_fields
+        self._entries = {}
+        self._flushed = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def _get(self, db_id):
+        if db_id not in self._entries:
+            entry = self._store.get(db_id)
+            self._entries[db_id] = entry
+            self._flushed[db_id] = entry
+        return self._entries[db_id]
+
+    def _reload(self, db_id):
+        """
+            Replaces the cached entry with the stored one if the latter was
+            changed since it was last flushed. Returns True if it was.
+        """
+        entry = self._store.get(db_id)
+        if entry == self._flushed[db_id]:
+            return False
+        self._entries[db_id] = entry
+        self._flushed[db_id] = entry
+        return True
+
+    def get(self, db_id):
+        with self._lock:
+            if db_id in self._entries:
+                self._reload(db_id)
+            entry = self._get(db_id)
+            return dict(entry) if entry is not None else None
+
+    def update(self, db_id, update_fn):
+        with self._lock:
+            entry = self._get(db_id)
+            if entry is not None:
+                entry = dict(entry)
+            self._entries[db_id] = update_fn(entry)
+            if self._should_flush():
+                self._flush()
+
+    def _row_delta(self, db_id):
+        entry = self._entries[db_id] or {}
+        flushed = self._flushed[db_id] or {}
+        return max([abs(entry.get(field, 0) - flushed.get(field, 0))
+                    for field in self._row_fields] or [0])
+
+    def _dirty(self):
+        return [db_id for db_id in self._entries
+                if self._entries[db_id] != self._flushed[db_id]]
+
+    def _should_flush(self):
+        if self._flush_interval is not None and\
+                time.time() - self._last_flush >= self._flush_interval:
+            return True
+        if self._flush_rows is not None:
+            return any(self._row_delta(db_id) >= self._flush_rows
+                       for db_id in self._dirty())
+        return False
+
+    def _flush(self):
+        dirty = dict((db_id, self._entries[db_id]) for db_id in self._dirty()
+                     if not self._reload(db_id))
+        if dirty:
+            self._store.update_many(dirty)
+            self._flushed.update(dirty)
+        self._last_flush = time.time()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+
+class CheckpointCache(object):
+    """
+        Shares the cached status stores between the MetadataSync instances,
+        so that the cached entries outlive any one instance.
+    """
+    def __init__(self, flush_interval=None, flush_rows=None, row_fields=()):
+        self._flush_interval = flush_interval
+        self._flush_rows = flush_rows
+        self._row_fields = row_fields
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, store):
+        with self._lock:
+            if store.cache_key not in self._stores:
+                self._stores[store.cache_key] = CachedStatusStore(
+                    store, self._flush_interval, self._flush_rows,
+                    self._row_fields)
+            return self._stores[store.cache_key]
+
+    def flush(self):
+        with self._lock:
+            stores = self._stores.values()
+        for store in stores:
+            store.flush()
@@ -0,0 +1,128 @@
+import os.path
+import time
+
+from container_crawler.base_sync import BaseSync
+from swift.common.ring import Ring
+from swift.common.utils import hash_path, storage_directory
+from swift.container.backend import ContainerBroker, DATADIR
+from .fan_out import get_targets
+from .mappings import is_per_account
+from .metadata_sync import MetadataSync
+from .status import SyncProgress
+
+
+class SyncStatus(SyncProgress, BaseSync):
+    """
+        Read-only view of the progress of a container mapping. It reads the
+        same status store as MetadataSync, but does not connect to
+        Elasticsearch.
+    """
+    def __init__(self, status_dir, settings, per_account=False,
+                 status_backend='json', target=None):
+        super(SyncStatus, self).__init__(status_dir, settings, per_account)
+        self._target = target
+        self._index = settings['index']
+        self._status_store = self._get_status_store(status_dir, status_backend)
+
+    def get_lag(self, broker, now=None):
+        """
+            Compares the container database with the status of the mapping.
+            Returns a dictionary of the row lag, the estimated time to catch
+            up (in seconds) at the recent rate, and the age of the oldest row
+            that has not been processed yet (in seconds).
+        """
+        if now is None:
+            now = time.time()
+        db_id = broker.get_info()['id']
+        max_row = broker.get_max_row()
+        last_row = self.get_last_processed_row(db_id)
+        last_verified_row = self.get_last_verified_row(db_id)
+        row_lag = max(0, max_row - last_row)
+        rate = self.get_rate(db_id)
+        catch_up_time = None
+        if not row_lag:
+            catch_up_time = 0
+        elif rate:
+            catch_up_time = row_lag / rate
+        oldest_row_age = None
+        if row_lag:
+            rows = broker.get_items_since(last_row, 1)
+            if rows:
+                oldest_row_age = max(0, now - float(
+                    MetadataSync._get_last_modified_date(rows[0])))
+        return {'db_id': db_id,
+                'max_row': max_row,
+                self.PROCESSED_ROW: last_row,
+                self.VERIFIED_ROW: last_verified_row,
+                'row_lag': row_lag,
+                'verify_lag': max(0, max_row - last_verified_row),
+                self.PROCESSED_RATE: rate,
+                'catch_up_seconds': catch_up_time,
+                'oldest_row_age': oldest_row_age}
+
+
+def get_container_broker(conf, account, container):
+    """
+        Returns the broker of the container database on this node, or None if
+        the node does not hold the database.
+    """
+    ring = Ring(conf.get('swift_dir', '/etc/swift'), ring_name='container')
+    part, nodes = ring.get_nodes(account, container)
+    container_hash = hash_path(account, container)
+    db_dir = storage_directory(DATADIR, part, container_hash)
+    for node in nodes:
+        db_path = os.path.join(conf['devices'], node['device'], db_dir,
+                               container_hash + '.db')
+        if os.path.exists(db_path):
+            return ContainerBroker(db_path, account=account,
+                                   container=container)
+    return None
+
+
+def _get_mapping_containers(mapping, internal_client):
+    """
+        Returns the (container, settings, per_account) of the containers of
+        the mapping. A per-account mapping covers the containers that Swift
+        lists for its account.
+    """
+    if not is_per_account(mapping):
+        return [(mapping['container'], mapping, False)]
+    return [(container['name'], dict(mapping, container=container['name']),
+             True)
+            for container in internal_client.iter_containers(
+                mapping['account'].encode('utf-8'))]
+
+
+def get_status(conf, now=None, internal_client=None):
+    """
+        Returns the lag of every configured container mapping whose database
+        is on this node, with an entry for every target of the mappings that
+        list several. The containers of the per-account mappings are listed
+        with the internal client, and only those on this node are reported.
+    """
+    report = []
+    for mapping in conf.get('containers', []):
+        for container, settings, per_account in _get_mapping_containers(
+                mapping, internal_client):
+            broker = get_container_broker(
+                conf, mapping['account'].encode('utf-8'),
+                container.encode('utf-8'))
+            if broker is None and per_account:
+                continue
+            for name, target, target_settings in get_targets(settings):
+                entry = {'account': mapping['account'],
+                         'container': container,
+                         'index': target_settings['index']}
+                if 'targets' in mapping:
+                    entry['target'] = name
+                if broker is None:
+                    entry['error'] = 'container database not found'
+                else:
+                    sync_status = SyncStatus(
+                        conf['status_dir'], target_settings,
+                        per_account=per_account,
+                        status_backend=conf.get('status_backend', 'json'),
+                        target=target)
+                    entry.update(sync_status.get_lag(broker, now))
+                report.append(entry)
+    return report
@@ -0,0 +1,81 @@
+import errno
+import os
+import os.path
+import sqlite3
+
+
+class TimestampIndex(object):
+    """
+        Local on-disk map of document IDs to the last indexed x-timestamp (in
+        milliseconds). The index is bound to a container database ID and an
+        Elasticsearch index and is cleared if either one changes, similarly to
+        the rows recorded in the status file.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._conn = None
+        self._identity = None
+
+    def _connect(self):
+        if self._conn:
+            return self._conn
+        try:
+            os.makedirs(os.path.dirname(self._path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS identity '
+                '(db_id TEXT NOT NULL, es_index TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS timestamps '
+                '(doc_id TEXT PRIMARY KEY, x_timestamp INTEGER NOT NULL)')
+        return self._conn
+
+    def open(self, db_id, index):
+        if self._identity == (db_id, index):
+            return
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                'SELECT db_id, es_index FROM identity').fetchone()
+            if row is None or tuple(row) != (db_id, index):
+                conn.execute('DELETE FROM timestamps')
+                conn.execute('DELETE FROM identity')
+                conn.execute('INSERT INTO identity VALUES (?, ?)',
+                             (db_id, index))
+        self._identity = (db_id, index)
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+        self._identity = None
+
+    def get_many(self, doc_ids):
+        """Returns a dictionary of the known document IDs to timestamps."""
+        result = {}
+        doc_ids = list(doc_ids)
+        # Stay well under the default SQLITE_MAX_VARIABLE_NUMBER (999)
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            result.update(self._conn.execute(
+                'SELECT doc_id, x_timestamp FROM timestamps '
+                'WHERE doc_id IN (%s)' % ','.join('?' * len(chunk)),
+                chunk).fetchall())
+        return result
+
+    def update(self, timestamps):
+        """Records the (document ID, timestamp) pairs."""
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO timestamps VALUES (?, ?)',
+                timestamps)
+
+    def remove(self, doc_ids):
+        with self._conn:
+            self._conn.executemany(
+                'DELETE FROM timestamps WHERE doc_id = ?',
+                [(doc_id,) for doc_id in doc_ids])
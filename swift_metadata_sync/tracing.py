@@ -0,0 +1,49 @@
+import logging
+import zlib
+
+
+class _TraceMessage(object):
+    """Formats a trace event only if a handler emits it."""
+    __slots__ = ('event', 'labels', 'fields')
+
+    def __init__(self, event, labels, fields):
+        self.event = event
+        self.labels = labels
+        self.fields = fields
+
+    def __str__(self):
+        parts = [self.event]
+        for key, value in self.labels + sorted(self.fields.items()):
+            if callable(value):
+                value = value()
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            else:
+                value = str(value)
+            parts.append('%s=%s' % (key, value))
+        return ' '.join(parts)
+
+
+class Tracer(object):
+    """
+        Structured debug output of a container. An event is only built if
+        debug logging is enabled and the container is sampled, so tracing
+        costs one check on the hot path otherwise. The field values are
+        formatted with str() (or called first, if they are callables) when
+        the event is emitted.
+
+        `sample_rate` is the fraction of the containers that are traced. The
+        choice is made by hashing the account and container, so a container
+        is either always or never traced.
+    """
+    def __init__(self, account, container, sample_rate=1.0, logger=None):
+        self.logger = logger or logging.getLogger('swift-metadata-sync')
+        self._labels = [('account', account), ('container', container)]
+        path = u'/'.join((account, container or u'')).encode('utf-8')
+        self.sampled = sample_rate >= 1 or (
+            zlib.crc32(path) & 0xffffffff) < sample_rate * 2 ** 32
+
+    def trace(self, event, **fields):
+        if not self.sampled or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.logger.debug('%s', _TraceMessage(event, self._labels, fields))
@@ -0,0 +1,113 @@
+import mock
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync.backfill import Backfill, BackfillLock
+
+
+class TestBackfillLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'account', '.hash.backfill')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lock(self):
+        self.assertFalse(BackfillLock.is_held(self.path))
+        with BackfillLock(self.path):
+            self.assertTrue(os.path.exists(self.path))
+            self.assertTrue(BackfillLock.is_held(self.path))
+            with self.assertRaises(RuntimeError):
+                BackfillLock(self.path).acquire()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(BackfillLock.is_held(self.path))
+
+    def test_stale_lock_file(self):
+        # A backfill that is killed leaves the file behind, but not the lock
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, 'w').close()
+        self.assertFalse(BackfillLock.is_held(self.path))
+        with BackfillLock(self.path):
+            self.assertTrue(BackfillLock.is_held(self.path))
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.sync = mock.MagicMock()
+        self.sync.get_last_processed_row.return_value = 0
+        self.sync.is_backfill.return_value = False
+        self.sync.count_documents.return_value = 0
+        self.broker = mock.Mock()
+        self.broker.get_info.return_value = {'id': 'db-id'}
+        self.rows = [{'ROWID': i, 'name': 'object-%d' % i}
+                     for i in range(1, 11)]
+
+        def get_items_since(start, count):
+            return [row for row in self.rows if row['ROWID'] > start][:count]
+
+        self.broker.get_items_since.side_effect = get_items_since
+        self.swift = mock.Mock()
+
+    def test_run(self):
+        backfill = Backfill(self.sync, self.broker, self.swift,
+                            batch_size=3, checkpoint_rows=5)
+        self.assertEqual((10, 10), backfill.run())
+
+        lock = self.sync.backfill_lock.return_value
+        lock.__enter__.assert_called_once_with()
+        lock.__exit__.assert_called_once_with(None, None, None)
+        self.assertEqual(
+            [mock.call(self.rows[i:i + 3], self.swift)
+             for i in range(0, 10, 3)],
+            self.sync.backfill.mock_calls)
+        self.assertEqual(
+            [mock.call(0, 'db-id'), mock.call(6, 'db-id'),
+             mock.call(10, 'db-id', done=True)],
+            self.sync.save_backfill_row.mock_calls)
+
+    def test_resume(self):
+        self.sync.get_last_processed_row.return_value = 6
+        self.sync.is_backfill.return_value = True
+        self.sync.count_documents.return_value = 6
+        backfill = Backfill(self.sync, self.broker, self.swift, batch_size=3)
+        self.assertEqual((4, 10), backfill.run())
+        self.assertEqual(
+            [mock.call(self.rows[6:9], self.swift),
+             mock.call(self.rows[9:], self.swift)],
+            self.sync.backfill.mock_calls)
+        self.assertEqual([mock.call(10, 'db-id', done=True)],
+                         self.sync.save_backfill_row.mock_calls)
+
+    def test_already_synced(self):
+        self.sync.get_last_processed_row.return_value = 6
+        backfill = Backfill(self.sync, self.broker, self.swift)
+        with self.assertRaises(RuntimeError):
+            backfill.run(force=True)
+        self.sync.backfill.assert_not_called()
+        self.sync.save_backfill_row.assert_not_called()
+
+    def test_index_not_empty(self):
+        self.sync.count_documents.return_value = 1
+        backfill = Backfill(self.sync, self.broker, self.swift)
+        with self.assertRaises(RuntimeError):
+            backfill.run()
+        self.sync.backfill.assert_not_called()
+
+        self.assertEqual((10, 10), backfill.run(force=True))
+
+    def test_failure(self):
+        self.sync.backfill.side_effect = [None, RuntimeError('failed')]
+        backfill = Backfill(self.sync, self.broker, self.swift,
+                            batch_size=3, checkpoint_rows=1)
+        with self.assertRaises(RuntimeError):
+            backfill.run()
+        # The checkpoint only covers the rows that were indexed
+        self.assertEqual(
+            [mock.call(0, 'db-id'), mock.call(3, 'db-id')],
+            self.sync.save_backfill_row.mock_calls)
+        lock = self.sync.backfill_lock.return_value
+        lock.__exit__.assert_called_once_with(RuntimeError, mock.ANY, mock.ANY)
@@ -0,0 +1,100 @@
+import elasticsearch
+import mock
+import threading
+import unittest
+
+from swift_metadata_sync.bulk_aggregator import BulkAggregator
+from swift_metadata_sync.bulk_sizer import BulkSizer
+
+
+def fake_streaming_bulk(client, actions, **kwargs):
+    """Fails the operations whose IDs start with "fail"."""
+    for action in actions:
+        info = {'_id': action['_id'], 'status': 200}
+        if action['_id'].startswith('fail'):
+            info.update(status=400, error={'type': 'mapper_parsing_exception'})
+        yield info['status'] == 200, {action['_op_type']: info}
+
+
+@mock.patch('swift_metadata_sync.bulk_aggregator.elasticsearch.helpers.'
+            'streaming_bulk')
+class TestBulkAggregator(unittest.TestCase):
+    def setUp(self):
+        self.es_conn = mock.Mock()
+        self.sizer = BulkSizer(max_docs=5, min_docs=1)
+        self.aggregator = BulkAggregator(self.es_conn, self.sizer, 5)
+
+    @staticmethod
+    def make_ops(*ids):
+        return [{'_op_type': 'index', '_id': doc_id, '_source': {}}
+                for doc_id in ids]
+
+    def test_full_request(self, bulk_mock):
+        bulk_mock.side_effect = fake_streaming_bulk
+        results = {}
+
+        def submit(name, ops):
+            results[name] = self.aggregator.bulk(ops, 10 * len(ops))
+
+        # The first caller waits for the others, until the request is full
+        first = threading.Thread(
+            target=submit, args=('first', self.make_ops('a', 'fail-b')))
+        first.start()
+        while self.aggregator._pending is None:
+            pass
+        submit('second', self.make_ops('c', 'd', 'fail-e'))
+        first.join()
+
+        bulk_mock.assert_called_once_with(
+            self.es_conn, self.make_ops('a', 'fail-b', 'c', 'd', 'fail-e'),
+            chunk_size=5, max_chunk_bytes=self.sizer.max_bytes,
+            raise_on_error=False, raise_on_exception=False, yield_ok=True)
+        self.assertEqual(1, results['first'][0])
+        self.assertEqual(['fail-b'], [
+            failure['index']['_id'] for failure in results['first'][1]])
+        self.assertEqual(2, results['second'][0])
+        self.assertEqual(['fail-e'], [
+            failure['index']['_id'] for failure in results['second'][1]])
+        self.assertIsNone(self.aggregator._pending)
+
+    def test_delay(self, bulk_mock):
+        bulk_mock.side_effect = fake_streaming_bulk
+        self.aggregator._delay = 0.01
+        self.assertEqual((1, []), self.aggregator.bulk(self.make_ops('a'), 10))
+        bulk_mock.assert_called_once_with(
+            self.es_conn, self.make_ops('a'), chunk_size=1,
+            max_chunk_bytes=mock.ANY, raise_on_error=False,
+            raise_on_exception=False, yield_ok=True)
+
+    def test_overflow(self, bulk_mock):
+        bulk_mock.side_effect = fake_streaming_bulk
+        self.aggregator._delay = 0.01
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+            self.aggregator.bulk(self.make_ops('a', 'b', 'c'), 30)))
+        first.start()
+        while self.aggregator._pending is None:
+            pass
+        # The pending request is sent without the operations that do not fit
+        self.assertEqual((3, []), self.aggregator.bulk(
+            self.make_ops('d', 'e', 'f'), 30))
+        first.join()
+        self.assertEqual([(3, [])], results)
+        self.assertEqual(
+            [self.make_ops('a', 'b', 'c'), self.make_ops('d', 'e', 'f')],
+            [call[1][1] for call in bulk_mock.mock_calls])
+
+    def test_rejected(self, bulk_mock):
+        bulk_mock.return_value = iter([
+            (False, {'index': {'_id': 'a', 'status': 429}})])
+        self.aggregator._delay = 0
+        with mock.patch.object(self.sizer, 'record') as record_mock:
+            success, failures = self.aggregator.bulk(self.make_ops('a'), 10)
+        self.assertEqual(0, success)
+        record_mock.assert_called_once_with(mock.ANY, True)
+
+    def test_error(self, bulk_mock):
+        bulk_mock.side_effect = elasticsearch.SerializationError('failed')
+        self.aggregator._delay = 0
+        with self.assertRaises(elasticsearch.SerializationError):
+            self.aggregator.bulk(self.make_ops('a'), 10)
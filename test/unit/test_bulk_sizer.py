@@ -0,0 +1,106 @@
+import json
+import unittest
+
+from swift_metadata_sync.bulk_sizer import BulkSizer
+
+
+class TestBulkSizer(unittest.TestCase):
+    def make_action(self, doc_id, size=0):
+        return {'_op_type': 'index', '_id': doc_id, '_index': 'index',
+                '_source': {'data': 'x' * size}}
+
+    def test_action_size(self):
+        action = self.make_action('foo', 100)
+        self.assertEqual(
+            len(json.dumps({'_op_type': 'index', '_id': 'foo',
+                            '_index': 'index'})) +
+            len(json.dumps(action['_source'])) + 2,
+            BulkSizer.action_size(action))
+        delete = {'_op_type': 'delete', '_id': 'foo', '_index': 'index'}
+        self.assertEqual(len(json.dumps(delete)) + 1,
+                         BulkSizer.action_size(delete))
+
+    def test_chunks_by_docs(self):
+        sizer = BulkSizer(max_docs=3, min_docs=1)
+        actions = [self.make_action(str(i)) for i in range(7)]
+        chunks = [chunk for chunk, _ in sizer.chunks(iter(actions))]
+        self.assertEqual([actions[0:3], actions[3:6], actions[6:]], chunks)
+
+    def test_chunks_by_bytes(self):
+        action_size = BulkSizer.action_size(self.make_action('0', 1000))
+        sizer = BulkSizer(max_bytes=action_size * 2 + 1, min_bytes=1)
+        actions = [self.make_action(str(i), 1000) for i in range(5)]
+        chunks = list(sizer.chunks(actions))
+        self.assertEqual([actions[0:2], actions[2:4], actions[4:]],
+                         [chunk for chunk, _ in chunks])
+        self.assertEqual([action_size * 2, action_size * 2, action_size],
+                         [chunk_bytes for _, chunk_bytes in chunks])
+
+    def test_chunks_oversized_action(self):
+        sizer = BulkSizer(max_bytes=10, min_bytes=1)
+        actions = [self.make_action(str(i), 100) for i in range(2)]
+        self.assertEqual([[actions[0]], [actions[1]]],
+                         [chunk for chunk, _ in sizer.chunks(actions)])
+
+    def test_chunks_follow_limits(self):
+        sizer = BulkSizer(max_docs=4, min_docs=2, target_latency=1.0)
+        actions = [self.make_action(str(i)) for i in range(6)]
+        chunks = sizer.chunks(actions)
+        self.assertEqual(actions[0:4], next(chunks)[0])
+        sizer.record(0.1, True)
+        self.assertEqual(actions[4:6], next(chunks)[0])
+
+    def test_shrink_on_rejection(self):
+        sizer = BulkSizer(max_docs=100, min_docs=10, max_bytes=1000,
+                          min_bytes=100)
+        sizer.record(0.1, True)
+        self.assertEqual((50, 500), sizer.limits())
+        for _ in range(5):
+            sizer.record(0.1, True)
+        self.assertEqual((10, 100), sizer.limits())
+        self.assertEqual({'docs': 10, 'bytes': 100, 'shrinks': 4,
+                          'grows': 0}, sizer.stats())
+
+    def test_shrink_on_latency(self):
+        sizer = BulkSizer(max_docs=100, max_bytes=1000, min_bytes=100,
+                          target_latency=2.0)
+        sizer.record(2.0, False)
+        self.assertEqual((100, 1000), sizer.limits())
+        sizer.record(2.5, False)
+        self.assertEqual((50, 500), sizer.limits())
+        # Between half and the full target latency the size is kept
+        sizer.record(1.5, False)
+        self.assertEqual((50, 500), sizer.limits())
+
+    def test_grow_when_healthy(self):
+        sizer = BulkSizer(max_docs=100, min_docs=1, max_bytes=1000,
+                          min_bytes=100, target_latency=2.0)
+        for _ in range(7):
+            sizer.record(0.1, True)
+        self.assertEqual((1, 100), sizer.limits())
+        sizer.record(1.0, False)
+        self.assertEqual((2, 125), sizer.limits())
+        for _ in range(30):
+            sizer.record(0.1, False)
+        self.assertEqual((100, 1000), sizer.limits())
+        stats = sizer.stats()
+        self.assertEqual(6, stats['shrinks'])
+        self.assertEqual(20, stats['grows'])
+
+    def test_is_rejected(self):
+        self.assertTrue(BulkSizer.is_rejected({'status': 429}))
+        self.assertTrue(BulkSizer.is_rejected(
+            {'status': 503,
+             'error': {'type': 'es_rejected_execution_exception'}}))
+        self.assertFalse(BulkSizer.is_rejected(
+            {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}))
+        self.assertFalse(BulkSizer.is_rejected(
+            {'status': 500, 'exception': 'blow up!'}))
+
+    def test_invalid_limits(self):
+        with self.assertRaises(RuntimeError):
+            BulkSizer(max_docs=10, min_docs=20)
+        with self.assertRaises(RuntimeError):
+            BulkSizer(min_docs=0)
+        with self.assertRaises(RuntimeError):
+            BulkSizer(max_bytes=10, min_bytes=20)
@@ -0,0 +1,123 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync.dead_letters import DeadLetterQueue, find_queues
+
+
+class TestDeadLetterQueue(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(
+            self.tempdir, 'account', '.container' + DeadLetterQueue.SUFFIX)
+        self.queue = DeadLetterQueue(self.path, backoff=10, max_backoff=35)
+        self.row = {'ROWID': 1, 'name': 'foo', 'deleted': 0,
+                    'created_at': '1000000.00000'}
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tempdir)
+
+    @mock.patch('swift_metadata_sync.dead_letters.random')
+    def test_add_and_get_due(self, random_mock):
+        random_mock.uniform.side_effect = lambda low, high: high
+        self.queue.open(u'account', u'container', u'index')
+        self.assertTrue(os.path.exists(self.path))
+        self.queue.add([('doc-foo', self.row, 'failed')], now=100)
+        self.assertEqual([], self.queue.get_due(10, now=109))
+        self.assertEqual([('doc-foo', self.row)],
+                         self.queue.get_due(10, now=110))
+        self.assertEqual(str, type(self.queue.get_due(10, now=110)[0][1][
+            'name']))
+
+        self.queue.add([('doc-foo', self.row, 'failed again')], now=110)
+        self.queue.add([('doc-foo', self.row, 'failed again')], now=130)
+        self.queue.add([('doc-foo', self.row, 'failed again')], now=170)
+        self.assertEqual([{'doc_id': 'doc-foo',
+                           'row': self.row,
+                           'error': 'failed again',
+                           'attempts': 4,
+                           'failed_at': 100,
+                           'retry_at': 205}], self.queue.list())
+
+    @mock.patch('swift_metadata_sync.dead_letters.random')
+    def test_is_empty_and_has_due(self, random_mock):
+        random_mock.uniform.side_effect = lambda low, high: high
+        self.queue.open(u'account', u'container', u'index')
+        self.assertTrue(self.queue.is_empty())
+        self.assertFalse(self.queue.has_due(now=1000))
+        self.queue.add([('doc-foo', self.row, 'failed')], now=100)
+        self.assertFalse(self.queue.is_empty())
+        self.assertFalse(self.queue.has_due(now=109))
+        self.assertTrue(self.queue.has_due(now=110))
+
+    def test_add_new_row(self):
+        self.queue.open(u'account', u'container', u'index')
+        self.queue.add([('doc-foo', self.row, 'failed')], now=100)
+        self.queue.add([('doc-foo', self.row, 'failed')], now=200)
+        new_row = dict(self.row, ROWID=2)
+        self.queue.add([('doc-foo', new_row, 'failed')], now=300)
+        entries = self.queue.list()
+        self.assertEqual(1, len(entries))
+        self.assertEqual(new_row, entries[0]['row'])
+        self.assertEqual(1, entries[0]['attempts'])
+        self.assertEqual(300, entries[0]['failed_at'])
+
+    def test_get_due_order_and_limit(self):
+        self.queue.open(u'account', u'container', u'index')
+        for i in range(5):
+            self.queue.add([('doc-%d' % i, dict(self.row, ROWID=i), 'failed')],
+                           now=100 - i * 10)
+        self.assertEqual(['doc-4', 'doc-3'],
+                         [doc_id for doc_id, _ in self.queue.get_due(
+                             2, now=1000)])
+
+    def test_remove(self):
+        self.queue.open(u'account', u'container', u'index')
+        self.queue.add([('doc-foo', self.row, 'failed'),
+                        ('doc-bar', self.row, 'failed')])
+        self.queue.remove(['doc-foo', 'doc-baz'])
+        self.assertEqual(['doc-bar'],
+                         [entry['doc_id'] for entry in self.queue.list()])
+
+    def test_replay(self):
+        self.queue.open(u'account', u'container', u'index')
+        self.queue.add([('doc-foo', self.row, 'failed'),
+                        ('doc-bar', self.row, 'failed')], now=100)
+        self.assertEqual([], self.queue.get_due(10, now=100))
+        self.assertEqual(1, self.queue.replay(['doc-foo', 'doc-baz']))
+        self.assertEqual(['doc-foo'],
+                         [doc_id for doc_id, _ in self.queue.get_due(
+                             10, now=100)])
+        self.assertEqual(2, self.queue.replay())
+        self.assertEqual(2, len(self.queue.get_due(10, now=100)))
+
+    def test_index_change(self):
+        self.queue.open(u'account', u'container', u'index')
+        self.queue.add([('doc-foo', self.row, 'failed')])
+        self.queue.close()
+
+        self.queue.open(u'account', u'container', u'index')
+        self.assertEqual(1, len(self.queue.list()))
+        self.queue.open(u'account', u'container', u'new-index')
+        self.assertEqual([], self.queue.list())
+        self.assertEqual((u'account', u'container', u'new-index'),
+                         self.queue.identity)
+
+    def test_find_queues(self):
+        self.queue.open(u'account', u'container', u'index')
+        other = DeadLetterQueue(os.path.join(
+            self.tempdir, '.other' + DeadLetterQueue.SUFFIX))
+        other.open(u'account', u'other', u'index')
+        other.close()
+        open(os.path.join(self.tempdir, 'account', 'container'), 'w').close()
+
+        queues = list(find_queues(self.tempdir))
+        self.assertEqual(
+            [(u'account', u'other', u'index'),
+             (u'account', u'container', u'index')],
+            [queue.identity for queue in queues])
+        for queue in queues:
+            queue.close()
@@ -0,0 +1,121 @@
+import mock
+import unittest
+
+from swift_metadata_sync.fan_out import (
+    FanOutSync, SharedMetadata, get_targets)
+
+
+class TestGetTargets(unittest.TestCase):
+    def setUp(self):
+        self.mapping = {'account': u'AUTH_test',
+                        'container': u'test',
+                        'es_hosts': 'primary.example.com',
+                        'parse_json': True}
+
+    def test_no_targets(self):
+        settings = dict(self.mapping, index='index')
+        self.assertEqual([('index', None, settings)], get_targets(settings))
+
+    def test_targets(self):
+        self.mapping['targets'] = [
+            {'index': 'index'},
+            {'index': 'index', 'es_hosts': 'dr.example.com', 'name': 'dr',
+             'pipeline': 'dr-pipeline'}]
+        self.assertEqual([
+            ('index', None, {'account': u'AUTH_test',
+                             'container': u'test',
+                             'es_hosts': 'primary.example.com',
+                             'parse_json': True,
+                             'index': 'index'}),
+            ('dr', 'dr', {'account': u'AUTH_test',
+                          'container': u'test',
+                          'es_hosts': 'dr.example.com',
+                          'parse_json': True,
+                          'index': 'index',
+                          'pipeline': 'dr-pipeline'})],
+            get_targets(self.mapping))
+
+    def test_invalid_targets(self):
+        for targets in ([],
+                        [{'es_hosts': 'dr.example.com'}],
+                        [{'index': 'index'}, {'index': 'index'}]):
+            with self.assertRaises(RuntimeError):
+                get_targets(dict(self.mapping, targets=targets))
+
+
+class TestSharedMetadata(unittest.TestCase):
+    def test_get_object_metadata(self):
+        client = mock.Mock()
+        client.get_object_metadata.side_effect = lambda *args, **kwargs: {
+            'x-timestamp': '1000.00000', 'args': args, 'kwargs': kwargs}
+        shared = SharedMetadata(client)
+        meta = shared.get_object_metadata(
+            'account', 'container', 'object', headers={'X-Newest': True})
+        self.assertIs(meta, shared.get_object_metadata(
+            'account', 'container', 'object', headers={'X-Newest': True}))
+        self.assertIsNot(meta, shared.get_object_metadata(
+            'account', 'container', 'object', headers={}))
+        self.assertEqual(2, client.get_object_metadata.call_count)
+
+    def test_get_es_doc(self):
+        shared = SharedMetadata(mock.Mock())
+        build_doc = mock.Mock(side_effect=lambda: {'x-timestamp': 1})
+        doc = shared.get_es_doc(('object', '1.00000', False), build_doc)
+        self.assertIs(doc, shared.get_es_doc(('object', '1.00000', False),
+                                             build_doc))
+        build_doc.assert_called_once_with()
+
+
+class TestFanOutSync(unittest.TestCase):
+    def setUp(self):
+        self.syncs = [('primary', mock.Mock()), ('dr', mock.Mock())]
+        self.settings = {'account': u'AUTH_test', 'container': u'test',
+                         'targets': [{'index': 'primary'},
+                                     {'index': 'dr'}]}
+        self.sync = FanOutSync('/status/dir', self.settings, self.syncs)
+
+    def test_rows(self):
+        self.syncs[0][1].get_last_processed_row.return_value = 100
+        self.syncs[1][1].get_last_processed_row.return_value = 20
+        self.syncs[0][1].get_last_verified_row.return_value = 50
+        self.syncs[1][1].get_last_verified_row.return_value = 10
+        self.assertEqual(20, self.sync.get_last_processed_row('db-id'))
+        self.assertEqual(10, self.sync.get_last_verified_row('db-id'))
+
+        # The targets that are ahead keep their progress
+        self.sync.save_last_processed_row(60, 'db-id')
+        self.syncs[0][1].save_last_processed_row.assert_not_called()
+        self.syncs[1][1].save_last_processed_row.assert_called_once_with(
+            60, 'db-id')
+        self.sync.save_last_verified_row(60, 'db-id')
+        self.syncs[0][1].save_last_verified_row.assert_called_once_with(
+            60, 'db-id')
+        self.syncs[1][1].save_last_verified_row.assert_called_once_with(
+            60, 'db-id')
+
+    def test_handle(self):
+        self.syncs[0][1].get_last_processed_row.return_value = 10
+        self.syncs[1][1].get_last_processed_row.return_value = 0
+        self.syncs[0][1].get_last_verified_row.return_value = 5
+        self.syncs[1][1].get_last_verified_row.return_value = 0
+        self.sync.get_last_processed_row('db-id')
+        self.sync.get_last_verified_row('db-id')
+        rows = [{'ROWID': i, 'name': 'object-%d' % i} for i in range(1, 11)]
+        client = mock.Mock()
+
+        self.sync.handle(rows, client)
+
+        # The targets skip the rows they have verified
+        self.syncs[0][1].handle.assert_called_once_with(rows[5:], mock.ANY)
+        self.syncs[1][1].handle.assert_called_once_with(rows, mock.ANY)
+        shared = self.syncs[0][1].handle.mock_calls[0][1][1]
+        self.assertIsInstance(shared, SharedMetadata)
+        self.assertIs(shared, self.syncs[1][1].handle.mock_calls[0][1][1])
+
+    def test_handle_failure(self):
+        self.syncs[0][1].handle.side_effect = RuntimeError('failed')
+        rows = [{'ROWID': 1, 'name': 'object'}]
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        # The other targets still handle the rows
+        self.syncs[1][1].handle.assert_called_once_with(rows, mock.ANY)
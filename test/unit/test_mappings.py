@@ -0,0 +1,26 @@
+import unittest
+
+from swift_metadata_sync.mappings import find_mappings
+
+
+class TestFindMappings(unittest.TestCase):
+    def test_find_mappings(self):
+        mappings = [
+            {'account': u'AUTH_test', 'container': u'container',
+             'index': 'container-index'},
+            {'account': u'AUTH_test', 'container': u'/*',
+             'index': 'account-index'},
+            {'account': u'AUTH_other', 'container': u'container',
+             'index': 'other-index'}]
+        conf = {'containers': mappings}
+        self.assertEqual(
+            [(mappings[0], False),
+             ({'account': u'AUTH_test', 'container': u'container',
+               'index': 'account-index'}, True)],
+            find_mappings(conf, u'AUTH_test', u'container'))
+        self.assertEqual(
+            [({'account': u'AUTH_test', 'container': u'other',
+               'index': 'account-index'}, True)],
+            find_mappings(conf, u'AUTH_test', u'other'))
+        self.assertEqual([], find_mappings(conf, u'AUTH_unknown', u'other'))
+        self.assertEqual([], find_mappings({}, u'AUTH_test', u'container'))
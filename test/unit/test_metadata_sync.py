@@ -1,10 +1,42 @@
+import elasticsearch
 import email
+import eventlet
+import gc
 import hashlib
 import json
 import mock
+import shutil
+import tempfile
 import unittest
+from distutils.version import StrictVersion
 
+from swift.common.internal_client import UnexpectedResponse
 from swift_metadata_sync import metadata_sync
+from swift_metadata_sync.bulk_sizer import BulkSizer
+from swift_metadata_sync.status import (
+    CachedStatusStore, CheckpointCache, JSONStatusStore, SQLiteStatusStore)
+
+
+def live_greenthreads():
+    return [obj for obj in gc.get_objects()
+            if isinstance(obj, eventlet.greenthread.GreenThread) and
+            not obj.dead]
+
+
+class FakeBulk(object):
+    """
+        Stands in for elasticsearch.helpers.bulk(), consuming the (possibly
+        generated) actions and recording them as lists.
+    """
+    def __init__(self, *results):
+        self.results = list(results) or [(0, [])]
+        self.actions = []
+
+    def __call__(self, client, actions, **kwargs):
+        self.actions.append(list(actions))
+        if len(self.results) > 1:
+            return self.results.pop(0)
+        return self.results[0]
 
 
 class TestMetadataSync(unittest.TestCase):
@@ -69,6 +101,13 @@ class TestMetadataSync(unittest.TestCase):
     def test_default_parameters(self):
         self.assertFalse(self.sync._parse_json)
         self.assertEqual(None, self.sync._pipeline)
+        self.assertEqual(1, self.sync._head_concurrency)
+        self.assertFalse(self.sync._adaptive_newest)
+        self.assertFalse(self.sync._row_only)
+        self.assertFalse(self.sync._external_versioning)
+        self.assertFalse(self.sync._fast_verify)
+        self.assertIsNone(self.sync._timestamp_index)
+        self.assertIsNone(self.sync._dead_letters)
 
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
@@ -244,6 +283,172 @@ class TestMetadataSync(unittest.TestCase):
             42, status['id'][metadata_sync.MetadataSync.VERIFIED_ROW])
         self.assertEqual(self.test_index, status['id']['index'])
 
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_status_backend(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf,
+                                          status_backend='sqlite')
+        self.assertIsInstance(sync._status_store, SQLiteStatusStore)
+        self.assertIsInstance(sync._status_store._legacy_store,
+                              JSONStatusStore)
+        self.assertIsInstance(self.sync._status_store, JSONStatusStore)
+
+        with self.assertRaises(RuntimeError):
+            metadata_sync.MetadataSync(self.status_dir, self.sync_conf,
+                                       status_backend='bogus')
+
+    def test_save_row_status_store(self):
+        self.sync._status_store = mock.Mock()
+        self.sync.save_last_verified_row(42, 'db-id')
+        self.sync._status_store.update.assert_called_once_with(
+            'db-id', mock.ANY)
+        update_fn = self.sync._status_store.update.mock_calls[0][1][1]
+        self.assertEqual(
+            {'index': self.test_index, 'last_row': 0,
+             'last_verified_row': 42},
+            update_fn(None))
+        self.assertEqual(
+            {'index': self.test_index, 'last_row': 30,
+             'last_verified_row': 42},
+            update_fn({'index': self.test_index, 'last_row': 30}))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time')
+    def test_save_processed_row_rate(self, time_mock):
+        self.sync._status_store = mock.Mock()
+        self.sync.save_last_processed_row(42, 'db-id')
+        update_fn = self.sync._status_store.update.mock_calls[0][1][1]
+
+        time_mock.time.return_value = 1000
+        entry = update_fn(None)
+        self.assertEqual(
+            {'index': self.test_index, 'last_row': 42,
+             'last_verified_row': 0, 'last_row_time': 1000}, entry)
+
+        # The rate is measured over the time spent handling the rows, not
+        # the time since the last update
+        self.sync._active_seconds = 10
+        self.sync.save_last_processed_row(92, 'db-id')
+        self.assertEqual(0, self.sync._active_seconds)
+        update_fn = self.sync._status_store.update.mock_calls[1][1][1]
+        time_mock.time.return_value = 5000
+        entry = update_fn(entry)
+        self.assertEqual(92, entry['last_row'])
+        self.assertEqual(5000, entry['last_row_time'])
+        self.assertEqual(5.0, entry['rows_per_second'])
+
+        # The rate is a moving average of the recent rates
+        self.sync._active_seconds = 10
+        self.sync.save_last_processed_row(192, 'db-id')
+        update_fn = self.sync._status_store.update.mock_calls[2][1][1]
+        time_mock.time.return_value = 9000
+        self.assertEqual(6.5, update_fn(entry)['rows_per_second'])
+        # A reset of the processed rows drops the rate
+        self.assertNotIn('rows_per_second',
+                         update_fn(dict(entry, last_row=200)))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time')
+    def test_handle_active_seconds(self, time_mock):
+        self.sync._last_processed_row = 5
+        time_mock.time.side_effect = [100, 102, 200]
+        with mock.patch.object(self.sync, '_process_rows') as process_mock:
+            process_mock.return_value = []
+            self.sync.handle([{'ROWID': 6, 'name': 'new'}], mock.Mock())
+            # The verification of the processed rows is left out
+            self.sync.handle([{'ROWID': 5, 'name': 'old'}], mock.Mock())
+        self.assertEqual(2, self.sync._active_seconds)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time')
+    def test_save_backfill_row(self, time_mock):
+        time_mock.time.return_value = 1000
+        self.sync._status_store = mock.Mock()
+        self.sync.save_backfill_row(42, 'db-id')
+        update_fn = self.sync._status_store.update.mock_calls[0][1][1]
+        entry = update_fn({'index': self.test_index, 'last_row': 0,
+                           'last_verified_row': 0})
+        self.assertEqual(
+            {'index': self.test_index, 'last_row': 42,
+             'last_verified_row': 42, 'last_row_time': 1000,
+             'backfill': True}, entry)
+
+        self.sync._status_store.get.return_value = entry
+        self.assertTrue(self.sync.is_backfill('db-id'))
+        self.sync._status_store.get.return_value = dict(
+            entry, index='other-index')
+        self.assertFalse(self.sync.is_backfill('db-id'))
+
+        self.sync.save_backfill_row(92, 'db-id', done=True)
+        update_fn = self.sync._status_store.update.mock_calls[1][1][1]
+        entry = update_fn(entry)
+        self.assertEqual(92, entry['last_row'])
+        self.assertEqual(92, entry['last_verified_row'])
+        self.assertNotIn('backfill', entry)
+
+        # The incremental sync clears the mark as well
+        self.sync._status_store.update.reset_mock()
+        self.sync.save_last_processed_row(42, 'db-id')
+        update_fn = self.sync._status_store.update.mock_calls[0][1][1]
+        self.assertNotIn('backfill', update_fn(
+            {'index': self.test_index, 'last_row': 0, 'backfill': True}))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.BackfillLock.is_held')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_during_backfill(self, helpers_mock, is_held_mock):
+        is_held_mock.return_value = True
+        rows = [{'name': 'object', 'deleted': True, 'created_at': 0}]
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        is_held_mock.assert_called_once_with(self.sync._backfill_lock_path)
+        helpers_mock.bulk.assert_not_called()
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_backfill_checkpoint_cache(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        cache = CheckpointCache(
+            flush_rows=100000,
+            row_fields=(metadata_sync.MetadataSync.PROCESSED_ROW,
+                        metadata_sync.MetadataSync.VERIFIED_ROW))
+        sync = metadata_sync.MetadataSync(status_dir, self.sync_conf,
+                                          checkpoint_cache=cache)
+        backfill_sync = metadata_sync.MetadataSync(status_dir, self.sync_conf)
+
+        # The daemon's checkpoint is not flushed when the backfill starts
+        sync.save_last_processed_row(12000, 'db-id')
+        backfill_sync.save_backfill_row(5000000, 'db-id', done=True)
+        cache.flush()
+        self.assertEqual(5000000,
+                         backfill_sync.get_last_processed_row('db-id'))
+        self.assertEqual(5000000, sync.get_last_processed_row('db-id'))
+        self.assertFalse(sync.is_backfill('db-id'))
+
+        sync.save_last_processed_row(5000100, 'db-id')
+        cache.flush()
+        self.assertEqual(5000100,
+                         backfill_sync.get_last_processed_row('db-id'))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_profiler(self, helpers_mock):
+        rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
+        helpers_mock.bulk.return_value = (None, [])
+        self.sync._profiler = mock.Mock()
+        self.sync._profiler.runcall.side_effect = \
+            lambda func, *args: func(*args)
+        swift_mock = mock.Mock()
+
+        self.sync.handle(rows, swift_mock)
+        self.sync._profiler.runcall.assert_called_once_with(
+            self.sync._handle, rows, swift_mock)
+        self.assertEqual(1, helpers_mock.bulk.call_count)
+
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete(self, helpers_mock):
         rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
@@ -259,7 +464,9 @@ class TestMetadataSync(unittest.TestCase):
         helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
                                                   expected_delete_ops,
                                                   raise_on_error=False,
-                                                  raise_on_exception=False)
+                                                  raise_on_exception=False,
+                                                  chunk_size=10,
+                                                  max_chunk_bytes=mock.ANY)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete_errors(self, helpers_mock):
@@ -281,7 +488,9 @@ class TestMetadataSync(unittest.TestCase):
         helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
                                                   expected_delete_ops,
                                                   raise_on_error=False,
-                                                  raise_on_exception=False)
+                                                  raise_on_exception=False,
+                                                  chunk_size=10,
+                                                  max_chunk_bytes=mock.ANY)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete_skip_404(self, helpers_mock):
@@ -301,7 +510,9 @@ class TestMetadataSync(unittest.TestCase):
         helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
                                                   expected_delete_ops,
                                                   raise_on_error=False,
-                                                  raise_on_exception=False)
+                                                  raise_on_exception=False,
+                                                  chunk_size=10,
+                                                  max_chunk_bytes=mock.ANY)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_update_and_new_docs(self, helpers_mock):
@@ -327,7 +538,8 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
 
         self.sync.handle(rows, swift_mock)
 
@@ -348,8 +560,10 @@ class TestMetadataSync(unittest.TestCase):
             }
         } for i in range(1, 10, 2)]
         helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            self.sync._es_conn, mock.ANY, raise_on_error=False,
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual([expected_ops], fake_bulk.actions)
         self.sync._es_conn.mget.assert_called_once_with(
             body=mock.ANY,
             index=self.test_index,
@@ -385,7 +599,8 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
 
         self.sync.handle(rows, swift_mock)
 
@@ -406,8 +621,10 @@ class TestMetadataSync(unittest.TestCase):
             }
         }]
         helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            self.sync._es_conn, mock.ANY, raise_on_error=False,
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual([expected_ops], fake_bulk.actions)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
@@ -436,7 +653,8 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
 
         self.sync.handle(rows, swift_mock)
 
@@ -456,8 +674,10 @@ class TestMetadataSync(unittest.TestCase):
             }
         }]
         helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            self.sync._es_conn, mock.ANY, raise_on_error=False,
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual([expected_ops], fake_bulk.actions)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
@@ -466,6 +686,853 @@ class TestMetadataSync(unittest.TestCase):
             refresh=True,
             _source=['x-timestamp'])
 
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_concurrent_heads(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            object_id = int(key.split('_')[1])
+            # Make the earlier objects complete last
+            eventlet.sleep(0.001 * (10 - object_id))
+            return {'x-timestamp': object_id,
+                    'last-modified': email.utils.formatdate(object_id)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(10)]
+        es_docs = {'docs': [{
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
+            'found': False} for i in xrange(10)]}
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = es_docs
+        self.sync._head_concurrency = 4
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        self.assertEqual(10, swift_mock.get_object_metadata.call_count)
+        ops = fake_bulk.actions[0]
+        self.assertEqual([doc['_id'] for doc in es_docs['docs']],
+                         [op['_id'] for op in ops])
+        self.assertEqual(['object_%d' % i for i in xrange(10)],
+                         [op['_source']['x-swift-object'] for op in ops])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_concurrent_heads_error(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            if key == 'object_3':
+                raise RuntimeError('HEAD failed')
+            return {'x-timestamp': 0,
+                    'last-modified': email.utils.formatdate(0)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(10)]
+        es_docs = {'docs': [{
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
+            'found': False} for i in xrange(10)]}
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = es_docs
+        self.sync._head_concurrency = 4
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        threads = live_greenthreads()
+        with self.assertRaises(RuntimeError) as ctx:
+            self.sync.handle(rows, swift_mock)
+        self.assertEqual('HEAD failed', ctx.exception.message)
+        self.assertEqual([], fake_bulk.actions)
+        # The HEAD requests still in flight are not left behind
+        self.assertEqual(threads, live_greenthreads())
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_concurrent_heads_stopped(self, helpers_mock):
+        heads = []
+
+        def fake_object_meta(account, container, key, headers={}):
+            heads.append(key)
+            eventlet.sleep(0.001)
+            return {'x-timestamp': 0,
+                    'last-modified': email.utils.formatdate(0)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(10)]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [{
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
+            'found': False} for i in xrange(10)]}
+        self.sync._head_concurrency = 4
+        self.sync._bulk_sizer = BulkSizer(max_docs=2, min_docs=2)
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        helpers_mock.bulk.side_effect = elasticsearch.ConnectionError(
+            'bulk failed')
+
+        threads = live_greenthreads()
+        with self.assertRaises(elasticsearch.ConnectionError):
+            self.sync.handle(rows, swift_mock)
+        self.assertEqual(threads, live_greenthreads())
+        eventlet.sleep(0.01)
+        # The remaining rows are not fetched once the bulk request fails
+        self.assertLess(len(heads), 10)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_adaptive_newest(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            object_id = int(key.split('_')[1])
+            if headers.get('X-Newest'):
+                return {'x-timestamp': 1000000,
+                        'last-modified': email.utils.formatdate(1000000)}
+            if object_id == 2:
+                raise UnexpectedResponse('404 Not Found', mock.Mock())
+            # Odd objects are stale on the first replica
+            x_timestamp = 1000000 - object_id % 2
+            return {'x-timestamp': x_timestamp,
+                    'last-modified': email.utils.formatdate(x_timestamp)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(4)]
+        es_docs = {'docs': [{
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
+            'found': False} for i in xrange(4)]}
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = es_docs
+        self.sync._adaptive_newest = True
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        self.assertEqual([
+            mock.call(self.test_account, self.test_container, 'object_0',
+                      headers={}),
+            mock.call(self.test_account, self.test_container, 'object_1',
+                      headers={}),
+            mock.call(self.test_account, self.test_container, 'object_1',
+                      headers={'X-Newest': True}),
+            mock.call(self.test_account, self.test_container, 'object_2',
+                      headers={}),
+            mock.call(self.test_account, self.test_container, 'object_2',
+                      headers={'X-Newest': True}),
+            mock.call(self.test_account, self.test_container, 'object_3',
+                      headers={}),
+            mock.call(self.test_account, self.test_container, 'object_3',
+                      headers={'X-Newest': True})],
+            swift_mock.get_object_metadata.mock_calls)
+        self.assertEqual({'head': 4, 'newest_fallback': 3},
+                         self.sync.head_stats)
+        labels = {'account': self.test_account,
+                  'container': self.test_container,
+                  'index': self.test_index}
+        self.assertEqual(4, self.sync._metrics.get(
+            'head_requests_total', dict(labels, type='head')))
+        self.assertEqual(3, self.sync._metrics.get(
+            'head_requests_total', dict(labels, type='newest_fallback')))
+        ops = fake_bulk.actions[0]
+        self.assertEqual([1000000 * 1000] * 4,
+                         [op['_source']['x-timestamp'] for op in ops])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_row_only(self, helpers_mock):
+        rows = [{'name': 'object',
+                 'deleted': False,
+                 'created_at': '1000000.12345',
+                 'size': 42,
+                 'content_type': 'application/x-fake',
+                 'etag': 'deadbeef'},
+                {'name': u'slo\xb0'.encode('utf-8'),
+                 'deleted': False,
+                 'created_at': '1000000.00000',
+                 'size': 100,
+                 'content_type': 'application/x-fake;swift_bytes=4096',
+                 'etag': 'manifest-etag; slo_etag=slo-etag'}]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        es_docs = {'docs': [{'_id': doc_id, 'found': False}
+                            for doc_id in doc_ids]}
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = es_docs
+        self.sync._row_only = True
+        swift_mock = mock.Mock()
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        swift_mock.get_object_metadata.assert_not_called()
+        expected_ops = [{
+            '_op_type': 'index',
+            '_index': self.test_index,
+            '_id': doc_ids[0],
+            '_source': {
+                'content-length': 42,
+                'content-type': 'application/x-fake',
+                'etag': '"deadbeef"',
+                'last-modified': 1000001 * 1000,
+                'x-swift-account': self.test_account,
+                'x-swift-container': self.test_container,
+                'x-swift-object': 'object',
+                'x-timestamp': 1000000123,
+            }
+        }, {
+            '_op_type': 'index',
+            '_index': self.test_index,
+            '_id': doc_ids[1],
+            '_source': {
+                'content-length': 4096,
+                'content-type': 'application/x-fake',
+                'etag': '"slo-etag"',
+                'last-modified': 1000000 * 1000,
+                'x-static-large-object': 'true',
+                'x-swift-account': self.test_account,
+                'x-swift-container': self.test_container,
+                'x-swift-object': u'slo\xb0',
+                'x-timestamp': 1000000 * 1000,
+            }
+        }]
+        helpers_mock.bulk.assert_called_once_with(
+            self.sync._es_conn, mock.ANY, raise_on_error=False,
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual([expected_ops], fake_bulk.actions)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_external_versioning(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            return {'x-timestamp': '1000000.12345',
+                    'last-modified': email.utils.formatdate(1000001)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i % 2 == 0,
+                 'created_at': '1000000.12345'} for i in xrange(4)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._external_versioning = True
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        conflict = {'type': 'version_conflict_engine_exception'}
+        fake_bulk = FakeBulk(
+            (0, [{'delete': {'_id': doc_ids[0], 'status': 409,
+                             'error': conflict}}]),
+            (1, [{'index': {'_id': doc_ids[3], 'status': 409,
+                            'error': conflict}}]))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        self.sync._es_conn.mget.assert_not_called()
+        self.assertEqual([
+            [{'_op_type': 'delete',
+              '_id': doc_ids[i],
+              '_index': self.test_index,
+              'version': 1000000123,
+              'version_type': 'external'} for i in (0, 2)],
+            [{'_op_type': 'index',
+              '_id': doc_ids[i],
+              '_index': self.test_index,
+              '_source': {
+                  'last-modified': 1000001 * 1000,
+                  'x-swift-account': self.test_account,
+                  'x-swift-container': self.test_container,
+                  'x-swift-object': 'object_%d' % i,
+                  'x-timestamp': 1000000123},
+              'version': 1000000123,
+              'version_type': 'external'} for i in (1, 3)]],
+            fake_bulk.actions)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_backfill(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            return {'x-timestamp': '1000000.12345',
+                    'last-modified': email.utils.formatdate(1000001)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i == 0,
+                 'created_at': '1000000.12345'} for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk((1, []), (2, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.backfill(rows, swift_mock)
+
+        # The deletes are still sent, but the index is not queried
+        self.sync._es_conn.mget.assert_not_called()
+        self.assertEqual(2, len(fake_bulk.actions))
+        self.assertEqual([doc_ids[0]],
+                         [op['_id'] for op in fake_bulk.actions[0]])
+        self.assertEqual(doc_ids[1:],
+                         [op['_id'] for op in fake_bulk.actions[1]])
+        self.assertEqual(2, swift_mock.get_object_metadata.call_count)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_fast_verify(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            return {'x-timestamp': '2000000.12345',
+                    'last-modified': email.utils.formatdate(2000001)}
+
+        # Fresh, out of date, and missing documents, and deleted rows whose
+        # documents are missing and still indexed
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': i >= 3,
+                 'created_at': '2000000.12345'} for i in xrange(5)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.search.return_value = {'hits': {'hits': [
+            {'_id': doc_ids[0], 'fields': {'x-timestamp': ['2000000123']}},
+            {'_id': doc_ids[1], 'fields': {'x-timestamp': ['1000000123']}},
+            {'_id': doc_ids[4], 'fields': {'x-timestamp': ['1000000123']}},
+        ]}}
+        self.sync._fast_verify = True
+        self.sync._last_processed_row = 5
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk((1, []), (2, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        self.sync._es_conn.mget.assert_not_called()
+        self.sync._es_conn.search.assert_called_once_with(
+            index=self.test_index,
+            body={'query': {'ids': {'values': doc_ids}},
+                  'size': 5,
+                  '_source': False,
+                  'docvalue_fields': [
+                      {'field': 'x-timestamp', 'format': 'epoch_millis'}]})
+        self.assertEqual([doc_ids[4]],
+                         [op['_id'] for op in fake_bulk.actions[0]])
+        self.assertEqual(doc_ids[1:3],
+                         [op['_id'] for op in fake_bulk.actions[1]])
+        self.assertEqual(
+            ['object_1', 'object_2'],
+            [call[1][2] for call in
+             swift_mock.get_object_metadata.mock_calls])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_fast_verify_new_rows(self, helpers_mock):
+        rows = [{'ROWID': 10, 'name': 'object', 'deleted': False,
+                 'created_at': '2000000.12345'}]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': self.compute_id(self.test_account, self.test_container,
+                                    'object'),
+             'found': True, '_source': {'x-timestamp': 2000000123}}]}
+        self.sync._fast_verify = True
+        self.sync._last_processed_row = 5
+
+        self.sync.handle(rows, mock.Mock())
+
+        # The rows that are not being verified are looked up as before
+        self.sync._es_conn.search.assert_not_called()
+        self.sync._es_conn.mget.assert_called_once_with(
+            body={'ids': [mock.ANY]}, index=self.test_index, refresh=True,
+            _source=['x-timestamp'])
+        helpers_mock.bulk.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_shared_metadata(self, helpers_mock):
+        rows = [{'name': 'object', 'deleted': False,
+                 'created_at': '1000000.12345'}]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': self.compute_id(self.test_account, self.test_container,
+                                    'object'), 'found': False}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': '1000000.12345',
+            'last-modified': email.utils.formatdate(1000001)}
+        shared = metadata_sync.SharedMetadata(swift_mock)
+        fake_bulk = FakeBulk((1, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, shared)
+        self.sync.handle(rows, shared)
+
+        # The second batch reuses the metadata and the document
+        swift_mock.get_object_metadata.assert_called_once_with(
+            self.test_account, self.test_container, 'object',
+            headers={'X-Newest': True})
+        self.assertIs(fake_bulk.actions[0][0]['_source'],
+                      fake_bulk.actions[1][0]['_source'])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_bulk_aggregator(self, helpers_mock):
+        rows = [{'name': 'object_%d' % i, 'deleted': True}
+                for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._bulk_aggregator = mock.Mock()
+        self.sync._bulk_aggregator.bulk.return_value = (2, [
+            {'delete': {'_id': doc_ids[1], 'status': 503}}])
+        self.sync._bulk_sizer = mock.Mock(wraps=self.sync._bulk_sizer)
+        self.sync._retry_attempts = 0
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+
+        helpers_mock.bulk.assert_not_called()
+        self.sync._bulk_aggregator.bulk.assert_called_once_with(
+            [{'_op_type': 'delete', '_id': doc_id, '_index': self.test_index}
+             for doc_id in doc_ids], mock.ANY)
+        # The aggregator reports its requests to the sizer
+        self.sync._bulk_sizer.record.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_version_conflict_without_external_versioning(
+            self, helpers_mock):
+        rows = [{'name': 'object', 'deleted': True, 'created_at': 0}]
+        helpers_mock.bulk.return_value = (0, [{
+            'delete': {'_id': 'object', 'status': 409}}])
+
+        self.sync.logger = mock.Mock()
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        self.sync.logger.error.assert_called_once_with('object: 409')
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_local_timestamp_index(self, helpers_mock):
+        def fake_object_meta(account, container, key, headers={}):
+            return {'x-timestamp': 1000000,
+                    'last-modified': email.utils.formatdate(1000000)}
+
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': i == 5,
+                 'created_at': 1000000} for i in xrange(6)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        # object_0 is being verified and object_1 is fresh in the local index.
+        # object_2 is stale according to the local index and object_3 and
+        # object_4 are not in the local index.
+        ts_index = mock.Mock()
+        ts_index.get_many.return_value = {
+            doc_ids[1]: 1000000 * 1000,
+            doc_ids[2]: 999999 * 1000}
+        self.sync._timestamp_index = ts_index
+        self.sync._db_id = 'db-id'
+        self.sync._last_processed_row = 1
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[0], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}},
+            {'_id': doc_ids[3], 'found': False},
+            {'_id': doc_ids[4], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        fake_bulk = FakeBulk((1, []), (2, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+
+        ts_index.open.assert_called_with('db-id', self.test_index)
+        ts_index.get_many.assert_called_once_with(doc_ids[1:5])
+        self.sync._es_conn.mget.assert_called_once_with(
+            body={'ids': [doc_ids[0], doc_ids[3], doc_ids[4]]},
+            index=self.test_index,
+            refresh=True,
+            _source=['x-timestamp'])
+        ops = fake_bulk.actions[1]
+        self.assertEqual([doc_ids[2], doc_ids[3]],
+                         [op['_id'] for op in ops])
+        expected_calls = [
+            mock.call.remove([doc_ids[5]]),
+            mock.call.update([(doc_ids[0], 1000000 * 1000),
+                              (doc_ids[4], 1000000 * 1000)]),
+            mock.call.update([(doc_ids[2], 1000000 * 1000),
+                              (doc_ids[3], 1000000 * 1000)])]
+        self.assertEqual(expected_calls,
+                         [call for call in ts_index.mock_calls
+                          if call[0] in ('remove', 'update')])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_local_timestamp_index_failures(self, helpers_mock):
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(2)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        ts_index = mock.Mock()
+        ts_index.get_many.return_value = {}
+        self.sync._timestamp_index = ts_index
+        self.sync._db_id = 'db-id'
+        self.sync._last_processed_row = 0
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_id, 'found': False} for doc_id in doc_ids]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        helpers_mock.bulk.side_effect = FakeBulk((1, [
+            {'index': {'_id': doc_ids[0], 'status': 400}}]))
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, swift_mock)
+        ts_index.update.assert_called_once_with(
+            [(doc_ids[1], 1000000 * 1000)])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_dead_letter_queue(self, helpers_mock, exists_mock):
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(2)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        dead_letters = mock.Mock()
+        self.sync._dead_letters = dead_letters
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_id, 'found': False} for doc_id in doc_ids]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        failure = {'index': {'_id': doc_ids[0], 'status': 400,
+                             'error': {'type': 'document_parsing_exception',
+                                       'reason': 'failed to parse'}}}
+        helpers_mock.bulk.return_value = (1, [failure])
+        dead_letters.is_empty.return_value = False
+        exists_mock.return_value = True
+
+        self.sync.handle(rows, swift_mock)
+        exists_mock.assert_called_once_with(dead_letters.path)
+        self.assertEqual(
+            [mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.is_empty(),
+             mock.call.remove(doc_ids),
+             mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.add([(doc_ids[0], rows[0],
+                             '%s: failed to parse' % doc_ids[0])])],
+            dead_letters.mock_calls)
+
+        # An empty queue has nothing to supersede
+        dead_letters.reset_mock()
+        dead_letters.is_empty.return_value = True
+        helpers_mock.bulk.return_value = (2, [])
+        self.sync.handle(rows, swift_mock)
+        self.assertEqual(
+            [mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.is_empty()],
+            dead_letters.mock_calls)
+
+        # The queue is only created once a row fails
+        exists_mock.return_value = False
+        dead_letters.reset_mock()
+        self.sync.handle(rows, swift_mock)
+        self.assertEqual([], dead_letters.mock_calls)
+        helpers_mock.bulk.return_value = (1, [failure])
+        self.sync.handle(rows, swift_mock)
+        self.assertEqual(
+            [mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.add([(doc_ids[0], rows[0],
+                             '%s: failed to parse' % doc_ids[0])])],
+            dead_letters.mock_calls)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists',
+                mock.Mock(return_value=False))
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_dead_letter_queue_head_error(self, helpers_mock):
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        dead_letters = mock.Mock()
+        self.sync._dead_letters = dead_letters
+        self.sync._head_concurrency = 2
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_id, 'found': False} for doc_id in doc_ids]}
+        not_found = UnexpectedResponse('Unexpected response: 404 Not Found',
+                                       None)
+
+        def _get_object_metadata(account, container, obj, headers=None):
+            # The object was deleted after the row was listed
+            if obj == 'object_1':
+                raise not_found
+            return {'x-timestamp': 1000000,
+                    'last-modified': email.utils.formatdate(1000000)}
+
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = _get_object_metadata
+        fake_bulk = FakeBulk((2, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, swift_mock)
+        self.assertEqual([[doc_ids[0], doc_ids[2]]],
+                         [[op['_id'] for op in ops]
+                          for ops in fake_bulk.actions])
+        dead_letters.add.assert_called_once_with(
+            [(doc_ids[1], rows[1], '%s: %s' % (doc_ids[1], not_found))])
+
+    def test_handle_head_error(self):
+        rows = [{'ROWID': 1, 'name': 'object', 'deleted': False,
+                 'created_at': 1000000}]
+        labels = {'account': self.test_account,
+                  'container': self.test_container,
+                  'index': self.test_index}
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': self.compute_id(self.test_account, self.test_container,
+                                    'object'),
+             'found': False}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = UnexpectedResponse(
+            'Unexpected response: 404 Not Found', None)
+
+        # Without the dead letter queue, the batch fails
+        with self.assertRaises(UnexpectedResponse):
+            self.sync.handle(rows, swift_mock)
+        self.assertEqual(1, self.sync._metrics.get(
+            'errors_total', dict(labels, type='UnexpectedResponse')))
+
+        self.sync._es_conn.mget.side_effect = elasticsearch.ConnectionError(
+            'N/A', 'connection refused', None)
+        with self.assertRaises(elasticsearch.ConnectionError):
+            self.sync.handle(rows, swift_mock)
+        self.assertEqual(1, self.sync._metrics.get(
+            'errors_total', dict(labels, type='ConnectionError')))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists',
+                mock.Mock(return_value=False))
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_dead_letter_queue_transient(self, helpers_mock):
+        rows = [{'ROWID': 1, 'name': 'object', 'deleted': True,
+                 'created_at': 1000000}]
+        doc_id = self.compute_id(self.test_account, self.test_container,
+                                 'object')
+        dead_letters = mock.Mock()
+        self.sync._dead_letters = dead_letters
+        self.sync._retry_attempts = 0
+        helpers_mock.bulk.return_value = (0, [
+            {'delete': {'_id': doc_id, 'status': 503}}])
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        dead_letters.add.assert_not_called()
+        dead_letters.get_due.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_retry_dead_letters(self, helpers_mock, exists_mock):
+        rows = [{'ROWID': i + 1,
+                 'name': 'object_%d' % i,
+                 'deleted': True,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        dead_letters = mock.Mock()
+        dead_letters.get_due.return_value = [
+            (doc_ids[1], rows[1]), (doc_ids[2], rows[2])]
+        self.sync._dead_letters = dead_letters
+        exists_mock.return_value = True
+        fake_bulk = FakeBulk(
+            (1, [{'delete': {'_id': doc_ids[2], 'status': 400,
+                             'error': {'reason': 'bad request'}}}]))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.assertEqual(2, self.sync.retry_dead_letters(mock.Mock()))
+        exists_mock.assert_called_once_with(dead_letters.path)
+        self.assertEqual(
+            [doc_ids[1:]],
+            [[op['_id'] for op in ops] for ops in fake_bulk.actions])
+        self.assertEqual(
+            [mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.get_due(
+                 metadata_sync.MetadataSync.DEFAULT_DEAD_LETTER_BATCH),
+             mock.call.open(self.test_account, self.test_container,
+                            self.test_index),
+             mock.call.add([(doc_ids[2], rows[2],
+                             '%s: bad request' % doc_ids[2])]),
+             mock.call.remove([doc_ids[1]]),
+             mock.call.close()],
+            dead_letters.mock_calls)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
+    def test_retry_dead_letters_batches(self, exists_mock):
+        dead_letters = mock.Mock()
+        self.sync._dead_letters = dead_letters
+        self.sync._dead_letter_batch = 2
+        exists_mock.return_value = True
+        with mock.patch.object(self.sync, '_drain_dead_letters',
+                               side_effect=[2, 2, 1]) as drain_mock:
+            self.assertEqual(5, self.sync.retry_dead_letters(mock.Mock()))
+        self.assertEqual(3, drain_mock.call_count)
+        dead_letters.close.assert_called_once_with()
+
+        # Without a queue file, there is nothing to retry
+        exists_mock.return_value = False
+        dead_letters.reset_mock()
+        self.assertEqual(0, self.sync.retry_dead_letters(mock.Mock()))
+        self.assertEqual([], dead_letters.mock_calls)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
+    def test_retry_dead_letters_error(self, exists_mock):
+        row = {'ROWID': 2, 'name': 'object', 'deleted': False,
+               'created_at': 1000000}
+        doc_id = self.compute_id(self.test_account, self.test_container,
+                                 'object')
+        dead_letters = mock.Mock()
+        dead_letters.get_due.return_value = [(doc_id, row)]
+        self.sync._dead_letters = dead_letters
+        exists_mock.return_value = True
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = RuntimeError('mget failed')
+
+        self.assertEqual(1, self.sync.retry_dead_letters(mock.Mock()))
+        dead_letters.add.assert_called_once_with(
+            [(doc_id, row, repr(RuntimeError('mget failed')))])
+        dead_letters.remove.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
+    def test_retry_dead_letters_mapping_stale(self, exists_mock):
+        def _process_rows(rows, internal_client):
+            self.assertFalse(self.sync._mapping_stale)
+            return []
+
+        dead_letters = mock.Mock()
+        dead_letters.get_due.return_value = [('doc-id', {'name': 'object'})]
+        self.sync._dead_letters = dead_letters
+        self.sync._mapping_stale = True
+        exists_mock.return_value = True
+        with mock.patch.object(self.sync, '_verify_mapping') as verify_mock,\
+                mock.patch.object(self.sync, '_process_rows',
+                                  side_effect=_process_rows) as process_mock:
+            self.assertEqual(1, self.sync.retry_dead_letters(mock.Mock()))
+        verify_mock.assert_called_once_with()
+        process_mock.assert_called_once_with(
+            [{'name': 'object'}], mock.ANY)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_metrics(self, helpers_mock):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i == 0,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[1], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}},
+            {'_id': doc_ids[2], 'found': False}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        helpers_mock.bulk.side_effect = FakeBulk(
+            (1, []),
+            (0, [{'index': {'_id': doc_ids[2], 'status': 400,
+                            'error': {'type': 'mapper_parsing_exception',
+                                      'reason': 'failed to parse'}}}]))
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, swift_mock)
+        labels = {'account': self.test_account,
+                  'container': self.test_container,
+                  'index': self.test_index}
+        metrics = self.sync._metrics
+        self.assertEqual(3, metrics.get('rows_total', labels))
+        self.assertEqual(1, metrics.get('deletes_total', labels))
+        self.assertEqual(1, metrics.get('stale_rows_total', labels))
+        self.assertEqual(1, metrics.get('fresh_rows_total', labels))
+        self.assertEqual(1, metrics.get(
+            'errors_total', dict(labels, type='mapper_parsing_exception')))
+        text = metrics.render()
+        for histogram in ('head', 'mget', 'bulk'):
+            self.assertIn(
+                'swift_metadata_sync_%s_seconds_count{account="%s",'
+                'container="%s",index="%s"} %d' % (
+                    histogram, self.test_account, self.test_container,
+                    self.test_index, 2 if histogram == 'bulk' else 1), text)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_stage_timings(self, helpers_mock):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i == 0,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[1], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}},
+            {'_id': doc_ids[2], 'found': False}]}
+        swift_mock = mock.Mock()
+        meta = {'x-timestamp': 1000000,
+                'last-modified': email.utils.formatdate(1000000)}
+        swift_mock.get_object_metadata.return_value = meta
+        helpers_mock.bulk.side_effect = FakeBulk((1, []), (1, []))
+        hook = mock.Mock()
+        failing_hook = mock.Mock(side_effect=RuntimeError('hook failed'))
+        self.sync._stage_hooks = [failing_hook, hook]
+
+        self.sync.handle(rows, swift_mock)
+        labels = {'account': self.test_account,
+                  'container': self.test_container,
+                  'index': self.test_index}
+        hook.assert_called_once_with(labels, mock.ANY)
+        failing_hook.assert_called_once_with(labels, mock.ANY)
+        stages = hook.mock_calls[0][1][1]
+        self.assertEqual(
+            [('build_deletes', 3), ('bulk_delete', 1), ('get_stale_rows', 2),
+             ('head', 1), ('build_docs', 1), ('bulk_index', 1)],
+            [(stage, entry['items']) for stage, entry in stages.items()])
+        self.assertEqual(
+            len('x-timestamp1000000last-modified') +
+            len(meta['last-modified']), stages.get('head')['bytes'])
+        self.assertGreater(stages.get('bulk_delete')['bytes'], 0)
+        self.assertGreater(stages.get('bulk_index')['bytes'], 0)
+        self.assertEqual(0, stages.get('build_docs')['bytes'])
+        self.assertEqual(1, self.sync._metrics.get(
+            'stage_items_total', dict(labels, stage='head')))
+        self.assertEqual(2, self.sync._metrics.get(
+            'stage_items_total', dict(labels, stage='get_stale_rows')))
+
+    def test_local_timestamp_index_unknown_db_id(self):
+        self.sync._timestamp_index = mock.Mock()
+        self.assertFalse(self.sync._open_timestamp_index())
+        self.sync._timestamp_index.open.assert_not_called()
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_invalid_head_concurrency(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        sync_conf = dict(self.sync_conf)
+        sync_conf['head_concurrency'] = 0
+        with self.assertRaises(RuntimeError):
+            metadata_sync.MetadataSync(self.status_dir, sync_conf)
+
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
     @mock.patch(
@@ -647,8 +1714,8 @@ class TestMetadataSync(unittest.TestCase):
                  'deleted': False,
                  'created_at': 1000000} for i in range(0, 10)]
         es_docs = {'docs': [{
-            '_id': '%s/%s/object_%d' % (
-                self.test_account, self.test_container, i),
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
             'found': False} for i in range(0, 10)]}
         self.sync._es_conn = mock.Mock()
         self.sync._es_conn.mget.return_value = es_docs
@@ -719,7 +1786,8 @@ class TestMetadataSync(unittest.TestCase):
 
         for meta, is_json in test_cases:
             mock_helpers.reset_mock()
-            mock_helpers.bulk.return_value = (None, [])
+            fake_bulk = FakeBulk()
+            mock_helpers.bulk.side_effect = fake_bulk
 
             test_meta = dict(obj_meta)
             test_meta['x-object-meta-test'] = meta
@@ -738,20 +1806,23 @@ class TestMetadataSync(unittest.TestCase):
                 expected = meta
 
             mock_helpers.bulk.assert_called_once_with(
-                es_mock, [
-                    {'_op_type': 'index',
-                     '_id': doc_id,
-                     '_index': self.test_index,
-                     '_type': metadata_sync.MetadataSync.DEFAULT_DOC_TYPE,
-                     '_source': {
-                         'test': expected,
-                         'x-timestamp': 0,
-                         'last-modified': 1528323859000,
-                         'x-swift-account': self.test_account,
-                         'x-swift-container': self.test_container,
-                         'x-swift-object': obj}}],
+                es_mock, mock.ANY,
                 raise_on_error=False,
-                raise_on_exception=False)
+                raise_on_exception=False,
+                chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+            self.assertEqual([[
+                {'_op_type': 'index',
+                 '_id': doc_id,
+                 '_index': self.test_index,
+                 '_type': metadata_sync.MetadataSync.DEFAULT_DOC_TYPE,
+                 '_source': {
+                     'test': expected,
+                     'x-timestamp': 0,
+                     'last-modified': 1528323859000,
+                     'x-swift-account': self.test_account,
+                     'x-swift-container': self.test_container,
+                     'x-swift-object': obj}}]],
+                fake_bulk.actions)
 
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
@@ -775,7 +1846,8 @@ class TestMetadataSync(unittest.TestCase):
             'x-timestamp': 0,
             'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT'
         }
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
         index_mock.return_value.get_mapping.return_value = {
             self.test_index: {
                 'mappings': {
@@ -786,19 +1858,23 @@ class TestMetadataSync(unittest.TestCase):
                     internal_client)
         helpers_mock.bulk.assert_called_once_with(
             es_mock.return_value,
-            [{'_op_type': 'index',
-              '_id': doc_id,
-              '_index': self.test_index,
-              '_source': {
-                  'x-timestamp': 0,
-                  'last-modified': 1528323859000,
-                  'x-swift-account': self.test_account,
-                  'x-swift-container': self.test_container,
-                  'x-swift-object': obj,
-              },
-              'pipeline': 'test-pipeline'}],
+            mock.ANY,
             raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual(
+            [[{'_op_type': 'index',
+               '_id': doc_id,
+               '_index': self.test_index,
+               '_source': {
+                   'x-timestamp': 0,
+                   'last-modified': 1528323859000,
+                   'x-swift-account': self.test_account,
+                   'x-swift-container': self.test_container,
+                   'x-swift-object': obj,
+               },
+               'pipeline': 'test-pipeline'}]],
+            fake_bulk.actions)
 
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
@@ -818,7 +1894,8 @@ class TestMetadataSync(unittest.TestCase):
             'x-timestamp': 0,
             'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT'
         }
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
         index_mock.return_value.get_mapping.return_value = {
             self.test_index: {
                 'mappings': {
@@ -829,19 +1906,23 @@ class TestMetadataSync(unittest.TestCase):
                     internal_client)
         helpers_mock.bulk.assert_called_once_with(
             es_mock.return_value,
-            [{'_op_type': 'index',
-              '_id': doc_id,
-              '_index': self.test_index,
-              '_type': metadata_sync.MetadataSync.DEFAULT_DOC_TYPE,
-              '_source': {
-                  'x-timestamp': 0,
-                  'last-modified': 1528323859000,
-                  'x-swift-account': self.test_account,
-                  'x-swift-container': self.test_container,
-                  'x-swift-object': obj}
-              }],
+            mock.ANY,
             raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual(
+            [[{'_op_type': 'index',
+               '_id': doc_id,
+               '_index': self.test_index,
+               '_type': metadata_sync.MetadataSync.DEFAULT_DOC_TYPE,
+               '_source': {
+                   'x-timestamp': 0,
+                   'last-modified': 1528323859000,
+                   'x-swift-account': self.test_account,
+                   'x-swift-container': self.test_container,
+                   'x-swift-object': obj}
+               }]],
+            fake_bulk.actions)
 
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
@@ -864,7 +1945,8 @@ class TestMetadataSync(unittest.TestCase):
             'x-timestamp': 0,
             'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT'
         }
-        helpers_mock.bulk.return_value = (None, [])
+        fake_bulk = FakeBulk()
+        helpers_mock.bulk.side_effect = fake_bulk
         index_mock.return_value.get_mapping.return_value = {
             self.test_index: {
                 'mappings': {
@@ -875,19 +1957,180 @@ class TestMetadataSync(unittest.TestCase):
                     internal_client)
         helpers_mock.bulk.assert_called_once_with(
             es_mock.return_value,
-            [{'_op_type': 'index',
-              '_id': doc_id,
-              '_index': self.test_index,
-              '_source': {
-                  'x-timestamp': 0,
-                  'last-modified': 1528323859000,
-                  'x-swift-account': self.test_account,
-                  'x-swift-container': self.test_container,
-                  'x-swift-object': obj,
-                  'x-static-large-object': 'true',
-              }}],
+            mock.ANY,
             raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            chunk_size=mock.ANY, max_chunk_bytes=mock.ANY)
+        self.assertEqual(
+            [[{'_op_type': 'index',
+               '_id': doc_id,
+               '_index': self.test_index,
+               '_source': {
+                   'x-timestamp': 0,
+                   'last-modified': 1528323859000,
+                   'x-swift-account': self.test_account,
+                   'x-swift-container': self.test_container,
+                   'x-swift-object': obj,
+                   'x-static-large-object': 'true',
+               }}]],
+            fake_bulk.actions)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_adaptive_chunks(self, helpers_mock, time_mock):
+        time_mock.time.return_value = 0
+        rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
+        sizer = BulkSizer(max_docs=4, min_docs=2)
+        self.sync._bulk_sizer = sizer
+        fake_bulk = FakeBulk(
+            (3, [{'delete': {'_id': 'rejected', 'status': 429}}]),
+            (2, []), (3, []), (1, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        # The rejection of the first request halves the second one and the
+        # size then grows back with every successful request.
+        self.assertEqual([4, 2, 3, 1], map(len, fake_bulk.actions))
+        self.assertEqual(
+            [self.compute_id(self.test_account, self.test_container,
+                             row['name']) for row in rows],
+            [op['_id'] for chunk in fake_bulk.actions for op in chunk])
+        self.assertEqual(
+            [mock.call(self.sync._es_conn, mock.ANY, chunk_size=size,
+                       max_chunk_bytes=sizer.max_bytes,
+                       raise_on_error=False, raise_on_exception=False)
+             for size in (4, 2, 3, 1)],
+            helpers_mock.bulk.mock_calls)
+        stats = sizer.stats()
+        self.assertEqual(4, stats['docs'])
+        self.assertEqual(1, stats['shrinks'])
+        self.assertEqual(3, stats['grows'])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_mapping_error(self, helpers_mock):
+        es_pool = self.sync._es_pool
+        es_pool._mapping_ttl = 60
+        self.sync._server_version = StrictVersion('6.8.0')
+        self.sync._doc_type = metadata_sync.MetadataSync.OLD_DOC_TYPE
+        es_pool.set_doc_type(self.sync._es_conn, self.test_index,
+                             metadata_sync.MetadataSync.OLD_DOC_TYPE)
+        rows = [{'name': 'deleted', 'deleted': True, 'created_at': 0},
+                {'name': 'object', 'deleted': False, 'created_at': 0}]
+        deleted_id, doc_id = [
+            self.compute_id(self.test_account, self.test_container,
+                            row['name']) for row in rows]
+        self.sync._es_conn.mget.return_value = {
+            'docs': [{'_id': doc_id, 'found': False}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 0,
+            'last-modified': email.utils.formatdate(0)}
+        fake_bulk = FakeBulk(
+            (0, [{'delete': {
+                '_id': deleted_id, 'status': 400,
+                'error': {'type': 'mapper_parsing_exception',
+                          'reason': 'failed to parse'}}}]),
+            (1, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, swift_mock)
+        # The rest of the batch is sent with the doc type it started with
+        self.assertEqual([metadata_sync.MetadataSync.OLD_DOC_TYPE] * 2,
+                         [chunk[0]['_type'] for chunk in fake_bulk.actions])
+        self.assertTrue(self.sync._mapping_stale)
+        self.assertIsNone(
+            es_pool.get_doc_type(self.sync._es_conn, self.test_index))
+
+        helpers_mock.bulk.side_effect = None
+        helpers_mock.bulk.return_value = (1, [])
+        with mock.patch.object(self.sync, '_verify_mapping') as verify_mock:
+            self.sync.handle(rows, swift_mock)
+            verify_mock.assert_called_once_with()
+        self.assertFalse(self.sync._mapping_stale)
+        self.assertEqual(
+            metadata_sync.MetadataSync.OLD_DOC_TYPE,
+            es_pool.get_doc_type(self.sync._es_conn, self.test_index))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.random')
+    @mock.patch('swift_metadata_sync.metadata_sync.eventlet.sleep')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_retry_transient(self, helpers_mock, sleep_mock,
+                                  random_mock):
+        random_mock.uniform.side_effect = lambda low, high: high
+        rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 4)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        fake_bulk = FakeBulk(
+            (1, [{'delete': {'_id': doc_ids[1], 'status': 429}},
+                 {'delete': {'_id': doc_ids[2], 'status': 503}},
+                 {'delete': {'_id': doc_ids[3], 'status': 504}}]),
+            (1, [{'delete': {'_id': doc_ids[2],
+                             'error': 'ConnectionTimeout',
+                             'status': 'TIMEOUT',
+                             'exception':
+                             elasticsearch.ConnectionTimeout()}}]),
+            (1, []))
+        helpers_mock.bulk.side_effect = fake_bulk
+
+        self.sync.handle(rows, mock.Mock())
+        self.assertEqual(
+            [doc_ids, doc_ids[1:], [doc_ids[2]]],
+            [[op['_id'] for op in ops] for ops in fake_bulk.actions])
+        self.assertEqual([mock.call(0.5), mock.call(1.0)],
+                         sleep_mock.mock_calls)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.eventlet.sleep')
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_retry_exhausted(self, helpers_mock, sleep_mock):
+        rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 4)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._retry_attempts = 2
+        self.sync.logger = mock.Mock()
+        helpers_mock.bulk.side_effect = FakeBulk(
+            (2, [{'delete': {'_id': doc_ids[0], 'status': 503}},
+                 {'delete': {'_id': doc_ids[1], 'status': 500}}]),
+            (0, [{'delete': {'_id': doc_ids[0], 'status': 503}}]))
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        self.assertEqual(3, helpers_mock.bulk.call_count)
+        self.assertEqual(2, sleep_mock.call_count)
+        self.assertEqual(
+            [mock.call('%s: 500' % doc_ids[1]),
+             mock.call('%s: 503' % doc_ids[0])],
+            self.sync.logger.error.mock_calls)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_concurrent_chunks(self, helpers_mock):
+        rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
+        doc_ids = [self.compute_id(self.test_account, self.test_container,
+                                   row['name']) for row in rows]
+        self.sync._bulk_sizer = BulkSizer(max_docs=3, min_docs=1)
+        self.sync._bulk_concurrency = 2
+        in_flight = []
+        max_in_flight = []
+
+        def fake_bulk(client, actions, **kwargs):
+            in_flight.append(actions)
+            max_in_flight.append(len(in_flight))
+            eventlet.sleep(0.01)
+            in_flight.remove(actions)
+            if doc_ids[4] in [action['_id'] for action in actions]:
+                return (len(actions) - 1, [{'delete': {
+                    '_id': doc_ids[4], 'status': 400}}])
+            return (len(actions), [])
+        helpers_mock.bulk.side_effect = fake_bulk
+        self.sync.logger = mock.Mock()
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        self.assertEqual(4, helpers_mock.bulk.call_count)
+        self.assertEqual(2, max(max_in_flight))
+        self.sync.logger.error.assert_called_once_with(
+            '%s: 400' % doc_ids[4])
 
 
 class TestMetadataSyncFactory(unittest.TestCase):
@@ -896,6 +2139,326 @@ class TestMetadataSyncFactory(unittest.TestCase):
             metadata_sync.MetadataSyncFactory({})
         self.assertIn('"status_dir" is missing', ctx.exception.message)
 
+    def test_raise_error_on_unknown_status_backend(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            metadata_sync.MetadataSyncFactory(
+                {'status_dir': '/foo/bar', 'status_backend': 'bogus'})
+        self.assertIn('"status_backend" must be one of',
+                      ctx.exception.message)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_shared_clients(self, elastic_constructor_mock,
+                                     verify_mapping_mock):
+        config = {'status_dir': '/foo/bar'}
+        es_hosts = ['http://elastic.foo', 'http://elastic.bar']
+        settings = [
+            {'es_hosts': es_hosts,
+             'index': 'test-index',
+             'account': 'AUTH_test-account',
+             'container': 'container-%d' % i} for i in range(3)]
+        settings[2]['ca_certs'] = '/etc/ssl/ca.pem'
+        clients = [mock.Mock(), mock.Mock()]
+        clients[0].info.return_value = {'version': {'number': '7.4.0'}}
+        clients[1].info.return_value = {'version': {'number': '6.8.0'}}
+        elastic_constructor_mock.side_effect = clients
+
+        factory = metadata_sync.MetadataSyncFactory(config)
+        instances = [factory.instance(instance_settings)
+                     for instance_settings in settings]
+
+        self.assertEqual([
+            mock.call(es_hosts),
+            mock.call(es_hosts, ca_certs='/etc/ssl/ca.pem')],
+            elastic_constructor_mock.mock_calls)
+        clients[0].info.assert_called_once_with()
+        self.assertIs(clients[0], instances[0]._es_conn)
+        self.assertIs(clients[0], instances[1]._es_conn)
+        self.assertIs(clients[1], instances[2]._es_conn)
+        self.assertEqual(StrictVersion('7.4.0'), instances[1]._server_version)
+        self.assertEqual(StrictVersion('6.8.0'), instances[2]._server_version)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_bulk_aggregator(self, elastic_constructor_mock,
+                                      verify_mapping_mock):
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        settings = [
+            {'es_hosts': es_hosts,
+             'index': 'test-index',
+             'account': 'AUTH_test-account',
+             'container': 'container'}
+            for es_hosts in ('http://elastic.foo', 'http://elastic.foo',
+                             'http://elastic.bar')]
+        factory = metadata_sync.MetadataSyncFactory(
+            {'status_dir': '/foo/bar'})
+        self.assertIsNone(factory.instance(settings[0])._bulk_aggregator)
+
+        factory = metadata_sync.MetadataSyncFactory(
+            {'status_dir': '/foo/bar', 'bulk_aggregation_delay': 0.05})
+        instances = [factory.instance(instance_settings)
+                     for instance_settings in settings]
+        aggregator = instances[0]._bulk_aggregator
+        self.assertIsInstance(aggregator, metadata_sync.BulkAggregator)
+        self.assertEqual(0.05, aggregator._delay)
+        self.assertIs(instances[0]._bulk_sizer, aggregator._sizer)
+        self.assertIs(aggregator, instances[1]._bulk_aggregator)
+        self.assertIsNot(aggregator, instances[2]._bulk_aggregator)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_cached_mapping(self, elastic_constructor_mock,
+                                     time_mock):
+        def fake_verify_mapping(sync):
+            sync._doc_type = metadata_sync.MetadataSync.DEFAULT_DOC_TYPE
+
+        config = {'status_dir': '/foo/bar', 'mapping_cache_ttl': 60}
+        settings = [
+            {'es_hosts': 'http://elastic.foo',
+             'index': index,
+             'account': 'AUTH_test-account',
+             'container': 'test-container'}
+            for index in ('test-index', 'other-index', 'test-index')]
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        time_mock.return_value = 1000
+
+        factory = metadata_sync.MetadataSyncFactory(config)
+        with mock.patch.object(metadata_sync.MetadataSync, '_verify_mapping',
+                               autospec=True) as verify_mock:
+            verify_mock.side_effect = fake_verify_mapping
+            instances = [factory.instance(instance_settings)
+                         for instance_settings in settings]
+            self.assertEqual([mock.call(instances[0]),
+                              mock.call(instances[1])],
+                             verify_mock.mock_calls)
+            self.assertEqual(
+                metadata_sync.MetadataSync.DEFAULT_DOC_TYPE,
+                instances[2]._doc_type)
+
+            verify_mock.reset_mock()
+            time_mock.return_value = 1060
+            instance = factory.instance(settings[0])
+            verify_mock.assert_called_once_with(instance)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_targets(self, elastic_constructor_mock,
+                              verify_mapping_mock):
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        settings = {'account': u'AUTH_test',
+                    'container': u'test-container',
+                    'es_hosts': 'http://primary',
+                    'targets': [
+                        {'index': 'test-index'},
+                        {'index': 'test-index', 'name': 'dr',
+                         'es_hosts': 'http://dr', 'pipeline': 'dr'}]}
+        factory = metadata_sync.MetadataSyncFactory(
+            {'status_dir': '/foo/bar'})
+        instance = factory.instance(settings)
+
+        self.assertIsInstance(instance, metadata_sync.FanOutSync)
+        (primary_name, primary), (dr_name, dr) = instance._syncs
+        self.assertEqual(('test-index', 'dr'), (primary_name, dr_name))
+        self.assertEqual(None, primary._pipeline)
+        self.assertEqual('dr', dr._pipeline)
+        self.assertEqual(
+            [mock.call('http://primary'), mock.call('http://dr')],
+            [call for call in elastic_constructor_mock.mock_calls
+             if call[0] == ''])
+        # The first target keeps the status of the mapping
+        self.assertEqual('db-id', primary._get_status_key('db-id'))
+        self.assertEqual('db-id:dr', dr._get_status_key('db-id'))
+        self.assertNotEqual(primary._get_state_path('.timestamps'),
+                            dr._get_state_path('.timestamps'))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.find_queues')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync.retry_dead_letters')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_retry_dead_letters(self, elastic_constructor_mock,
+                                verify_mapping_mock, retry_mock,
+                                find_queues_mock):
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+        queues = [mock.Mock(identity=identity) for identity in (
+            (u'AUTH_test', u'container', u'index'),
+            (u'AUTH_test', u'unknown', u'index'),
+            (u'AUTH_other', u'container', u'index'),
+            (u'AUTH_other', u'idle', u'index'),
+            None)]
+        # The rows queued for the idle container are not due yet
+        queues[3].has_due.return_value = False
+        find_queues_mock.return_value = queues
+        retry_mock.return_value = 2
+        config = {'status_dir': '/foo/bar', 'containers': [
+            {'account': u'AUTH_test', 'container': u'container',
+             'es_hosts': 'http://primary', 'dead_letter_queue': True,
+             'targets': [{'index': 'index'},
+                         {'index': 'index', 'name': 'dr',
+                          'es_hosts': 'http://dr'}]},
+            {'account': u'AUTH_other', 'container': u'/*',
+             'es_hosts': 'http://primary', 'index': 'index',
+             'dead_letter_queue': True}]}
+        factory = metadata_sync.MetadataSyncFactory(config)
+        swift = mock.Mock()
+
+        # Both targets of the first container and the per-account mapping
+        self.assertEqual(6, factory.retry_dead_letters(swift))
+        self.assertEqual([mock.call(swift)] * 3, retry_mock.mock_calls)
+        for queue in queues:
+            queue.close.assert_called_once_with()
+
+        retry_mock.reset_mock()
+        self.assertEqual(2, factory.retry_dead_letters(
+            swift, account=u'AUTH_other'))
+        retry_mock.assert_called_once_with(swift)
+
+        # A failure does not hold up the other containers
+        retry_mock.reset_mock()
+        retry_mock.side_effect = [RuntimeError('failed'), 2, 2]
+        self.assertEqual(4, factory.retry_dead_letters(swift))
+        self.assertEqual(3, retry_mock.call_count)
+
+    def test_raise_error_on_unknown_engine(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            metadata_sync.MetadataSyncFactory(
+                {'status_dir': '/foo/bar', 'engine': 'asyncio'})
+        self.assertIn('"engine" must be one of', ctx.exception.message)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_eventlet_engine(self, elastic_constructor_mock,
+                                      verify_mapping_mock):
+        instance_settings = {
+            'es_hosts': 'http://elastic.foo',
+            'index': 'test-index',
+            'account': 'AUTH_test-account',
+            'container': 'test-container'}
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+
+        factory = metadata_sync.MetadataSyncFactory(
+            {'status_dir': '/foo/bar', 'engine': 'eventlet'})
+        instance = factory.instance(instance_settings)
+        self.assertEqual('eventlet', instance._engine)
+        self.assertEqual(64, instance._head_concurrency)
+        self.assertEqual(4, instance._bulk_concurrency)
+        elastic_constructor_mock.assert_called_once_with(
+            'http://elastic.foo', maxsize=128)
+
+        instance = factory.instance(dict(
+            instance_settings, head_concurrency=1000, bulk_concurrency=16))
+        self.assertEqual(1000, instance._head_concurrency)
+        self.assertEqual(16, instance._bulk_concurrency)
+
+        elastic_constructor_mock.reset_mock()
+        factory = metadata_sync.MetadataSyncFactory(
+            {'status_dir': '/foo/bar', 'es_connections': 20})
+        instance = factory.instance(dict(instance_settings,
+                                         bulk_concurrency=16))
+        self.assertEqual('threads', instance._engine)
+        self.assertEqual(1, instance._head_concurrency)
+        self.assertEqual(1, instance._bulk_concurrency)
+        elastic_constructor_mock.assert_called_once_with(
+            'http://elastic.foo', maxsize=20)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_bulk_sizer(self, elastic_constructor_mock,
+                                 verify_mapping_mock):
+        config = {'status_dir': '/foo/bar',
+                  'bulk_max_docs': 1000,
+                  'bulk_max_bytes': 2 * 2**20,
+                  'bulk_target_latency': 5}
+        instance_settings = {
+            'es_hosts': 'http://elastic.foo',
+            'index': 'test-index',
+            'account': 'AUTH_test-account',
+            'container': 'test-container'}
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+
+        factory = metadata_sync.MetadataSyncFactory(config)
+        instance = factory.instance(instance_settings)
+        self.assertEqual(1000, instance._bulk_sizer.max_docs)
+        self.assertIs(factory.metrics, instance._metrics)
+        self.assertEqual(2 * 2**20, instance._bulk_sizer.max_bytes)
+        self.assertEqual(5, instance._bulk_sizer.target_latency)
+        self.assertEqual(BulkSizer.DEFAULT_MIN_DOCS,
+                         instance._bulk_sizer.min_docs)
+        other_settings = dict(instance_settings, index='other-index')
+        self.assertIs(instance._bulk_sizer,
+                      factory.instance(other_settings)._bulk_sizer)
+        self.assertEqual(
+            {json.dumps('http://elastic.foo'): {
+                'docs': 1000, 'bytes': 2 * 2**20, 'shrinks': 0,
+                'grows': 0}},
+            factory.bulk_sizes())
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_profiler(self, elastic_constructor_mock,
+                               verify_mapping_mock):
+        instance_settings = {
+            'es_hosts': 'http://elastic.foo',
+            'index': 'test-index',
+            'account': 'AUTH_test-account',
+            'container': 'test-container'}
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+
+        factory = metadata_sync.MetadataSyncFactory({'status_dir': '/foo'})
+        self.assertIsNone(factory.instance(instance_settings)._profiler)
+        factory.profiler = mock.Mock()
+        self.assertIs(factory.profiler,
+                      factory.instance(instance_settings)._profiler)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.atexit')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_instance_checkpoint_cache(self, elastic_constructor_mock,
+                                       verify_mapping_mock, atexit_mock):
+        config = {'status_dir': '/foo/bar',
+                  'checkpoint_flush_interval': 60,
+                  'checkpoint_flush_rows': 10000}
+        instance_settings = {
+            'es_hosts': 'http://elastic.foo',
+            'index': 'test-index',
+            'account': 'AUTH_test-account',
+            'container': 'test-container'}
+        elastic_constructor_mock.return_value.info.return_value = {
+            'version': {'number': '7.4.0'}}
+
+        factory = metadata_sync.MetadataSyncFactory(config)
+        atexit_mock.register.assert_called_once_with(factory.flush)
+        instance = factory.instance(instance_settings)
+        self.assertIsInstance(instance._status_store, CachedStatusStore)
+        self.assertEqual(60, instance._status_store._flush_interval)
+        self.assertEqual(10000, instance._status_store._flush_rows)
+        self.assertIs(instance._status_store,
+                      factory.instance(instance_settings)._status_store)
+
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
     @mock.patch(
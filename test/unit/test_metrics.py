@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from swift_metadata_sync.metrics import Metrics, start_http_server
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.labels = {'account': u'AUTH_test', 'container': u'cont\xe9',
+                       'index': 'index'}
+
+    def test_counters(self):
+        self.metrics.inc('rows_total', self.labels, 10)
+        self.metrics.inc('rows_total', self.labels)
+        self.metrics.inc('errors_total', dict(self.labels, type='foo'))
+        self.assertEqual(11, self.metrics.get('rows_total', self.labels))
+        self.assertIsNone(self.metrics.get('rows_total', {}))
+        self.assertEqual(
+            1, self.metrics.get('errors_total', dict(self.labels, type='foo')))
+        with self.assertRaises(KeyError):
+            self.metrics.inc('bogus_total', self.labels)
+
+    def test_render_counters_and_gauges(self):
+        self.metrics.inc('rows_total', self.labels, 10)
+        self.metrics.set('bulk_docs', {'cluster': '"es"'}, 250)
+        text = self.metrics.render()
+        self.assertIn(
+            '# HELP swift_metadata_sync_rows_total Container rows handled.\n'
+            '# TYPE swift_metadata_sync_rows_total counter\n'
+            'swift_metadata_sync_rows_total{account="AUTH_test",'
+            'container="cont\xc3\xa9",index="index"} 10\n', text)
+        self.assertIn(
+            '# TYPE swift_metadata_sync_bulk_docs gauge\n'
+            'swift_metadata_sync_bulk_docs{cluster="\\"es\\""} 250\n', text)
+        self.assertIn('# TYPE swift_metadata_sync_deletes_total counter\n',
+                      text)
+
+    def test_histograms(self):
+        self.metrics.observe('bulk_seconds', {'index': 'i'}, 0.02)
+        self.metrics.observe('bulk_seconds', {'index': 'i'}, 0.3)
+        self.metrics.observe('bulk_seconds', {'index': 'i'}, 100)
+        lines = [line for line in self.metrics.render().splitlines()
+                 if line.startswith('swift_metadata_sync_bulk_seconds')]
+        self.assertEqual([
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.005"} 0',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.01"} 0',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.025"} 1',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.05"} 1',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.1"} 1',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.25"} 1',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="0.5"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="1.0"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="2.5"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="5.0"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="10.0"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="30.0"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="60.0"} 2',
+            'swift_metadata_sync_bulk_seconds_bucket{index="i",le="+Inf"} 3',
+            'swift_metadata_sync_bulk_seconds_sum{index="i"} 100.32',
+            'swift_metadata_sync_bulk_seconds_count{index="i"} 3'], lines)
+
+    def test_timer(self):
+        with self.assertRaises(RuntimeError):
+            with self.metrics.timer('head_seconds', self.labels):
+                raise RuntimeError('HEAD failed')
+        self.assertIn(
+            'swift_metadata_sync_head_seconds_count{account="AUTH_test",'
+            'container="cont\xc3\xa9",index="index"} 1',
+            self.metrics.render())
+
+    def test_write_textfile(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'metadata_sync.prom')
+            self.metrics.inc('rows_total', self.labels)
+            self.metrics.write_textfile(path)
+            with open(path) as f:
+                self.assertEqual(self.metrics.render(), f.read())
+            self.assertEqual(['metadata_sync.prom'], os.listdir(tempdir))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_http_server(self):
+        server = start_http_server(self.metrics, 0)
+        try:
+            self.metrics.inc('rows_total', self.labels, 5)
+            response = urllib2.urlopen(
+                'http://127.0.0.1:%d/metrics' % server.server_address[1])
+            self.assertEqual(200, response.getcode())
+            self.assertEqual(self.metrics.render(), response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,104 @@
+import mock
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+from swift_metadata_sync.profiler import Profiler
+
+
+def handle_rows(rows):
+    return sum(rows)
+
+
+class Leaked(object):
+    pass
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.profile_dir = os.path.join(self.tempdir, 'profiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _functions(self, path):
+        return set(func[2] for func in pstats.Stats(path).stats)
+
+    def _profiles(self):
+        return sorted(path for path in os.listdir(self.profile_dir)
+                      if path.endswith('.prof'))
+
+    def test_cycle_with_worker_threads(self):
+        profiler = Profiler(self.profile_dir)
+        results = []
+
+        def _worker():
+            results.append(profiler.runcall(handle_rows, [1, 2, 3]))
+
+        def _cycle():
+            thread = threading.Thread(target=_worker)
+            thread.start()
+            thread.join()
+            return 'done'
+
+        self.assertEqual('done', profiler.wrap_cycle(_cycle)())
+        self.assertEqual([6], results)
+        profiles = self._profiles()
+        self.assertEqual(1, len(profiles))
+        self.assertTrue(profiles[0].startswith(Profiler.PREFIX))
+        functions = self._functions(
+            os.path.join(self.profile_dir, profiles[0]))
+        self.assertIn('_cycle', functions)
+        self.assertIn('handle_rows', functions)
+
+    def test_runcall_outside_of_cycle(self):
+        profiler = Profiler(self.profile_dir)
+        with mock.patch('swift_metadata_sync.profiler.cProfile') as \
+                cprofile_mock:
+            self.assertEqual(3, profiler.runcall(handle_rows, [1, 2]))
+        cprofile_mock.Profile.assert_not_called()
+
+    def test_runcall_on_cycle_thread(self):
+        profiler = Profiler(self.profile_dir, per_thread=False)
+        cycle = profiler.wrap_cycle(
+            lambda: profiler.runcall(handle_rows, [1, 2]))
+        self.assertEqual(3, cycle())
+        self.assertIn('handle_rows', self._functions(
+            os.path.join(self.profile_dir, self._profiles()[0])))
+
+    def test_every_and_keep(self):
+        profiler = Profiler(self.profile_dir, every=2, keep=2)
+        cycle = profiler.wrap_cycle(lambda: None)
+        with mock.patch('swift_metadata_sync.profiler.time') as time_mock:
+            for i in range(7):
+                time_mock.strftime.return_value = '20200101-00000%d' % i
+                cycle()
+        self.assertEqual(['cycle-20200101-000004-000005.prof',
+                          'cycle-20200101-000006-000007.prof'],
+                         self._profiles())
+
+    def test_memory(self):
+        profiler = Profiler(self.profile_dir, memory=True, keep=1)
+        leaked = []
+        cycle = profiler.wrap_cycle(
+            lambda: leaked.extend(Leaked() for _ in range(1000)))
+        cycle()
+        cycle()
+        files = sorted(os.listdir(self.profile_dir))
+        self.assertEqual(2, len(files))
+        self.assertTrue(files[0].endswith('.mem'))
+        with open(os.path.join(self.profile_dir, files[0])) as f:
+            summary = f.read()
+        self.assertTrue(summary.startswith('peak RSS: '))
+        self.assertIn('%+12d %12d  Leaked\n' % (1000, 2000), summary)
+
+    def test_write_error(self):
+        profiler = Profiler(self.profile_dir)
+        with mock.patch.object(profiler, '_write') as write_mock:
+            write_mock.side_effect = OSError('disk full')
+            self.assertEqual(3, profiler.wrap_cycle(
+                lambda: handle_rows([1, 2]))())
@@ -0,0 +1,39 @@
+import mock
+import unittest
+
+from swift_metadata_sync.stages import StageTimings
+
+
+class TestStageTimings(unittest.TestCase):
+    def test_add_and_merge(self):
+        stages = StageTimings()
+        stages.add('head', 0.5, 1, 100)
+        stages.add('head', 0.25, 1, 50)
+        self.assertEqual({'seconds': 0.75, 'items': 2, 'bytes': 150},
+                         stages.get('head'))
+        self.assertEqual(list(StageTimings.STAGES),
+                         [stage for stage, _ in stages.items()])
+
+        other = StageTimings()
+        other.add('head', 0.25, 2)
+        other.add('bulk_index', 1.0, 10, 1000)
+        stages.merge(other)
+        self.assertEqual({'seconds': 1.0, 'items': 4, 'bytes': 150},
+                         stages.get('head'))
+        self.assertEqual({'seconds': 1.0, 'items': 10, 'bytes': 1000},
+                         stages.get('bulk_index'))
+        self.assertEqual('head=1.000s/4/150B bulk_index=1.000s/10/1000B',
+                         str(stages))
+
+        with self.assertRaises(KeyError):
+            stages.add('bogus', 1.0)
+
+    @mock.patch('swift_metadata_sync.stages.time')
+    def test_timer(self, time_mock):
+        time_mock.time.side_effect = [10, 12.5]
+        stages = StageTimings()
+        with self.assertRaises(RuntimeError):
+            with stages.timer('get_stale_rows', 5):
+                raise RuntimeError('mget failed')
+        self.assertEqual({'seconds': 2.5, 'items': 5, 'bytes': 0},
+                         stages.get('get_stale_rows'))
@@ -0,0 +1,273 @@
+import copy
+import json
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from swift_metadata_sync import status
+
+
+class TestJSONStatusStore(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.account_dir = os.path.join(self.status_dir, 'account')
+        self.status_file = os.path.join(self.account_dir, 'container')
+        self.store = status.JSONStatusStore(self.status_file,
+                                            self.account_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.status_dir)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.store.get('db-id'))
+
+    def test_update(self):
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        self.store.update('other-id', lambda entry: {'last_row': 2})
+        self.store.update(
+            'db-id', lambda entry: {'last_row': entry['last_row'] + 1})
+        self.assertEqual({'last_row': 2}, self.store.get('db-id'))
+        self.assertEqual({'last_row': 2}, self.store.get('other-id'))
+        with open(self.status_file) as f:
+            self.assertEqual({'db-id': {'last_row': 2},
+                              'other-id': {'last_row': 2}}, json.load(f))
+
+    def test_update_many(self):
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        self.store.update('other-id', lambda entry: {'last_row': 2})
+        self.store.update_many({'db-id': {'last_row': 3},
+                                'new-id': {'last_row': 4}})
+        with open(self.status_file) as f:
+            self.assertEqual({'db-id': {'last_row': 3},
+                              'other-id': {'last_row': 2},
+                              'new-id': {'last_row': 4}}, json.load(f))
+        self.assertEqual(['container'], os.listdir(self.account_dir))
+
+    @mock.patch('swift_metadata_sync.status.os.rename')
+    def test_update_many_failure(self, rename_mock):
+        rename_mock.side_effect = OSError('failed')
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        with self.assertRaises(OSError):
+            self.store.update_many({'db-id': {'last_row': 3}})
+        self.assertEqual({'last_row': 1}, self.store.get('db-id'))
+        self.assertEqual(['container'], os.listdir(self.account_dir))
+
+    def test_malformed_file(self):
+        os.mkdir(self.account_dir)
+        with open(self.status_file, 'w') as f:
+            f.write('{')
+        self.assertIsNone(self.store.get('db-id'))
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        self.assertEqual({'last_row': 1}, self.store.get('db-id'))
+
+
+class TestSQLiteStatusStore(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.account_dir = os.path.join(self.status_dir, 'account')
+        self.status_file = os.path.join(self.account_dir, 'container')
+        self.legacy_store = status.JSONStatusStore(self.status_file,
+                                                   self.account_dir)
+        self.store = status.SQLiteStatusStore(
+            self.status_dir, 'account', 'container',
+            legacy_store=self.legacy_store)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.status_dir)
+
+    def _get_rows(self):
+        conn = sqlite3.connect(
+            os.path.join(self.status_dir, status.SQLiteStatusStore.DB_FILE))
+        try:
+            return [(db_id, account, container, json.loads(entry))
+                    for db_id, account, container, entry in conn.execute(
+                        'SELECT * FROM status ORDER BY db_id')]
+        finally:
+            conn.close()
+
+    def test_get_missing(self):
+        self.assertIsNone(self.store.get('db-id'))
+        self.assertEqual([], self._get_rows())
+
+    def test_update(self):
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        self.store.update(
+            'db-id', lambda entry: {'last_row': entry['last_row'] + 1})
+        self.assertEqual({'last_row': 2}, self.store.get('db-id'))
+        self.assertEqual(
+            [('db-id', 'account', 'container', {'last_row': 2})],
+            self._get_rows())
+        self.assertFalse(os.path.exists(self.status_file))
+
+    def test_wal_mode(self):
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        conn = sqlite3.connect(
+            os.path.join(self.status_dir, status.SQLiteStatusStore.DB_FILE))
+        try:
+            self.assertEqual(
+                'wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+        finally:
+            conn.close()
+
+    def test_shared_connection(self):
+        other_store = status.SQLiteStatusStore(
+            self.status_dir, 'account', 'other')
+        with mock.patch('swift_metadata_sync.status.sqlite3.connect',
+                        wraps=sqlite3.connect) as connect_mock:
+            self.store.update('db-id', lambda entry: {'last_row': 1})
+            other_store.update('other-id', lambda entry: {'last_row': 2})
+            self.assertEqual({'last_row': 1}, self.store.get('db-id'))
+            self.assertEqual({'last_row': 2}, other_store.get('other-id'))
+            # One connection to set up the database and one for the thread
+            self.assertEqual(2, connect_mock.call_count)
+
+            results = []
+            thread = threading.Thread(target=lambda: results.append(
+                self.store.get('db-id')))
+            thread.start()
+            thread.join()
+            self.assertEqual([{'last_row': 1}], results)
+            # The other thread has its own connection
+            self.assertEqual(3, connect_mock.call_count)
+
+    def test_failed_update(self):
+        def _fail(entry):
+            raise RuntimeError('failed')
+
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        with self.assertRaises(RuntimeError):
+            self.store.update('db-id', _fail)
+        self.assertEqual({'last_row': 1}, self.store.get('db-id'))
+
+    def test_update_many(self):
+        self.store.update('db-id', lambda entry: {'last_row': 1})
+        self.store.update_many({'db-id': {'last_row': 3},
+                                'new-id': {'last_row': 4}})
+        self.assertEqual(
+            [('db-id', 'account', 'container', {'last_row': 3}),
+             ('new-id', 'account', 'container', {'last_row': 4})],
+            self._get_rows())
+
+    def test_migrate_on_get(self):
+        self.legacy_store.update('db-id', lambda entry: {'last_row': 42})
+        self.assertEqual({'last_row': 42}, self.store.get('db-id'))
+        self.assertEqual(
+            [('db-id', 'account', 'container', {'last_row': 42})],
+            self._get_rows())
+
+    def test_migrate_on_update(self):
+        self.legacy_store.update('db-id', lambda entry: {'last_row': 42})
+        self.store.update(
+            'db-id', lambda entry: {'last_row': entry['last_row'] + 1})
+        self.assertEqual({'last_row': 43}, self.store.get('db-id'))
+        # The legacy file is left intact
+        self.assertEqual({'last_row': 42}, self.legacy_store.get('db-id'))
+
+
+class TestCachedStatusStore(unittest.TestCase):
+    def setUp(self):
+        self.entries = {}
+        self.store = mock.Mock()
+        self.store.get.side_effect = lambda db_id: copy.deepcopy(
+            self.entries.get(db_id))
+        self.store.update_many.side_effect = lambda entries: \
+            self.entries.update(copy.deepcopy(entries))
+
+    @staticmethod
+    def _set_row(row):
+        return lambda entry: {'last_row': row}
+
+    def test_cached_reads(self):
+        self.entries['db-id'] = {'last_row': 1}
+        cached = status.CachedStatusStore(self.store, flush_rows=10,
+                                          row_fields=('last_row',))
+        self.assertEqual({'last_row': 1}, cached.get('db-id'))
+        self.assertEqual({'last_row': 1}, cached.get('db-id'))
+        cached.update('db-id', self._set_row(5))
+        self.assertEqual({'last_row': 5}, cached.get('db-id'))
+        self.store.update_many.assert_not_called()
+
+    def test_reads_entries_written_elsewhere(self):
+        # e.g. by a backfill, while the cached entry has unflushed changes
+        cached = status.CachedStatusStore(self.store, flush_rows=10,
+                                          row_fields=('last_row',))
+        cached.update('db-id', self._set_row(5))
+        self.entries['db-id'] = {'last_row': 5000}
+        self.assertEqual({'last_row': 5000}, cached.get('db-id'))
+        cached.update('db-id', self._set_row(5010))
+        self.assertEqual({'db-id': {'last_row': 5010}}, self.entries)
+
+    def test_flush_skips_entries_written_elsewhere(self):
+        cached = status.CachedStatusStore(self.store, flush_rows=10,
+                                          row_fields=('last_row',))
+        cached.update('db-id', self._set_row(5))
+        cached.update('other-id', self._set_row(7))
+        self.entries['db-id'] = {'last_row': 5000}
+        cached.flush()
+        self.store.update_many.assert_called_once_with(
+            {'other-id': {'last_row': 7}})
+        self.assertEqual({'db-id': {'last_row': 5000},
+                          'other-id': {'last_row': 7}}, self.entries)
+        self.assertEqual({'last_row': 5000}, cached.get('db-id'))
+
+    def test_flush_rows(self):
+        cached = status.CachedStatusStore(self.store, flush_rows=10,
+                                          row_fields=('last_row',))
+        for row in range(1, 10):
+            cached.update('db-id', self._set_row(row))
+        self.store.update_many.assert_not_called()
+        cached.update('db-id', self._set_row(10))
+        self.store.update_many.assert_called_once_with(
+            {'db-id': {'last_row': 10}})
+        self.store.update_many.reset_mock()
+        cached.update('db-id', self._set_row(19))
+        self.store.update_many.assert_not_called()
+        cached.flush()
+        self.store.update_many.assert_called_once_with(
+            {'db-id': {'last_row': 19}})
+        self.store.update_many.reset_mock()
+        cached.flush()
+        self.store.update_many.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.status.time.time')
+    def test_flush_interval(self, time_mock):
+        time_mock.return_value = 100
+        cached = status.CachedStatusStore(self.store, flush_interval=30)
+        cached.update('db-id', self._set_row(1))
+        cached.update('other-id', self._set_row(2))
+        self.store.update_many.assert_not_called()
+        time_mock.return_value = 130
+        cached.update('db-id', self._set_row(3))
+        self.store.update_many.assert_called_once_with(
+            {'db-id': {'last_row': 3}, 'other-id': {'last_row': 2}})
+
+    def test_update_does_not_modify_cached_entry(self):
+        def _update(entry):
+            entry['last_row'] = 2
+            return entry
+
+        self.entries['db-id'] = {'last_row': 1}
+        cached = status.CachedStatusStore(self.store, flush_rows=1,
+                                          row_fields=('last_row',))
+        cached.update('db-id', _update)
+        self.store.update_many.assert_called_once_with(
+            {'db-id': {'last_row': 2}})
+
+    def test_checkpoint_cache(self):
+        store = mock.Mock(cache_key=('json', '/status/account/container'))
+        other_store = mock.Mock(cache_key=('json', '/status/account/other'))
+        cache = status.CheckpointCache(flush_interval=60)
+        cached = cache.wrap(store)
+        self.assertIs(cached, cache.wrap(store))
+        self.assertIsNot(cached, cache.wrap(other_store))
+        store.get.return_value = None
+        cached.update('db-id', self._set_row(1))
+        store.update_many.assert_not_called()
+        cache.flush()
+        store.update_many.assert_called_once_with({'db-id': {'last_row': 1}})
+        other_store.update_many.assert_not_called()
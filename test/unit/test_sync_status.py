@@ -0,0 +1,152 @@
+import mock
+import unittest
+
+from swift_metadata_sync import sync_status
+
+
+class TestSyncStatus(unittest.TestCase):
+    def setUp(self):
+        self.settings = {'account': u'AUTH_test',
+                         'container': u'container',
+                         'index': 'index',
+                         'es_hosts': 'es.example.com'}
+        self.status = sync_status.SyncStatus('/status/dir', self.settings)
+        self.status._status_store = mock.Mock()
+        self.status._status_store.get.return_value = {
+            'index': 'index', 'last_row': 90, 'last_verified_row': 80,
+            'last_row_time': 1000, 'rows_per_second': 5.0}
+        self.broker = mock.Mock()
+        self.broker.get_info.return_value = {'id': 'db-id'}
+        self.broker.get_max_row.return_value = 100
+        self.broker.get_items_since.return_value = [
+            {'ROWID': 91, 'name': 'foo', 'created_at': '1400.00000'}]
+
+    def test_lag(self):
+        self.assertEqual(
+            {'db_id': 'db-id',
+             'max_row': 100,
+             'last_row': 90,
+             'last_verified_row': 80,
+             'row_lag': 10,
+             'verify_lag': 20,
+             'rows_per_second': 5.0,
+             'catch_up_seconds': 2.0,
+             'oldest_row_age': 100.0},
+            self.status.get_lag(self.broker, now=1500))
+        self.status._status_store.get.assert_called_with('db-id')
+        self.broker.get_items_since.assert_called_once_with(90, 1)
+
+    def test_lag_caught_up(self):
+        self.broker.get_max_row.return_value = 90
+        lag = self.status.get_lag(self.broker, now=1500)
+        self.assertEqual(0, lag['row_lag'])
+        self.assertEqual(0, lag['catch_up_seconds'])
+        self.assertIsNone(lag['oldest_row_age'])
+        self.broker.get_items_since.assert_not_called()
+
+    def test_lag_unknown_rate(self):
+        self.status._status_store.get.return_value = {
+            'index': 'other-index', 'last_row': 90}
+        lag = self.status.get_lag(self.broker, now=1500)
+        self.assertEqual(0, lag['last_row'])
+        self.assertEqual(100, lag['row_lag'])
+        self.assertIsNone(lag['rows_per_second'])
+        self.assertIsNone(lag['catch_up_seconds'])
+        self.broker.get_items_since.assert_called_once_with(0, 1)
+
+    def test_per_account(self):
+        status = sync_status.SyncStatus('/status/dir', self.settings,
+                                        per_account=True)
+        self.assertEqual('/status/dir/AUTH_test', status._status_file)
+
+    @mock.patch('swift_metadata_sync.sync_status.ContainerBroker')
+    @mock.patch('swift_metadata_sync.sync_status.os.path.exists')
+    @mock.patch('swift_metadata_sync.sync_status.Ring')
+    def test_get_container_broker(self, ring_mock, exists_mock,
+                                  broker_mock):
+        ring_mock.return_value.get_nodes.return_value = (
+            7, [{'device': 'sda'}, {'device': 'sdb'}])
+        exists_mock.side_effect = lambda path: '/sdb/' in path
+        conf = {'devices': '/srv/node'}
+
+        broker = sync_status.get_container_broker(conf, 'AUTH_a', 'c')
+        self.assertEqual(broker_mock.return_value, broker)
+        ring_mock.assert_called_once_with('/etc/swift',
+                                          ring_name='container')
+        container_hash = sync_status.hash_path('AUTH_a', 'c')
+        broker_mock.assert_called_once_with(
+            '/srv/node/sdb/containers/7/%s/%s/%s.db' % (
+                container_hash[-3:], container_hash, container_hash),
+            account='AUTH_a', container='c')
+
+        exists_mock.side_effect = None
+        exists_mock.return_value = False
+        self.assertIsNone(
+            sync_status.get_container_broker(conf, 'AUTH_a', 'c'))
+
+    @mock.patch('swift_metadata_sync.sync_status.get_container_broker')
+    def test_get_status(self, get_broker_mock):
+        conf = {'status_dir': '/status/dir',
+                'devices': '/srv/node',
+                'containers': [self.settings,
+                               dict(self.settings, container=u'other')]}
+        get_broker_mock.side_effect = [self.broker, None]
+        with mock.patch.object(sync_status.SyncStatus, 'get_lag') as \
+                lag_mock:
+            lag_mock.return_value = {'row_lag': 10}
+            report = sync_status.get_status(conf, now=1500)
+        lag_mock.assert_called_once_with(self.broker, 1500)
+        self.assertEqual(
+            [{'account': u'AUTH_test', 'container': u'container',
+              'index': 'index', 'row_lag': 10},
+             {'account': u'AUTH_test', 'container': u'other',
+              'index': 'index', 'error': 'container database not found'}],
+            report)
+
+    @mock.patch('swift_metadata_sync.sync_status.get_container_broker')
+    def test_get_status_per_account(self, get_broker_mock):
+        conf = {'status_dir': '/status/dir',
+                'devices': '/srv/node',
+                'containers': [dict(self.settings, container=u'/*')]}
+        internal_client = mock.Mock()
+        internal_client.iter_containers.return_value = [
+            {'name': u'local'}, {'name': u'remote'}]
+        # Only the database of the first container is on this node
+        get_broker_mock.side_effect = [self.broker, None]
+        with mock.patch.object(sync_status.SyncStatus, 'get_lag',
+                               autospec=True) as lag_mock:
+            lag_mock.side_effect = lambda status, broker, now: {
+                'status_file': status._status_file}
+            report = sync_status.get_status(conf, now=1500,
+                                            internal_client=internal_client)
+        internal_client.iter_containers.assert_called_once_with('AUTH_test')
+        self.assertEqual(
+            [mock.call(conf, 'AUTH_test', 'local'),
+             mock.call(conf, 'AUTH_test', 'remote')],
+            get_broker_mock.mock_calls)
+        self.assertEqual(
+            [{'account': u'AUTH_test', 'container': u'local',
+              'index': 'index', 'status_file': '/status/dir/AUTH_test'}],
+            report)
+
+    @mock.patch('swift_metadata_sync.sync_status.get_container_broker')
+    def test_get_status_targets(self, get_broker_mock):
+        mapping = dict(self.settings, targets=[
+            {'index': 'index'}, {'index': 'index', 'name': 'dr',
+                                 'es_hosts': 'dr.example.com'}])
+        del mapping['index']
+        conf = {'status_dir': '/status/dir',
+                'devices': '/srv/node',
+                'containers': [mapping]}
+        get_broker_mock.return_value = self.broker
+        with mock.patch.object(sync_status.SyncStatus, 'get_lag',
+                               autospec=True) as lag_mock:
+            lag_mock.side_effect = lambda status, broker, now: {
+                'status_key': status._get_status_key('db-id')}
+            report = sync_status.get_status(conf, now=1500)
+        self.assertEqual(
+            [{'account': u'AUTH_test', 'container': u'container',
+              'index': 'index', 'target': 'index', 'status_key': 'db-id'},
+             {'account': u'AUTH_test', 'container': u'container',
+              'index': 'index', 'target': 'dr', 'status_key': 'db-id:dr'}],
+            report)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync.timestamp_index import TimestampIndex
+
+
+class TestTimestampIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'account', '.container.ts')
+        self.index = TimestampIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_update_and_get(self):
+        self.index.open('db-id', 'index')
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual({}, self.index.get_many(['foo']))
+        self.index.update([('foo', 1000), ('bar', 2000)])
+        self.index.update([('foo', 3000)])
+        self.assertEqual({'foo': 3000, 'bar': 2000},
+                         self.index.get_many(['foo', 'bar', 'baz']))
+
+    def test_get_many_large(self):
+        self.index.open('db-id', 'index')
+        self.index.update([('doc_%d' % i, i) for i in range(2000)])
+        self.assertEqual(
+            dict(('doc_%d' % i, i) for i in range(2000)),
+            self.index.get_many(['doc_%d' % i for i in range(2000)]))
+
+    def test_remove(self):
+        self.index.open('db-id', 'index')
+        self.index.update([('foo', 1000), ('bar', 2000)])
+        self.index.remove(['foo', 'baz'])
+        self.assertEqual({'bar': 2000}, self.index.get_many(['foo', 'bar']))
+
+    def test_reopen(self):
+        self.index.open('db-id', 'index')
+        self.index.update([('foo', 1000)])
+        self.index.close()
+
+        index = TimestampIndex(self.path)
+        index.open('db-id', 'index')
+        self.assertEqual({'foo': 1000}, index.get_many(['foo']))
+        index.close()
+
+    def test_invalidate(self):
+        for identity in [('new-db-id', 'index'), ('new-db-id', 'new-index')]:
+            self.index.open('db-id', 'index')
+            self.index.update([('foo', 1000)])
+            self.index.open(*identity)
+            self.assertEqual({}, self.index.get_many(['foo']))
+            self.index.close()
@@ -0,0 +1,53 @@
+import logging
+import mock
+import unittest
+
+from swift_metadata_sync.tracing import Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test-tracer')
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = mock.Mock(level=logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_trace(self):
+        tracer = Tracer(u'AUTH_test', u'cont\xe9', logger=self.logger)
+        tracer.trace('handle', rows=[{'name': 'foo'}], count=lambda: 3,
+                     name=u'\u062a')
+        self.handler.handle.assert_called_once_with(mock.ANY)
+        record = self.handler.handle.mock_calls[0][1][0]
+        self.assertEqual(logging.DEBUG, record.levelno)
+        self.assertEqual(
+            "handle account=AUTH_test container=cont\xc3\xa9 count=3 "
+            "name=\xd8\xaa rows=[{'name': 'foo'}]", record.getMessage())
+
+    def test_lazy(self):
+        self.logger.setLevel(logging.INFO)
+        tracer = Tracer(u'AUTH_test', u'container', logger=self.logger)
+        field = mock.Mock()
+        tracer.trace('handle', rows=field)
+        field.assert_not_called()
+        self.handler.handle.assert_not_called()
+
+    def test_sampling(self):
+        containers = [u'container-%d' % i for i in range(1000)]
+        sampled = [container for container in containers
+                   if Tracer(u'AUTH_test', container, 0.1,
+                             logger=self.logger).sampled]
+        self.assertGreater(len(sampled), 50)
+        self.assertLess(len(sampled), 150)
+        # The choice is stable
+        self.assertEqual(sampled, [
+            container for container in containers
+            if Tracer(u'AUTH_test', container, 0.1).sampled])
+        self.assertFalse(Tracer(u'AUTH_test', u'c', 0).sampled)
+        self.assertTrue(Tracer(u'AUTH_test', u'c', 1).sampled)
+
+        tracer = Tracer(u'AUTH_test', u'c', 0, logger=self.logger)
+        tracer.trace('handle', rows=[])
+        self.handler.handle.assert_not_called()